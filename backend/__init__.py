@@ -1,34 +1,42 @@
 # backend/__init__.py
-from .config import (
-    PROJECT_ROOT,
-    DATA_DIR,
-    WRITING_OUTPUTS,
-    JOB_RECORDS_DIR,
-    DB_DIR,
-    MEMU_DB,
-    MEMU_STORAGE_DIR,
-    MEMU_DOWNLOADS_DIR,
-    VENUE_FORMATS,
-    PROJECT_TYPES,
-    get_env,
-)
-from .memu_client import MemUClient
-from .scientific_writer_client import ScientificWriterClient
-from .app_backend import AppBackend
+"""
+backend 包：公开名称按需懒加载（PEP 562），`import backend` 不导入 httpx / openai / fitz 等重依赖。
+运行时目录由 config.ensure_dirs() 显式创建（AppBackend 初始化时调用）。
+"""
 
-__all__ = [
-    "PROJECT_ROOT",
-    "DATA_DIR",
-    "WRITING_OUTPUTS",
-    "JOB_RECORDS_DIR",
-    "DB_DIR",
-    "MEMU_DB",
-    "MEMU_STORAGE_DIR",
-    "MEMU_DOWNLOADS_DIR",
-    "VENUE_FORMATS",
-    "PROJECT_TYPES",
-    "get_env",
-    "MemUClient",
-    "ScientificWriterClient",
-    "AppBackend",
-]
+import importlib
+from typing import Any, Dict
+
+# 公开名称 -> 所在子模块
+_LAZY_ATTRS: Dict[str, str] = {
+    "PROJECT_ROOT": ".config",
+    "DATA_DIR": ".config",
+    "WRITING_OUTPUTS": ".config",
+    "JOB_RECORDS_DIR": ".config",
+    "DB_DIR": ".config",
+    "MEMU_DB": ".config",
+    "MEMU_STORAGE_DIR": ".config",
+    "MEMU_DOWNLOADS_DIR": ".config",
+    "VENUE_FORMATS": ".config",
+    "PROJECT_TYPES": ".config",
+    "get_env": ".config",
+    "ensure_dirs": ".config",
+    "MemUClient": ".memu_client",
+    "ScientificWriterClient": ".scientific_writer_client",
+    "AppBackend": ".app_backend",
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_ATTRS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
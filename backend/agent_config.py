@@ -1,37 +1,34 @@
 # backend/agent_config.py
 """
-Agent 与任务配置加载：memu_scenarios、tasks、prompts。
+Agent 与任务配置加载：memu_scenarios、tasks、prompts（均读自 config_registry 的内存快照，热路径不读磁盘）。
 - 按 agent_id 与 task_name 返回 memory override_config 与 prompt 内容
-- 意图识别 intent_to_agent_ids：小模型 API（qwen 系列），无关键词规则，兜底 _default
+- 意图识别 intent_to_agent_ids：小模型 API（qwen 系列），无关键词规则，兜底 _default；
+  intent_to_agent_ids_batch 将多条输入打包为少量请求；intent_router 本地路由置信时跳过 LLM
+- 异步版本 ainvoke_model / aintent_to_agent_ids：AsyncOpenAI + 按 provider 的并发信号量
+- 流式版本 invoke_model_stream：逐段产出 delta，可在顶层 JSON 对象闭合后提前结束
 """
 
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
 import json
 import re
+import threading
+import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional
-
-from .config import (
-    CONFIG_AGENTS_DIR,
-    CONFIG_PROMPTS_DIR,
-    CONFIG_TASKS_DIR,
-    MEMU_SCENARIOS_PATH,
-    get_env,
-    INTENT_MODEL_DEFAULT,
-)
-
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
 
-def _load_json(path: Path) -> Dict[str, Any]:
-    if not path.exists():
-        return {}
-    try:
-        return json.loads(path.read_text(encoding="utf-8"))
-    except Exception:
-        return {}
+from .config import get_env, INTENT_MODEL_DEFAULT
+from .config_registry import get_config
+from .llm_clients import canonical_provider, get_async_openai_client, get_openai_client, loop_scoped
+from . import intent_router, json_repair, llm_breaker, llm_cache, llm_telemetry, rate_limit, singleflight
 
 
 def load_scenarios() -> Dict[str, Any]:
-    """加载 memu_scenarios.json。"""
-    return _load_json(MEMU_SCENARIOS_PATH)
+    """memu_scenarios.json 的内容（快照副本，可自由修改）。"""
+    return copy.deepcopy(get_config().scenarios)
 
 
 # provider -> (api_key_env, base_url_env, default_base_url)
@@ -44,15 +41,15 @@ _PROVIDER_ENV: Dict[str, tuple] = {
 }
 
 
+def _resolve_provider(provider: str) -> tuple:
+    """provider -> (api_key, base_url)；未知 provider 按 qwen 处理。"""
+    key_env, url_env, default_url = _PROVIDER_ENV.get(provider) or _PROVIDER_ENV["qwen"]
+    return get_env(key_env), get_env(url_env) or default_url
+
+
 def _load_agents_config(agent_id: str) -> Dict[str, Any]:
-    """从 config/agents/<agent_id>.json 加载；缺失时回退 _default.json。"""
-    for aid in (agent_id, "_default"):
-        path = CONFIG_AGENTS_DIR / f"{aid}.json"
-        if path.exists():
-            data = _load_json(path)
-            if isinstance(data, dict):
-                return data
-    return {}
+    """config/agents/<agent_id>.json；缺失时回退 _default.json（只读，来自配置快照）。"""
+    return get_config().agent_config(agent_id)
 
 
 def get_model_for_step(agent_id: str, task_name: str, step: str) -> Dict[str, str]:
@@ -61,15 +58,23 @@ def get_model_for_step(agent_id: str, task_name: str, step: str) -> Dict[str, st
     缺失时回退 _default.json；再缺失则使用 qwen 兜底。
     返回：{"provider": "qwen", "model": "qwen-long"}
     """
+    step_cfg = _get_step_config(agent_id, task_name, step)
+    if step_cfg:
+        provider = (step_cfg.get("provider") or "qwen").lower()
+        model = step_cfg.get("model") or "qwen-long"
+        return {"provider": provider, "model": model}
+    return {"provider": "qwen", "model": "qwen-long"}
+
+
+def _get_step_config(agent_id: str, task_name: str, step: str) -> Dict[str, Any]:
+    """config/agents/<agent_id>.json 中 (task_name, step) 的原始配置；缺失返回 {}。"""
     cfg = _load_agents_config(agent_id)
     task_cfg = cfg.get(task_name)
     if isinstance(task_cfg, dict):
         step_cfg = task_cfg.get(step)
         if isinstance(step_cfg, dict):
-            provider = (step_cfg.get("provider") or "qwen").lower()
-            model = step_cfg.get("model") or "qwen-long"
-            return {"provider": provider, "model": model}
-    return {"provider": "qwen", "model": "qwen-long"}
+            return step_cfg
+    return {}
 
 
 def get_client_for_step(agent_id: str, task_name: str, step: str):
@@ -79,18 +84,8 @@ def get_client_for_step(agent_id: str, task_name: str, step: str):
     """
     m = get_model_for_step(agent_id, task_name, step)
     provider = m.get("provider") or "qwen"
-    model = m.get("model") or "qwen-long"
-    tup = _PROVIDER_ENV.get(provider) or _PROVIDER_ENV.get("qwen")
-    key_env, url_env, default_url = tup
-    api_key = get_env(key_env)
-    base_url = get_env(url_env) or default_url
-    if not api_key:
-        return None
-    try:
-        from openai import OpenAI
-        return OpenAI(api_key=api_key, base_url=base_url)
-    except Exception:
-        return None
+    api_key, base_url = _resolve_provider(provider)
+    return get_openai_client(provider, base_url, api_key)
 
 
 # LLM 调用超时（秒），长文本如公式校验、论文提取需较高值，避免卡壳
@@ -104,17 +99,24 @@ def _do_llm_call(
     messages: List[Dict[str, str]],
     temperature: float,
     timeout: float = LLM_CALL_TIMEOUT,
+    provider: str = "",
 ) -> str:
-    """发起 chat.completions.create，返回 content 或空字符串。"""
-    if not api_key:
+    """
+    发起 chat.completions.create（复用 llm_clients 连接池），返回 content 或空字符串。
+    不做限流：调用方须先 rate_limit.acquire_for_messages，再开始计时，排队时间不计入端点延迟（熔断、hedge p95）。
+    """
+    c = get_openai_client(provider, base_url, api_key, timeout=timeout)
+    if c is None:
         return ""
+    t0 = time.monotonic()
     try:
-        from openai import OpenAI
-        c = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout)
         r = c.chat.completions.create(model=model, messages=messages, temperature=temperature)
-        return (r.choices[0].message.content or "").strip()
-    except Exception:
+        out = (r.choices[0].message.content or "").strip()
+    except Exception as e:
+        llm_telemetry.note_attempt(provider, model, False, time.monotonic() - t0, error=str(e))
         return ""
+    llm_telemetry.note_attempt(provider, model, bool(out), time.monotonic() - t0, response=r, output=out)
+    return out
 
 
 def invoke_model(
@@ -124,58 +126,699 @@ def invoke_model(
     messages: List[Dict[str, str]],
     *,
     temperature: float = 0.2,
+    use_cache: Optional[bool] = None,
+    on_delta: Optional[Callable[[str], None]] = None,
+    stop_at_json_end: bool = False,
 ) -> str:
     """
     根据 agent_id + task_name + step 获取 provider/model，从 .env 取 api_key/base_url，
-    发起 chat.completions.create；失败时回退 qwen 系列。
+    发起 chat.completions.create；失败时回退 qwen 系列（熔断打开的端点跳过，可选 hedged 并行回退）。
+    use_cache: None 时按步骤决定是否走 llm_cache（见 _cache_enabled_for）；False 绕过缓存读写。
+    on_delta / stop_at_json_end: 任一给出时改走 invoke_model_stream，每段输出回调 on_delta（供前端展示部分结果；
+    收到 STREAM_RESET 时应清空已展示的部分输出），
+    stop_at_json_end=True 时顶层 JSON 对象闭合即停止生成。
+    启用 llm_cache 的步骤上，相同 (provider, model, messages, temperature) 的并发调用经 singleflight 合并为一次请求
+    （结果本就可复用）；未缓存的步骤各自请求，不合并。
+    流式模式下被合并的调用方在结果返回后一次性收到完整输出的 on_delta。
     返回：assistant 消息的 content 字符串。
     """
     m = get_model_for_step(agent_id, task_name, step)
     provider = m.get("provider") or "qwen"
     model = m.get("model") or "qwen-long"
-    tup = _PROVIDER_ENV.get(provider) or _PROVIDER_ENV.get("qwen")
-    key_env, url_env, default_url = tup
-    api_key = get_env(key_env)
-    base_url = get_env(url_env) or default_url
 
-    result = _do_llm_call(api_key, base_url, model, messages, temperature, timeout=LLM_CALL_TIMEOUT)
-    if result:
+    if on_delta is not None or stop_at_json_end:
+        def run_stream() -> str:
+            parts = []
+            for delta in invoke_model_stream(
+                agent_id, task_name, step, messages,
+                temperature=temperature, use_cache=use_cache, stop_at_json_end=stop_at_json_end,
+            ):
+                if delta == STREAM_RESET:
+                    parts.clear()
+                else:
+                    parts.append(delta)
+                if on_delta is not None:
+                    try:
+                        on_delta(delta)
+                    except Exception:
+                        pass
+            return "".join(parts).strip()
+
+        if not _cache_enabled_for(agent_id, task_name, step, use_cache):
+            return run_stream()
+        key = llm_cache.make_cache_key(provider, model, messages, temperature) + (":json_end" if stop_at_json_end else "")
+        result, shared = _coalesce(key, run_stream)
+        if shared and on_delta is not None and result:
+            try:
+                on_delta(result)
+            except Exception:
+                pass
+        return result
+
+    with llm_telemetry.track("invoke_model", agent_id, task_name, step, messages) as call:
+        call.provider, call.model = provider, model
+        cache = None
+        cache_key = ""
+        if _cache_enabled_for(agent_id, task_name, step, use_cache):
+            cache = llm_cache.get_cache()
+            cache_key = llm_cache.make_cache_key(provider, model, messages, temperature)
+            cached = cache.get(cache_key)
+            if cached:
+                print(f"[LLM_CACHE] hit | agent_id={agent_id} task={task_name} step={step}", flush=True)
+                call.set_outcome("cache_hit")
+                return cached
+        elif use_cache is False:
+            llm_cache.get_cache().record_bypass()
+
+        def run() -> str:
+            result = _invoke_with_fallback(
+                provider, model, messages, temperature,
+                hedge=_hedge_enabled_for(agent_id, task_name, step), agent_id=agent_id,
+            )
+            if result and cache is not None:
+                cache.put(
+                    cache_key, result,
+                    provider=provider, model=model, agent_id=agent_id, task_name=task_name, step=step,
+                )
+            return result
+
+        if cache is None:
+            return run()
+        result, shared = _coalesce(cache_key, run)
+        if shared:
+            call.set_outcome("coalesced")
         return result
-    # 回退 qwen
-    qwen_key, qwen_url_env, qwen_default = _PROVIDER_ENV["qwen"]
-    qwen_api_key = get_env(qwen_key)
-    qwen_base = get_env(qwen_url_env) or qwen_default
-    for fm in ["qwen-long", "qwen-plus", "qwen-turbo"]:
-        r = _do_llm_call(qwen_api_key, qwen_base, fm, messages, temperature, timeout=LLM_CALL_TIMEOUT)
-        if r:
-            return r
+
+
+def _coalesce(key: str, fn: Callable[[], str]) -> tuple:
+    """经 singleflight "llm" 分组执行 fn；返回 (结果, 是否复用了其他调用方的 in-flight 请求)。"""
+    ran = []
+
+    def leader() -> str:
+        ran.append(True)
+        return fn()
+
+    result = singleflight.get_group("llm").do(key, leader)
+    return result, not ran
+
+
+async def _acoalesce(key: str, fn: Callable[[], Awaitable[str]]) -> tuple:
+    """_coalesce 的协程版本；与线程调用方共享同一 in-flight 表。"""
+    ran = []
+
+    async def leader() -> str:
+        ran.append(True)
+        return await fn()
+
+    result = await singleflight.get_group("llm").ado(key, leader)
+    return result, not ran
+
+
+def _cache_enabled_for(agent_id: str, task_name: str, step: str, use_cache: Optional[bool]) -> bool:
+    """显式 use_cache 优先；否则全局开关 LLM_CACHE_ENABLED + 步骤配置 cache 字段 + 默认缓存步骤。"""
+    if use_cache is not None:
+        return bool(use_cache)
+    if not llm_cache.cache_globally_enabled():
+        return False
+    step_flag = _get_step_config(agent_id, task_name, step).get("cache")
+    if isinstance(step_flag, bool):
+        return step_flag
+    return step in llm_cache.DEFAULT_CACHED_STEPS
+
+
+# qwen 回退链：配置的 provider/model 失败后依次尝试
+_QWEN_FALLBACK_MODELS = ["qwen-long", "qwen-plus", "qwen-turbo"]
+# 视觉模型（消息含图片）只回退到 qwen 视觉模型，纯文本模型无法处理图片
+_QWEN_VL_FALLBACK_MODELS = ["qwen-vl-plus", "qwen-vl-max"]
+# hedged 模式在端点尚无 p95 样本时的默认启动延迟（秒），.env 的 LLM_HEDGE_DELAY 可覆盖
+DEFAULT_HEDGE_DELAY = 30.0
+
+_hedge_pool_lock = threading.Lock()
+_hedge_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def _fallback_chain(provider: str, model: str) -> List[tuple]:
+    """[(provider, model), ...]：配置项在前，随后 qwen 回退链（去重，避免对同一端点重复等待）。"""
+    chain = [(provider, model)]
+    fallbacks = _QWEN_VL_FALLBACK_MODELS if "-vl" in (model or "").lower() else _QWEN_FALLBACK_MODELS
+    for fm in fallbacks:
+        if ("qwen", fm) not in chain and not (canonical_provider(provider) == "qwen" and fm == model):
+            chain.append(("qwen", fm))
+    return chain
+
+
+def _hedge_enabled_for(agent_id: str, task_name: str, step: str) -> bool:
+    """步骤配置 "hedge": true/false 优先；否则 .env 的 LLM_HEDGE_ENABLED（默认关闭）。"""
+    flag = _get_step_config(agent_id, task_name, step).get("hedge")
+    if isinstance(flag, bool):
+        return flag
+    return (get_env("LLM_HEDGE_ENABLED") or "").lower() in ("1", "true", "yes", "on")
+
+
+def _hedge_delay(provider: str, model: str) -> float:
+    """hedge 启动延迟：该端点的 p95 延迟；样本不足时用 LLM_HEDGE_DELAY / DEFAULT_HEDGE_DELAY。"""
+    p95 = llm_breaker.get_breaker(provider, model).p95()
+    if p95 is not None:
+        return max(1.0, p95)
+    try:
+        return max(1.0, float(get_env("LLM_HEDGE_DELAY") or DEFAULT_HEDGE_DELAY))
+    except ValueError:
+        return DEFAULT_HEDGE_DELAY
+
+
+def _get_hedge_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+        return _hedge_pool
+
+
+def _call_endpoint(
+    provider: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    agent_id: str = "_default",
+) -> Optional[str]:
+    """
+    经熔断器调用单个端点：熔断打开或未配置 api_key 时返回 None（表示跳过），
+    否则返回模型输出（失败为空字符串）并记录结果与延迟。
+    """
+    api_key, base_url = _resolve_provider(provider)
+    if not api_key:
+        return None
+    breaker = llm_breaker.get_breaker(provider, model)
+    if not breaker.allow():
+        print(f"[LLM_BREAKER] skip | endpoint={breaker.name}", flush=True)
+        return None
+    rate_limit.acquire_for_messages(provider, model, messages, agent_id=agent_id)
+    t0 = time.monotonic()
+    out = _do_llm_call(api_key, base_url, model, messages, temperature, timeout=LLM_CALL_TIMEOUT, provider=provider)
+    breaker.record(bool(out), time.monotonic() - t0)
+    return out
+
+
+def _invoke_with_fallback(
+    provider: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    hedge: bool = False,
+    agent_id: str = "_default",
+) -> str:
+    """
+    按配置的 provider/model 调用；失败时沿 qwen 回退链继续，熔断打开的端点直接跳过。
+    hedge=True 时，当前端点超过其 p95 延迟仍未返回即并行启动下一个回退，取第一个有效结果。
+    """
+    chain = _fallback_chain(provider, model)
+    if hedge:
+        return _invoke_hedged(chain, messages, temperature, agent_id=agent_id)
+    attempted = False
+    for prov, mdl in chain:
+        out = _call_endpoint(prov, mdl, messages, temperature, agent_id=agent_id)
+        if out is None:
+            continue
+        attempted = True
+        if out:
+            return out
+    if not attempted:
+        # 全部端点熔断：对首个端点强制探测一次，避免直接失败
+        api_key, base_url = _resolve_provider(provider)
+        rate_limit.acquire_for_messages(provider, model, messages, agent_id=agent_id)
+        return _do_llm_call(api_key, base_url, model, messages, temperature, timeout=LLM_CALL_TIMEOUT, provider=provider)
     return ""
 
 
-def get_task_config(agent_id: str, task_name: str) -> Dict[str, Any]:
+def _invoke_hedged(chain: List[tuple], messages: List[Dict[str, str]], temperature: float, agent_id: str = "_default") -> str:
+    pool = _get_hedge_pool()
+    remaining = list(chain)
+    running: Dict[concurrent.futures.Future, tuple] = {}
+
+    def launch_next() -> bool:
+        while remaining:
+            prov, mdl = remaining.pop(0)
+            if not _resolve_provider(prov)[0] or not llm_breaker.get_breaker(prov, mdl).allow():
+                continue
+            # allow() 已占用 half_open 探测名额，此处直接调用并记录
+            # 复制 contextvars，使备用请求的遥测归属到当前调用
+            running[pool.submit(contextvars.copy_context().run, _timed_call, prov, mdl, messages, temperature, agent_id)] = (prov, mdl)
+            return True
+        return False
+
+    if not launch_next():
+        return _invoke_with_fallback(chain[0][0], chain[0][1], messages, temperature, hedge=False, agent_id=agent_id)
+    while running:
+        delay = _hedge_delay(*list(running.values())[-1])
+        done, _ = concurrent.futures.wait(list(running), timeout=delay, return_when=concurrent.futures.FIRST_COMPLETED)
+        if not done:
+            if launch_next():
+                prov, mdl = list(running.values())[-1]
+                print(f"[LLM_HEDGE] 启动备用端点 | endpoint={prov}/{mdl} after={delay:.1f}s", flush=True)
+            continue
+        for fut in done:
+            running.pop(fut, None)
+            try:
+                out = fut.result()
+            except Exception:
+                out = ""
+            if out:
+                return out
+        # 有端点失败：立即启动下一个回退，不再等待 hedge 延迟
+        launch_next()
+    return ""
+
+
+def _timed_call(
+    provider: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    agent_id: str = "_default",
+) -> str:
+    api_key, base_url = _resolve_provider(provider)
+    rate_limit.acquire_for_messages(provider, model, messages, agent_id=agent_id)
+    t0 = time.monotonic()
+    out = _do_llm_call(api_key, base_url, model, messages, temperature, timeout=LLM_CALL_TIMEOUT, provider=provider)
+    llm_breaker.get_breaker(provider, model).record(bool(out), time.monotonic() - t0)
+    return out
+
+
+def get_breaker_states() -> List[Dict[str, Any]]:
+    """各 provider/model 端点的熔断状态、错误率与延迟（closed / open / half_open）。"""
+    return llm_breaker.breaker_states()
+
+
+# ---------- 流式调用：逐段产出 delta，JSON 闭合即停 ----------
+
+
+class JsonEndDetector:
     """
-    获取 (agent_id, task_name) 对应的任务配置（prompt 文件名等）。
-    task_name: paper_ingest | parameter_recommendation | project_proposal | writing
+    增量检测输出中首个顶层 JSON 对象何时闭合：从第一个 "{" 开始计数括号深度，
+    跳过字符串内的括号与转义字符。之前的 ```json 围栏或说明文字不影响检测。
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.done = False
+
+    def feed(self, text: str) -> int:
+        """输入一段增量文本；对象在本段内闭合时返回闭合 "}" 之后的下标，否则返回 -1。"""
+        if self.done:
+            return 0
+        for i, ch in enumerate(text):
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+                    return i + 1
+        return -1
+
+
+# invoke_model_stream 中途断流、改由下一个端点重新生成时产出的标记；on_delta 收到它时应清空已累积的输出
+STREAM_RESET = "\x00<stream-reset>\x00"
+
+
+def _do_llm_stream(
+    api_key: str,
+    base_url: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    timeout: float = LLM_CALL_TIMEOUT,
+    provider: str = "",
+) -> Iterator[str]:
+    """
+    发起 stream=True 的 chat.completions.create，逐段产出非空 delta。
+    与 _do_llm_call 不同，异常直接抛出，由调用方决定是否切换端点；生成器被提前关闭时同时关闭 HTTP 流。
+    限流同 _do_llm_call，由调用方在计时前完成。
+    """
+    c = get_openai_client(provider, base_url, api_key, timeout=timeout)
+    if c is None:
+        return
+    stream = c.chat.completions.create(model=model, messages=messages, temperature=temperature, stream=True)
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+
+
+def invoke_model_stream(
+    agent_id: str,
+    task_name: str,
+    step: str,
+    messages: List[Dict[str, str]],
+    *,
+    temperature: float = 0.2,
+    use_cache: Optional[bool] = None,
+    stop_at_json_end: bool = False,
+) -> Iterator[str]:
     """
-    tasks_file = CONFIG_TASKS_DIR / f"{task_name}.json"
-    data = _load_json(tasks_file)
-    cfg = data.get(agent_id) or data.get("_default") or {}
-    return dict(cfg)
+    invoke_model 的流式版本：逐段产出模型输出，回退链与熔断同 invoke_model（不做 hedged）。
+    端点失败时切换到下一个端点；若失败前已产出内容，先产出 STREAM_RESET，调用方应丢弃此前收到的全部输出，
+    避免收到两个端点拼接的结果。中途断流记为失败（熔断、遥测），截断的输出不写缓存。
+    stop_at_json_end=True 时首个顶层 JSON 对象闭合即停止并关闭连接，丢弃其后的说明文字。
+    缓存命中时一次性产出缓存内容；完整输出（截断后）写入缓存。
+    """
+    m = get_model_for_step(agent_id, task_name, step)
+    provider = m.get("provider") or "qwen"
+    model = m.get("model") or "qwen-long"
+
+    with llm_telemetry.track("invoke_model_stream", agent_id, task_name, step, messages) as call:
+        call.provider, call.model = provider, model
+        cache = None
+        cache_key = ""
+        if _cache_enabled_for(agent_id, task_name, step, use_cache):
+            cache = llm_cache.get_cache()
+            cache_key = llm_cache.make_cache_key(provider, model, messages, temperature)
+            cached = cache.get(cache_key)
+            if cached:
+                print(f"[LLM_CACHE] hit | agent_id={agent_id} task={task_name} step={step}", flush=True)
+                if stop_at_json_end:
+                    detector = JsonEndDetector()
+                    end = detector.feed(cached)
+                    if end >= 0:
+                        cached = cached[:end]
+                call.set_outcome("cache_hit")
+                yield cached
+                return
+        elif use_cache is False:
+            llm_cache.get_cache().record_bypass()
+
+        parts: List[str] = []
+        attempted = False
+        # 仅正常结束（或 JSON 闭合提前结束）的流可写缓存
+        completed = False
+        for prov, mdl in _fallback_chain(provider, model):
+            api_key, base_url = _resolve_provider(prov)
+            if not api_key:
+                continue
+            breaker = llm_breaker.get_breaker(prov, mdl)
+            if not breaker.allow():
+                print(f"[LLM_BREAKER] skip | endpoint={breaker.name}", flush=True)
+                continue
+            attempted = True
+            detector = JsonEndDetector() if stop_at_json_end else None
+            error = ""
+            rate_limit.acquire_for_messages(prov, mdl, messages, agent_id=agent_id)
+            t0 = time.monotonic()
+            try:
+                for delta in _do_llm_stream(api_key, base_url, mdl, messages, temperature, timeout=LLM_CALL_TIMEOUT, provider=prov):
+                    if detector is not None:
+                        end = detector.feed(delta)
+                        if end >= 0:
+                            delta = delta[:end]
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+                    if detector is not None and detector.done:
+                        print(f"[LLM_STREAM] JSON 已闭合，提前结束 | endpoint={breaker.name} chars={sum(len(p) for p in parts)}", flush=True)
+                        break
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                print(f"[LLM_STREAM] 失败 | endpoint={breaker.name} chars={sum(len(p) for p in parts)} error={error}", flush=True)
+            finally:
+                elapsed = time.monotonic() - t0
+                ok = bool(parts) and not error
+                breaker.record(ok, elapsed)
+                llm_telemetry.note_attempt(prov, mdl, ok, elapsed, output="".join(parts), error=error)
+            if ok:
+                completed = True
+                break
+            if parts:
+                # 中途断流：已产出的是截断输出，通知调用方丢弃后由下一个端点重新生成
+                parts.clear()
+                yield STREAM_RESET
+
+        if not attempted:
+            # 全部端点熔断：退回非流式调用（含对首个端点的强制探测）
+            out = _invoke_with_fallback(provider, model, messages, temperature, agent_id=agent_id)
+            if out:
+                completed = True
+                parts.append(out)
+                yield out
+        result = "".join(parts).strip()
+        if result and completed and cache is not None:
+            cache.put(
+                cache_key, result,
+                provider=provider, model=model, agent_id=agent_id, task_name=task_name, step=step,
+            )
 
 
-def _read_prompt_file(agent_id: str, file_name: str, format_vars: Dict[str, Any]) -> str:
-    """读取指定 agent 下的 prompt 文件并应用 format_vars。"""
-    name = file_name if file_name.endswith(".txt") else f"{file_name}.txt"
-    path = CONFIG_PROMPTS_DIR / agent_id / name
-    if not path.exists():
+# ---------- 异步调用：AsyncOpenAI + 按 provider 的并发信号量 ----------
+# 默认每个 provider 的最大并发；config/agents/<agent_id>.json 的 "concurrency": {"qwen": 8} 可覆盖
+DEFAULT_PROVIDER_CONCURRENCY = 8
+
+_semaphore_lock = threading.Lock()
+# id(event loop) -> (循环弱引用, {(provider, 并发上限): Semaphore})；已关闭循环的条目由 loop_scoped 清理
+_semaphores: Dict[int, Tuple[Any, Dict[Tuple[str, int], asyncio.Semaphore]]] = {}
+
+
+def get_provider_concurrency(agent_id: str, provider: str) -> int:
+    """读取 provider 最大并发：agent 配置的 concurrency 优先，其次 _default.json，最后 DEFAULT_PROVIDER_CONCURRENCY。"""
+    provider = canonical_provider(provider)
+    agents = get_config().agents
+    for aid in (agent_id, "_default"):
+        conc = (agents.get(aid) or {}).get("concurrency")
+        if isinstance(conc, dict) and provider in conc:
+            try:
+                return max(1, int(conc[provider]))
+            except (TypeError, ValueError):
+                continue
+    return DEFAULT_PROVIDER_CONCURRENCY
+
+
+def _provider_semaphore(agent_id: str, provider: str) -> asyncio.Semaphore:
+    """
+    当前事件循环内的 provider 信号量，按 (provider, 并发上限) 共享：
+    并发上限取自该 agent 的 get_provider_concurrency，配置了不同 concurrency 的 agent 各自按自己的额度限流。
+    """
+    loop = asyncio.get_running_loop()
+    name = canonical_provider(provider)
+    key = (name, get_provider_concurrency(agent_id, name))
+    with _semaphore_lock:
+        per_loop = loop_scoped(_semaphores, loop)
+        sem = per_loop.get(key)
+        if sem is None:
+            sem = asyncio.Semaphore(key[1])
+            per_loop[key] = sem
+        return sem
+
+
+@contextlib.asynccontextmanager
+async def _endpoint_slot(agent_id: str, provider: str, model: str, messages: List[Dict[str, str]]):
+    """先在限流器排队（不占信号量），再取 provider 并发信号量；两段等待都不计入端点延迟。"""
+    await rate_limit.aacquire_for_messages(provider, model, messages, agent_id=agent_id)
+    async with _provider_semaphore(agent_id, provider):
+        yield
+
+
+async def _ado_llm_call(
+    api_key: str,
+    base_url: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    timeout: float = LLM_CALL_TIMEOUT,
+    provider: str = "",
+    agent_id: str = "_default",
+) -> str:
+    """
+    _do_llm_call 的异步版本：await chat.completions.create。
+    调用方须在 _endpoint_slot 内调用（限流排队 + provider 信号量），计时从取得名额后开始。
+    """
+    c = get_async_openai_client(provider, base_url, api_key, timeout=timeout)
+    if c is None:
         return ""
-    text = path.read_text(encoding="utf-8")
-    if format_vars:
-        try:
-            text = text.format(**format_vars)
-        except KeyError:
-            pass
-    return text.strip()
+    t0 = time.monotonic()
+    try:
+        r = await c.chat.completions.create(model=model, messages=messages, temperature=temperature)
+        out = (r.choices[0].message.content or "").strip()
+    except Exception as e:
+        llm_telemetry.note_attempt(provider, model, False, time.monotonic() - t0, error=str(e))
+        return ""
+    llm_telemetry.note_attempt(provider, model, bool(out), time.monotonic() - t0, response=r, output=out)
+    return out
+
+
+async def _acall_endpoint(
+    agent_id: str,
+    provider: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    check_breaker: bool = True,
+) -> Optional[str]:
+    """_call_endpoint 的异步版本；check_breaker=False 表示调用方已通过 allow()。"""
+    api_key, base_url = _resolve_provider(provider)
+    if not api_key:
+        return None
+    breaker = llm_breaker.get_breaker(provider, model)
+    if check_breaker and not breaker.allow():
+        print(f"[LLM_BREAKER] skip | endpoint={breaker.name}", flush=True)
+        return None
+    async with _endpoint_slot(agent_id, provider, model, messages):
+        t0 = time.monotonic()
+        out = await _ado_llm_call(api_key, base_url, model, messages, temperature, provider=provider, agent_id=agent_id)
+        breaker.record(bool(out), time.monotonic() - t0)
+    return out
+
+
+async def _ainvoke_with_fallback(
+    agent_id: str,
+    provider: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    hedge: bool = False,
+) -> str:
+    chain = _fallback_chain(provider, model)
+    if hedge:
+        return await _ainvoke_hedged(agent_id, chain, messages, temperature)
+    attempted = False
+    for prov, mdl in chain:
+        out = await _acall_endpoint(agent_id, prov, mdl, messages, temperature)
+        if out is None:
+            continue
+        attempted = True
+        if out:
+            return out
+    if not attempted:
+        api_key, base_url = _resolve_provider(provider)
+        async with _endpoint_slot(agent_id, provider, model, messages):
+            return await _ado_llm_call(api_key, base_url, model, messages, temperature, provider=provider, agent_id=agent_id)
+    return ""
+
+
+async def _ainvoke_hedged(
+    agent_id: str,
+    chain: List[tuple],
+    messages: List[Dict[str, str]],
+    temperature: float,
+) -> str:
+    remaining = list(chain)
+    running: Dict[asyncio.Task, tuple] = {}
+
+    def launch_next() -> bool:
+        while remaining:
+            prov, mdl = remaining.pop(0)
+            if not _resolve_provider(prov)[0] or not llm_breaker.get_breaker(prov, mdl).allow():
+                continue
+            task = asyncio.ensure_future(
+                _acall_endpoint(agent_id, prov, mdl, messages, temperature, check_breaker=False)
+            )
+            running[task] = (prov, mdl)
+            return True
+        return False
+
+    if not launch_next():
+        return await _ainvoke_with_fallback(agent_id, chain[0][0], chain[0][1], messages, temperature, hedge=False)
+    try:
+        while running:
+            delay = _hedge_delay(*list(running.values())[-1])
+            done, _ = await asyncio.wait(list(running), timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if launch_next():
+                    prov, mdl = list(running.values())[-1]
+                    print(f"[LLM_HEDGE] 启动备用端点 | endpoint={prov}/{mdl} after={delay:.1f}s", flush=True)
+                continue
+            for task in done:
+                running.pop(task, None)
+                out = task.result() if not task.exception() else ""
+                if out:
+                    return out
+            launch_next()
+        return ""
+    finally:
+        # 异步任务可取消：已有结果后取消仍在进行的备用请求
+        for task in running:
+            task.cancel()
+
+
+async def ainvoke_model(
+    agent_id: str,
+    task_name: str,
+    step: str,
+    messages: List[Dict[str, str]],
+    *,
+    temperature: float = 0.2,
+    use_cache: Optional[bool] = None,
+) -> str:
+    """
+    invoke_model 的异步版本：同样的 provider/model 选择、qwen 回退与响应缓存，
+    但走 AsyncOpenAI 且受 provider 并发信号量约束，多个场景可共享一个事件循环。
+    """
+    m = get_model_for_step(agent_id, task_name, step)
+    provider = m.get("provider") or "qwen"
+    model = m.get("model") or "qwen-long"
+
+    with llm_telemetry.track("ainvoke_model", agent_id, task_name, step, messages) as call:
+        call.provider, call.model = provider, model
+        cache = None
+        cache_key = ""
+        if _cache_enabled_for(agent_id, task_name, step, use_cache):
+            cache = llm_cache.get_cache()
+            cache_key = llm_cache.make_cache_key(provider, model, messages, temperature)
+            cached = await asyncio.to_thread(cache.get, cache_key)
+            if cached:
+                print(f"[LLM_CACHE] hit | agent_id={agent_id} task={task_name} step={step}", flush=True)
+                call.set_outcome("cache_hit")
+                return cached
+        elif use_cache is False:
+            llm_cache.get_cache().record_bypass()
+
+        async def run() -> str:
+            result = await _ainvoke_with_fallback(
+                agent_id, provider, model, messages, temperature, hedge=_hedge_enabled_for(agent_id, task_name, step)
+            )
+            if result and cache is not None:
+                await asyncio.to_thread(
+                    cache.put, cache_key, result,
+                    provider=provider, model=model, agent_id=agent_id, task_name=task_name, step=step,
+                )
+            return result
+
+        if cache is None:
+            return await run()
+        result, shared = await _acoalesce(cache_key, run)
+        if shared:
+            call.set_outcome("coalesced")
+        return result
+
+
+def get_task_config(agent_id: str, task_name: str) -> Dict[str, Any]:
+    """
+    获取 (agent_id, task_name) 对应的任务配置（prompt 文件名等）。
+    task_name: paper_ingest | parameter_recommendation | project_proposal | writing
+    """
+    return get_config().task_config(agent_id, task_name)
 
 
 def get_prompt(agent_id: str, prompt_key: str, task_name: Optional[str] = None, **format_vars: Any) -> str:
@@ -184,30 +827,22 @@ def get_prompt(agent_id: str, prompt_key: str, task_name: Optional[str] = None,
 
     若 task_name 给定，则从 tasks/<task_name>.json 解析 prompt_key 对应的文件名。
     prompt_key: 如 extraction_s1, extraction_s2, figure_caption, prompt, hint
-    format_vars: 用于 str.format() 的变量，如 page_index, param_summary_text
+    format_vars: 模板变量，如 page_index, param_summary_text（模板已预编译，仅 {标识符} 为占位符，
+    JSON 示例等其余花括号原样保留；缺失的变量保留 {name} 原样）
 
     拼接规则：当 agent_id != "_default" 且 agent 与 _default 均存在时，
     返回 agent_specific + "\\n\\n" + default_base；否则返回存在的优先内容。
     """
+    cfg = get_config()
     if task_name:
-        task_cfg = get_task_config(agent_id, task_name)
+        task_cfg = cfg.task_config(agent_id, task_name)
         file_name = task_cfg.get(prompt_key) or task_cfg.get("prompt") or task_cfg.get("hint")
     else:
         file_name = prompt_key if prompt_key.endswith(".txt") else f"{prompt_key}.txt"
 
     if not file_name:
         return ""
-
-    default_content = _read_prompt_file("_default", file_name, format_vars)
-    if agent_id == "_default":
-        return default_content
-
-    agent_content = _read_prompt_file(agent_id, file_name, format_vars)
-    if agent_content and default_content:
-        return agent_content + "\n\n" + default_content
-    if agent_content:
-        return agent_content
-    return default_content
+    return cfg.merged_prompt(agent_id, file_name, format_vars)
 
 
 def get_parameter_recommendation_system_prompt(agent_id: str) -> str:
@@ -226,43 +861,46 @@ def get_memorize_override_config(agent_id: str, task_name: str) -> Dict[str, Any
     获取某任务在 memU memorize 时使用的 override_config（memory_types + memory_categories）。
     从 memu_scenarios[agent_id].tasks[task_name] 读取 memory_types，categories 用 agent 顶层或 _default。
     """
-    scenarios = load_scenarios()
+    scenarios = get_config().scenarios
     agent_cfg = scenarios.get(agent_id) or scenarios.get("_default") or {}
     tasks = agent_cfg.get("tasks") or {}
     task_cfg = tasks.get(task_name) or {}
     memory_types = task_cfg.get("memory_types") or agent_cfg.get("memory_types") or ["knowledge"]
     memory_categories = agent_cfg.get("memory_categories") or (scenarios.get("_default") or {}).get("memory_categories") or []
-    return {
+    return copy.deepcopy({
         "memory_types": memory_types,
         "memory_categories": memory_categories,
-    }
+    })
+
+
+_INTENT_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
 
 
 def _get_intent_client():
     """意图识别使用 DashScope（qwen 系列）；可选后续扩展 OpenRouter。"""
     key = get_env("DASHSCOPE_API_KEY")
-    if not key:
-        return None
-    try:
-        from openai import OpenAI
-        return OpenAI(api_key=key, base_url="https://dashscope.aliyuncs.com/compatible-mode/v1")
-    except Exception:
-        return None
+    return get_openai_client("dashscope", _INTENT_BASE_URL, key)
 
 
-def intent_to_agent_ids(
+def _intent_allowed() -> set:
+    """意图识别允许的 agent_id：memu_scenarios 中的非下划线键 + _default。"""
+    return set(get_config().allowed_agents)
+
+
+def _intent_system_prompt() -> str:
+    return get_config().root_prompt("intent_classification_system.txt") or (
+        "你是一个学术任务意图分类器。根据用户输入或文件名，判断应使用的领域 agent。"
+        "可选 agent_id：physics_agent、cs_agent、chemistry_agent、biology_agent、math_agent、_default。"
+        "只输出一个 JSON：{\"agent_ids\": [\"agent_id1\"]}，不要其他文字。"
+    )
+
+
+def _intent_user_input(
     input_text: str = "",
     file_path: Optional[str] = None,
     file_name: Optional[str] = None,
-) -> List[str]:
-    """
-    根据用户输入或文件名做意图识别，返回应使用的 agent_id 列表。
-    全面采用小模型 API（qwen 系列），无关键词规则。模型不可用或解析失败时返回 ["_default"]。
-    """
-    scenarios = load_scenarios()
-    allowed = {k for k in scenarios if k != "_comment" and not k.startswith("_")}
-    allowed.add("_default")
-
+) -> str:
+    """组装单条意图识别输入（摘要片段 + 文件名）；无可用输入时返回空字符串。"""
     # 优先使用真实内容做意图识别；仅当 input_text 为空且 file_path 提供时，
     # 尝试从文件中截取一小段。PDF 为二进制，read_text 会失败或得乱码，故跳过，仅用文件名。
     text = (input_text or "").strip()
@@ -284,46 +922,52 @@ def intent_to_agent_ids(
         user_input_parts.append(f"用户输入/摘要片段: {text}")
     if name:
         user_input_parts.append(f"文件名: {name}")
-    user_input = "\n".join(user_input_parts).strip()
+    return "\n".join(user_input_parts).strip()
+
+
+def _build_intent_request(
+    input_text: str = "",
+    file_path: Optional[str] = None,
+    file_name: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    组装意图识别请求：返回 {"messages", "model", "allowed"}；无可用输入时返回 None。
+    同步 intent_to_agent_ids 与异步 aintent_to_agent_ids 共用。
+    """
+    user_input = _intent_user_input(input_text, file_path, file_name)
     if not user_input:
-        return ["_default"]
+        return None
+    return {
+        "messages": [
+            {"role": "system", "content": _intent_system_prompt()},
+            {"role": "user", "content": user_input},
+        ],
+        "model": get_env("INTENT_MODEL", INTENT_MODEL_DEFAULT),
+        "allowed": _intent_allowed(),
+        "user_input": user_input,
+    }
 
-    system_path = CONFIG_PROMPTS_DIR / "intent_classification_system.txt"
-    system_prompt = system_path.read_text(encoding="utf-8") if system_path.exists() else (
-        "你是一个学术任务意图分类器。根据用户输入或文件名，判断应使用的领域 agent。"
-        "可选 agent_id：physics_agent、cs_agent、chemistry_agent、biology_agent、math_agent、_default。"
-        "只输出一个 JSON：{\"agent_ids\": [\"agent_id1\"]}，不要其他文字。"
-    )
-    model = get_env("INTENT_MODEL", INTENT_MODEL_DEFAULT)
 
-    client = _get_intent_client()
-    if not client:
-        return ["_default"]
+def _route_intent_locally(user_input: str, allowed: set) -> tuple:
+    """
+    本地意图路由（intent_router）：返回 (routed, prediction)。
+    routed 非 None 时可直接作为结果跳过 LLM；prediction 供 LLM 返回后记录一致性。
+    """
+    router = intent_router.get_router()
+    prediction = router.predict(user_input, allowed)
+    routed = router.answer(prediction)
+    if routed:
+        print(f"[INTENT_ROUTER] 本地命中 | agent_ids={routed} score={prediction['score']}", flush=True)
+    return routed, prediction
 
-    try:
-        r = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_input},
-            ],
-            temperature=0.1,
-        )
-        raw = (r.choices[0].message.content or "").strip()
-    except Exception:
-        return ["_default"]
 
-    # 解析 JSON：允许 {"agent_ids": ["physics_agent"]} 或 代码块内 JSON
-    if "```" in raw:
-        raw = re.sub(r"^.*?```(?:json)?\s*", "", raw)
-        raw = re.sub(r"\s*```.*$", "", raw)
-    raw = raw.strip()
-    m = re.search(r"\{[^{}]*\"agent_ids\"[^{}]*\}", raw)
-    if m:
-        raw = m.group(0)
-    try:
-        data = json.loads(raw)
-        ids = data.get("agent_ids") or []
+def _parse_intent_response(raw: str, allowed: set) -> Optional[List[str]]:
+    """解析意图模型输出；不合法或无允许的 agent_id 时返回 None（调用方回退 _default 且不记录路由样本）。"""
+    # 解析 JSON：允许 {"agent_ids": ["physics_agent"]}、代码块内 JSON 及本地可修复的格式问题；
+    # 意图调用本身很便宜，解析失败直接回退 _default，不发起修复调用
+    parsed = json_repair.parse_model_json(raw, "intent", allow_llm_repair=False)
+    if parsed.ok:
+        ids = parsed.data.get("agent_ids") or []
         if not isinstance(ids, list):
             ids = [ids] if ids else []
         ids = [str(x).strip() for x in ids if x]
@@ -338,15 +982,232 @@ def intent_to_agent_ids(
                 out.append(aid)
         if out:
             return out
-    except (json.JSONDecodeError, TypeError):
-        pass
-    return ["_default"]
+    return None
+
+
+def intent_to_agent_ids(
+    input_text: str = "",
+    file_path: Optional[str] = None,
+    file_name: Optional[str] = None,
+) -> List[str]:
+    """
+    根据用户输入或文件名做意图识别，返回应使用的 agent_id 列表。
+    全面采用小模型 API（qwen 系列），无关键词规则。模型不可用或解析失败时返回 ["_default"]。
+    """
+    req = _build_intent_request(input_text, file_path, file_name)
+    if req is None:
+        return ["_default"]
+    with llm_telemetry.track("intent", "_default", "intent", "classify", req["messages"]) as call:
+        call.provider, call.model = "dashscope", req["model"]
+        routed, prediction = _route_intent_locally(req["user_input"], req["allowed"])
+        if routed:
+            call.set_outcome("local")
+            return routed
+
+        client = _get_intent_client()
+        if not client:
+            return ["_default"]
+
+        raw = _intent_completion(client, req["model"], req["messages"])
+        if not raw:
+            return ["_default"]
+        ids = _parse_intent_response(raw, req["allowed"])
+        if ids is None:
+            return ["_default"]
+        intent_router.get_router().record(req["user_input"], ids, prediction)
+        return ids
+
+
+def _intent_completion(client, model: str, messages: List[Dict[str, str]]) -> str:
+    """意图模型单次请求（限流 + 遥测）；失败返回空字符串。"""
+    rate_limit.acquire_for_messages("dashscope", model, messages)
+    t0 = time.monotonic()
+    try:
+        r = client.chat.completions.create(model=model, messages=messages, temperature=0.1)
+        raw = (r.choices[0].message.content or "").strip()
+    except Exception as e:
+        llm_telemetry.note_attempt("dashscope", model, False, time.monotonic() - t0, error=str(e))
+        return ""
+    llm_telemetry.note_attempt("dashscope", model, bool(raw), time.monotonic() - t0, response=r, output=raw)
+    return raw
+
+
+async def aintent_to_agent_ids(
+    input_text: str = "",
+    file_path: Optional[str] = None,
+    file_name: Optional[str] = None,
+) -> List[str]:
+    """intent_to_agent_ids 的异步版本：AsyncOpenAI + provider 并发信号量，不占用线程。"""
+    req = _build_intent_request(input_text, file_path, file_name)
+    if req is None:
+        return ["_default"]
+    with llm_telemetry.track("aintent", "_default", "intent", "classify", req["messages"]) as call:
+        call.provider, call.model = "dashscope", req["model"]
+        routed, prediction = _route_intent_locally(req["user_input"], req["allowed"])
+        if routed:
+            call.set_outcome("local")
+            return routed
+
+        client = get_async_openai_client("dashscope", _INTENT_BASE_URL, get_env("DASHSCOPE_API_KEY"))
+        if not client:
+            return ["_default"]
+
+        t0 = time.monotonic()
+        try:
+            async with _endpoint_slot("_default", "dashscope", req["model"], req["messages"]):
+                t0 = time.monotonic()
+                r = await client.chat.completions.create(
+                    model=req["model"],
+                    messages=req["messages"],
+                    temperature=0.1,
+                )
+            raw = (r.choices[0].message.content or "").strip()
+        except Exception as e:
+            llm_telemetry.note_attempt("dashscope", req["model"], False, time.monotonic() - t0, error=str(e))
+            return ["_default"]
+        llm_telemetry.note_attempt("dashscope", req["model"], bool(raw), time.monotonic() - t0, response=r, output=raw)
+        ids = _parse_intent_response(raw, req["allowed"])
+        if ids is None:
+            return ["_default"]
+        await asyncio.to_thread(intent_router.get_router().record, req["user_input"], ids, prediction)
+        return ids
+
+
+# 批量意图识别：每个请求最多打包的条目数 / 字符数，单条输入截断长度
+INTENT_BATCH_SIZE = 16
+INTENT_BATCH_MAX_CHARS = 24000
+_INTENT_BATCH_ITEM_CHARS = 1200
+
+_INTENT_BATCH_INSTRUCTION = (
+    "\n\n【批量模式】本次输入包含多条编号条目（[0]、[1]、…），请对每一条独立分类。"
+    "只输出一个 JSON：{\"results\": [{\"index\": 0, \"agent_ids\": [\"agent_id1\"]}, …]}，"
+    "results 必须覆盖全部条目且每条恰好一项，index 与输入编号一致，不要其他文字。"
+)
+
+
+def _parse_intent_batch_response(raw: str, count: int, allowed: set) -> List[Optional[List[str]]]:
+    """解析批量意图输出；缺失或不合法的条目为 None（由调用方逐条回退）。"""
+    out: List[Optional[List[str]]] = [None] * count
+    # 截断的批量输出经本地修复后仍可保留已完整的条目；其余条目由调用方逐条回退
+    data = json_repair.parse_model_json(raw, "intent_batch", allow_llm_repair=False).data
+    results = data.get("results") if isinstance(data, dict) else None
+    if not isinstance(results, list):
+        return out
+    for entry in results:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            idx = int(entry.get("index"))
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= idx < count:
+            continue
+        ids = entry.get("agent_ids") or []
+        if not isinstance(ids, list):
+            ids = [ids]
+        valid: List[str] = []
+        for aid in (str(x).strip() for x in ids if x):
+            if aid in allowed and aid not in valid:
+                valid.append(aid)
+        out[idx] = valid or None
+    return out
+
+
+def _chunk_intent_inputs(indexed: List[tuple], batch_size: int) -> List[List[tuple]]:
+    """按条目数与总字符数切分批次，避免单个请求过大。"""
+    chunks: List[List[tuple]] = []
+    current: List[tuple] = []
+    chars = 0
+    for idx, text in indexed:
+        if current and (len(current) >= batch_size or chars + len(text) > INTENT_BATCH_MAX_CHARS):
+            chunks.append(current)
+            current, chars = [], 0
+        current.append((idx, text))
+        chars += len(text)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _classify_intent_chunk(client, model: str, system_prompt: str, chunk: List[tuple], allowed: set) -> List[Optional[List[str]]]:
+    body = "\n\n".join(f"[{i}]\n{text}" for i, (_, text) in enumerate(chunk))
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": body},
+    ]
+    with llm_telemetry.track("intent_batch", "_default", "intent", "classify_batch", messages) as call:
+        call.provider, call.model = "dashscope", model
+        raw = _intent_completion(client, model, messages)
+    if not raw:
+        return [None] * len(chunk)
+    return _parse_intent_batch_response(raw, len(chunk), allowed)
+
+
+def intent_to_agent_ids_batch(
+    items: List[Any],
+    batch_size: Optional[int] = None,
+) -> List[List[str]]:
+    """
+    批量意图识别：把多条输入打包进少量分类请求（每批最多 batch_size 条，默认 INTENT_BATCH_SIZE），
+    各批并行发送，返回与 items 等长、顺序一致的 agent_id 列表。
+    items 每项为字符串（视为 input_text）或 {"input_text", "file_path", "file_name"} 字典。
+    本地路由（intent_router）置信的条目不进入请求；批量结果中缺失或不合法的条目逐条回退 intent_to_agent_ids；
+    无可用输入的条目直接为 ["_default"]。
+    """
+    results: List[List[str]] = [["_default"] for _ in items]
+    allowed = _intent_allowed()
+    texts: Dict[int, str] = {}
+    predictions: Dict[int, Optional[Dict[str, Any]]] = {}
+    indexed: List[tuple] = []
+    for i, item in enumerate(items):
+        if isinstance(item, dict):
+            text = _intent_user_input(item.get("input_text") or "", item.get("file_path"), item.get("file_name"))
+        else:
+            text = _intent_user_input(str(item or ""))
+        if not text:
+            continue
+        routed, predictions[i] = _route_intent_locally(text, allowed)
+        if routed:
+            results[i] = routed
+            continue
+        texts[i] = text
+        indexed.append((i, text[:_INTENT_BATCH_ITEM_CHARS]))
+    if not indexed:
+        return results
+
+    client = _get_intent_client()
+    if not client:
+        return results
+    model = get_env("INTENT_MODEL", INTENT_MODEL_DEFAULT)
+    system_prompt = _intent_system_prompt() + _INTENT_BATCH_INSTRUCTION
+    chunks = _chunk_intent_inputs(indexed, max(1, batch_size or INTENT_BATCH_SIZE))
+    print(f"[INTENT_BATCH] items={len(items)} requests={len(chunks)}", flush=True)
+
+    if len(chunks) == 1:
+        chunk_outputs = [_classify_intent_chunk(client, model, system_prompt, chunks[0], allowed)]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, len(chunks)), thread_name_prefix="intent-batch") as pool:
+            chunk_outputs = list(pool.map(lambda c: _classify_intent_chunk(client, model, system_prompt, c, allowed), chunks))
+
+    missing: List[int] = []
+    for chunk, outputs in zip(chunks, chunk_outputs):
+        for (idx, _), ids in zip(chunk, outputs):
+            if ids is None:
+                missing.append(idx)
+            else:
+                results[idx] = ids
+                intent_router.get_router().record(texts[idx], ids, predictions.get(idx))
+    for idx in missing:
+        item = items[idx]
+        if isinstance(item, dict):
+            results[idx] = intent_to_agent_ids(item.get("input_text") or "", item.get("file_path"), item.get("file_name"))
+        else:
+            results[idx] = intent_to_agent_ids(str(item or ""))
+    if missing:
+        print(f"[INTENT_BATCH] 批量结果缺失，逐条回退 | count={len(missing)}", flush=True)
+    return results
 
 
 def list_agent_ids() -> List[str]:
     """从 memu_scenarios.json 的 agent_ids 字段读取；若无则回退到遍历排除 _comment 等。"""
-    scenarios = load_scenarios()
-    ids = scenarios.get("agent_ids")
-    if isinstance(ids, list):
-        return [str(x) for x in ids if x and str(x) != "_comment"]
-    return [k for k in scenarios if k != "_comment" and not str(k).startswith("_")]
+    return list(get_config().agent_ids)
@@ -11,17 +11,22 @@ import json
 import time
 import uuid
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
 
-from .config import PROJECT_ROOT, DATA_DIR, get_env
+from .config import PROJECT_ROOT, DATA_DIR, ensure_dirs, get_env
 from .config import VENUE_FORMATS, PROJECT_TYPES, PROJECT_TYPE_PROMPT_HINTS
 from .memu_client import create_memu_client
 from .scientific_writer_client import ScientificWriterClient
 from . import agent_config as agent_config_module
+from . import figure_caption
 from . import paper_ingest as paper_ingest_module
 from . import parameter_recommendation as param_rec_module
 
 
+# 意图识别摘要片段最多读取的页数（扫描版 PDF 无文字时不会遍历全文）
+_SNIPPET_MAX_PAGES = 5
+
+
 def _step_print(scenario: str, step: str, msg: str = "", **kwargs: Any) -> None:
     """每次场景调用的小步骤统一打印，便于后台知晓进度。"""
     parts = [f"[STEP] {scenario} | {step}"]
@@ -53,6 +58,7 @@ class AppBackend:
         memu_db_path: Optional[Path] = None,
         memu_storage_dir: Optional[Path] = None,
     ):
+        ensure_dirs()
         self.project_root = Path(project_root or PROJECT_ROOT)
         self.data_dir = self.project_root / "data"
         self.data_dir.mkdir(parents=True, exist_ok=True)
@@ -88,6 +94,35 @@ class AppBackend:
             "message": writer_status.get("message", "OK"),
         }
 
+    def get_llm_runtime_stats(self) -> Dict[str, Any]:
+        """LLM 调用运行时统计：client 连接池 hit/miss、响应缓存命中率、端点熔断状态、限流排队、本地意图路由一致率、JSON 修复率、请求合并数、PDF 进程池与整页栅格缓存状态等，供调试面板展示。"""
+        from . import intent_router, json_repair, llm_cache, llm_clients, page_raster_cache, pdf_worker_pool, rate_limit, singleflight
+        return {
+            "client_pool": llm_clients.pool_stats(),
+            "response_cache": llm_cache.get_cache().stats(),
+            "breakers": agent_config_module.get_breaker_states(),
+            "rate_limits": rate_limit.get_limiter().metrics(),
+            "intent_router": intent_router.get_router().stats(),
+            "json_repair": json_repair.repair_stats(),
+            "singleflight": singleflight.stats(),
+            "pdf_pool": pdf_worker_pool.stats(),
+            "page_rasters": page_raster_cache.stats(),
+            "figure_captions": figure_caption.stats(),
+        }
+
+    def get_llm_telemetry_report(self, since_hours: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        LLM 调用遥测汇总：按 (agent_id, task_name, step) 返回调用数、错误/缓存命中/回退次数、
+        p50/p95/最大延迟、累计延迟、prompt/completion token 与费用（配置 pricing 时），按累计延迟降序。
+        since_hours 仅统计最近 N 小时。
+        """
+        from . import llm_telemetry
+        return llm_telemetry.get_store().report(since_hours=since_hours)
+
+    def get_llm_breaker_states(self) -> List[Dict[str, Any]]:
+        """各 provider/model 端点熔断状态（closed / open / half_open、错误率、p50/p95 延迟）。"""
+        return agent_config_module.get_breaker_states()
+
     def get_venue_formats(self) -> List[Dict[str, str]]:
         """前端下拉：出版/格式选项（可扩展）。"""
         return self.writer.get_venue_formats()
@@ -97,16 +132,15 @@ class AppBackend:
         return self.writer.get_project_types()
 
     # ---------- Query 规范化（含记忆） ----------
-    def _normalize_query_via_agent_config(
+    def _build_normalize_messages(
         self,
         raw_input: str,
         venue_id: str,
         project_type_id: str,
         data_file_names: List[str],
         memory_md: str,
-        agent_id: str,
-    ) -> Optional[str]:
-        """通过 agent_config.invoke_model 做 query 规范化，返回规范化后的 query 或 None。"""
+    ) -> List[Dict[str, str]]:
+        """组装 query 规范化的 messages（同步/异步规范化共用）。"""
         venue = next((v for v in VENUE_FORMATS if v["id"] == venue_id), VENUE_FORMATS[0])
         ptype = next((t for t in PROJECT_TYPES if t["id"] == project_type_id), PROJECT_TYPES[0])
         prompt_hint = PROJECT_TYPE_PROMPT_HINTS.get(project_type_id, "document")
@@ -121,19 +155,69 @@ class AppBackend:
 {memory_md[:3000] if memory_md else '无'}
 """
         from .scientific_writer_client import QUERY_NORMALIZE_SYSTEM
-        messages = [
+        return [
             {"role": "system", "content": QUERY_NORMALIZE_SYSTEM},
             {"role": "user", "content": user_content.strip()},
         ]
-        out = agent_config_module.invoke_model(
-            agent_id, "writing", "query_normalize", messages, temperature=0.3
-        )
+
+    @staticmethod
+    def _clean_normalized_query(out: str) -> Optional[str]:
         if not out:
             return None
         if out.startswith('"') and out.endswith('"'):
             out = out[1:-1]
         return out.strip()
 
+    def _normalize_query_via_agent_config(
+        self,
+        raw_input: str,
+        venue_id: str,
+        project_type_id: str,
+        data_file_names: List[str],
+        memory_md: str,
+        agent_id: str,
+    ) -> Optional[str]:
+        """通过 agent_config.invoke_model 做 query 规范化，返回规范化后的 query 或 None。"""
+        messages = self._build_normalize_messages(raw_input, venue_id, project_type_id, data_file_names, memory_md)
+        out = agent_config_module.invoke_model(
+            agent_id, "writing", "query_normalize", messages, temperature=0.3
+        )
+        return self._clean_normalized_query(out)
+
+    async def anormalize_query(
+        self,
+        raw_input: str,
+        venue_id: str = "nature",
+        project_type_id: str = "paper",
+        data_file_names: Optional[List[str]] = None,
+        memory_md: str = "",
+        agent_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        normalize_query 的异步版本（memory_md 由调用方提供）：agent_config.ainvoke_model 不占用线程；
+        失败时在线程中回退 writer.normalize_query。
+        """
+        aid = agent_id or self.memu.agent_id or "_default"
+        data_files = data_file_names or []
+        _step_print("normalize_query", "agent_config 异步规范化", agent_id=aid, memory_len=len(memory_md or ""))
+        messages = self._build_normalize_messages(raw_input, venue_id, project_type_id, data_files, memory_md or "")
+        out = await agent_config_module.ainvoke_model(
+            aid, "writing", "query_normalize", messages, temperature=0.3
+        )
+        query = self._clean_normalized_query(out)
+        if query:
+            _step_print("normalize_query", "完成", source="agent_config", query_len=len(query))
+            return {"query": query, "source": "agent_config", "error": None}
+        _step_print("normalize_query", "回退 writer.normalize_query")
+        return await asyncio.to_thread(
+            self.writer.normalize_query,
+            raw_input=raw_input,
+            venue_id=venue_id,
+            project_type_id=project_type_id,
+            data_file_names=data_files,
+            memory_md=memory_md or "",
+        )
+
     def normalize_query(
         self,
         raw_input: str,
@@ -196,7 +280,8 @@ class AppBackend:
         # 1) 记忆上下文（minimal 模式可跳过以加快速度）
         memory_md = ""
         if not use_minimal_query and self.memu.enabled:
-            memory_md = self.memu.get_memory_context_for_writing(
+            memory_md = await asyncio.to_thread(
+                self.memu.get_memory_context_for_writing,
                 topic_hint=raw_input.strip() or "scientific writing",
                 user_id=user_id,
                 agent_id=agent_id,
@@ -223,13 +308,12 @@ class AppBackend:
                 log_step("query", f"minimal query_len={len(query)}")
         else:
             _step_print("run_paper_generation", "规范化 query")
-            norm = self.normalize_query(
+            norm = await self.anormalize_query(
                 raw_input=raw_input,
                 venue_id=venue_id,
                 project_type_id=project_type_id,
                 data_file_names=data_file_names,
                 memory_md=memory_md,
-                user_id=user_id,
                 agent_id=agent_id,
             )
             query = norm.get("query", "")
@@ -501,7 +585,8 @@ class AppBackend:
     ) -> str:
         """
         从文件提取可用于意图识别的摘要片段。
-        PDF 使用 PyMuPDF 提取，非 PDF 使用 read_text；避免 read_text 对 PDF 产生乱码。
+        PDF 经 pdf_extract.iter_pdf_text_pages 逐页读前几页文本（进程池启用时在子进程中读取，不写盘，凑够 max_chars 即停），
+        格式与 extract_raw_with_pymupdf 的 raw_text 相同；非 PDF 使用 read_text；避免 read_text 对 PDF 产生乱码。
         返回空字符串表示提取失败，调用方可用 file_name 作为兜底。
         """
         path = Path(file_path)
@@ -510,9 +595,15 @@ class AppBackend:
         if path.suffix.lower() == ".pdf":
             try:
                 from . import pdf_extract as pdf_extract_module
-                out = pdf_extract_module.extract_raw_with_pymupdf(str(path))
-                if not out.get("error") and out.get("raw_text"):
-                    return out["raw_text"][:max_chars]
+                parts: List[str] = []
+                n_chars = 0
+                for page in pdf_extract_module.iter_pdf_text_pages(str(path), max_pages=_SNIPPET_MAX_PAGES):
+                    parts.append(f"--- 第 {page['page_num']} 页 ---\n{page['text']}")
+                    n_chars += len(page["text"])
+                    if n_chars >= max_chars:
+                        break
+                if n_chars:
+                    return "\n\n".join(parts)[:max_chars]
             except Exception:
                 pass
             return ""
@@ -550,6 +641,39 @@ class AppBackend:
         _step_print("intent_to_agent_ids", "完成", agent_ids=result)
         return result
 
+    def intent_to_agent_ids_batch(
+        self,
+        file_paths: Optional[List[str]] = None,
+        input_texts: Optional[List[str]] = None,
+        auto_extract_pdf: bool = True,
+        file_names: Optional[List[Optional[str]]] = None,
+    ) -> List[List[str]]:
+        """
+        批量意图识别（多文件上传 / 批量入库）：file_paths、input_texts、file_names 按位置对应，可只给其一。
+        file_names 为文件名提示（同 intent_to_agent_ids 的 file_name），未给出时取 file_paths 的文件名。
+        auto_extract_pdf=True 时对无 input_text 的 PDF 用 get_pdf_abstract_snippet 提取摘要。
+        多条输入打包为少量请求，返回与输入等长的 agent_id 列表。
+        """
+        paths = list(file_paths or [])
+        texts = list(input_texts or [])
+        names = list(file_names or [])
+        n = max(len(paths), len(texts), len(names))
+        items: List[Dict[str, Any]] = []
+        for i in range(n):
+            fpath = paths[i] if i < len(paths) else None
+            inp = (texts[i] if i < len(texts) else "") or ""
+            inp = inp.strip()
+            fname = (names[i] if i < len(names) else None) or (Path(fpath).name if fpath else "")
+            if not inp and auto_extract_pdf and fpath and Path(fpath).suffix.lower() == ".pdf":
+                inp = self.get_pdf_abstract_snippet(str(fpath), max_chars=1000)
+            if not inp and fname:
+                inp = fname
+            items.append({"input_text": inp, "file_path": fpath, "file_name": fname})
+        _step_print("intent_to_agent_ids_batch", "开始", count=n)
+        result = agent_config_module.intent_to_agent_ids_batch(items)
+        _step_print("intent_to_agent_ids_batch", "完成", agent_ids=result)
+        return result
+
     def get_agent_task_config(
         self,
         agent_id: str,
@@ -564,6 +688,13 @@ class AppBackend:
         _step_print("list_agent_ids", "返回", agent_ids=ids)
         return ids
 
+    def get_config_report(self, reload: bool = False) -> Dict[str, Any]:
+        """配置快照的校验报告（文件数、解析错误、缺失 prompt 等告警、加载时间与重载次数）；reload=True 先强制重载。"""
+        from . import config_registry
+        if reload:
+            config_registry.get_registry().reload(force=True)
+        return config_registry.validation_report()
+
     # ---------- 论文入库（PDF 结构化提取 + memU + 本地 DB） ----------
     def paper_ingest_pdf(
         self,
@@ -579,6 +710,7 @@ class AppBackend:
         论文 PDF 入库：意图识别（可选）→ 按 agent 模板提取 → 存储 → memU memorize → 本地 DB。
         paper_ingest 返回 results 后，app_backend 对每条执行 memorize + insert_record（含 memu_error）。
         若提供 pre_extracted、pre_extracted_for_agent，则对匹配的 agent 复用，避免重复提取。
+        有 figures 的记录入库后提交后台图像说明（figure_caption.schedule_captioning），results 项的 figure_caption_scheduled 标记是否已提交。
         返回 agent_ids、results（每项含 agent_id, record_id, task_id, structured, error）。
         """
         uid = user_id or self.memu.user_id
@@ -625,9 +757,36 @@ class AppBackend:
             record["memu_error"] = memu_error
             _step_print("paper_ingest_pdf", "insert_record", record_id=record.get("record_id"))
             self.memu.insert_record(record)
+            # 图像说明（VLM）在记录入库后于后台进行，完成后改写 structured.json，不计入入库耗时
+            if r.get("resolved_storage_folder") and (r.get("structured") or {}).get("figures"):
+                fut = figure_caption.schedule_captioning(Path(r["resolved_storage_folder"]), r.get("agent_id") or "_default")
+                r["figure_caption_scheduled"] = fut is not None
         _step_print("paper_ingest_pdf", "完成", total_records=len(results))
         return out
 
+    def paper_ingest_pdfs(
+        self,
+        file_paths: List[str],
+        user_id: Optional[str] = None,
+        user_input: str = "",
+        storage_dir: Optional[Path] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        批量论文入库：先用 intent_to_agent_ids_batch 一次性完成全部意图识别，再逐篇 paper_ingest_pdf。
+        返回与 file_paths 等长的入库结果列表。
+        """
+        agent_ids_list = self.intent_to_agent_ids_batch(file_paths=file_paths)
+        return [
+            self.paper_ingest_pdf(
+                fp,
+                user_id=user_id,
+                agent_ids=agent_ids,
+                user_input=user_input,
+                storage_dir=storage_dir,
+            )
+            for fp, agent_ids in zip(file_paths, agent_ids_list)
+        ]
+
     # ---------- 参数推荐（多 agent 记忆 + 模板 + 大模型） ----------
     def _get_memory_context_for_agents(
         self,
@@ -655,11 +814,13 @@ class AppBackend:
         agent_id: Optional[str] = None,
         agent_ids: Optional[List[str]] = None,
         relevant_forces: Optional[List[Dict[str, Any]]] = None,
+        on_partial: Optional[Callable[[str], None]] = None,
     ) -> Dict[str, Any]:
         """
         场景三：参数推荐（final_project DESIGN_ARCHITECTURE 对应）。
         输入：structured_paper + user_params（expected_phenomena 期望模拟现象；参数名 -> 含义/单位）。
         输出：parameter_recommendations（各参数的 range 如 [1,2]、reason 取值原因）、force_field_recommendation（力场与其他模拟参数）。
+        on_partial：逐段接收模型输出（流式），供前端在生成过程中展示部分结果。
         """
         uid = user_id or self.memu.user_id
         _step_print("parameter_recommendation", "开始", agent_id=agent_id)
@@ -702,6 +863,7 @@ class AppBackend:
             agent_ids=agent_ids,
             memory_context=memory_context,
             relevant_forces=relevant_forces,
+            on_partial=on_partial,
         )
         # 保存参数推荐结果到存储（summary.md + recommendations.json）
         if not out.get("error"):
@@ -887,12 +1049,14 @@ class AppBackend:
         agent_ids: Optional[List[str]] = None,
         log_step: Optional[Any] = None,
         skip_formula_verify: bool = False,
+        on_partial: Optional[Callable[[str], None]] = None,
     ) -> Dict[str, Any]:
         """
         场景一：论文上传分析（final_project DESIGN_ARCHITECTURE 对应）。
         输入：PDF 路径 + 用户问题（对论文的理解/关注点）。
         输出：JSON（text_thread 结构化）+ Markdown（markdown_summary 供前端展示）；memU 记忆 + DB 落库。
         流程：PyMuPDF 提取 → 意图识别 → LLM 公式校验（可 skip_formula_verify 避免卡壳）→ 文本结构化 → 入库。
+        on_partial：逐段接收文本结构化阶段的 JSON 输出（流式）。
         """
         from .agent_config import intent_to_agent_ids  # type: ignore
         from . import pdf_extract as pdf_extract_module
@@ -931,10 +1095,12 @@ class AppBackend:
         # 2) LLM 公式校验（仅 PyMuPDF 成功时执行一次，main_agent；skip_formula_verify 可跳过避免卡壳）
         _step_print("paper_analysis_scenario", "公式校验", skip=skip_formula_verify or not (use_pymupdf_flow and bool(raw_text)))
         if use_pymupdf_flow and raw_text and not skip_formula_verify:
-            verify_out = pdf_extract_module.verify_formulas_with_llm(raw_text, agent_id=main_agent, max_chars=15000)
+            verify_out = pdf_extract_module.verify_formulas_with_llm(
+                raw_text, agent_id=main_agent, max_chars=15000, file_path=str(path)
+            )
             corrected_text = verify_out.get("corrected_text", raw_text)
             if log_step:
-                log_step("formula_verify", "公式校验", data={"error": verify_out.get("error") or "ok"})
+                log_step("formula_verify", "公式校验", data={"error": verify_out.get("error") or "ok", "stats": verify_out.get("stats")})
 
         # 3) 文本结构化：有 corrected_text 时用 raw_text_input；否则回退 file-extract
         _step_print("paper_analysis_scenario", "extract_paper_structure", main_agent=main_agent)
@@ -944,6 +1110,7 @@ class AppBackend:
             agent_id=main_agent,
             storage_dir=None,
             raw_text_input=raw_text_input,
+            on_partial=on_partial,
         )
         if log_step:
             log_step("thread_text", "extract_paper_structure 输出", data=text_thread)
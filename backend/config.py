@@ -36,6 +36,12 @@ MEMU_TEST_DB = DB_DIR / "memu_test.db"
 MEMU_TEST_STORAGE = DB_DIR / "memu_storage_test"
 # 默认下载目录（用户选择“下载”时，可指定或使用此目录）
 MEMU_DOWNLOADS_DIR = DB_DIR / "downloads"
+# LLM 响应缓存（invoke_model 确定性步骤复用结果，见 llm_cache.py）
+LLM_CACHE_DB = DB_DIR / "llm_cache.db"
+# 本地意图路由的决策日志（intent_router.py 从历史 LLM 意图结果中学习）
+INTENT_ROUTER_DB = DB_DIR / "intent_router.db"
+# LLM 调用遥测（每次调用的延迟/token/回退路径，见 llm_telemetry.py）
+LLM_TELEMETRY_DB = DB_DIR / "llm_telemetry.db"
 
 # 场景与 agent 格式配置（JSON，按 agent_id 区分领域）
 CONFIG_DIR = PROJECT_ROOT / "config"
@@ -44,17 +50,30 @@ MEMU_SCENARIOS_PATH = CONFIG_DIR / "memu_scenarios.json"
 CONFIG_TASKS_DIR = CONFIG_DIR / "tasks"
 CONFIG_PROMPTS_DIR = CONFIG_DIR / "prompts"
 
-# Ensure dirs
-WRITING_OUTPUTS.mkdir(parents=True, exist_ok=True)
-JOB_RECORDS_DIR.mkdir(parents=True, exist_ok=True)
-DATA_DIR.mkdir(parents=True, exist_ok=True)
-DB_DIR.mkdir(parents=True, exist_ok=True)
-MEMU_STORAGE_DIR.mkdir(parents=True, exist_ok=True)
-MEMU_DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
-CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-CONFIG_AGENTS_DIR.mkdir(parents=True, exist_ok=True)
-CONFIG_TASKS_DIR.mkdir(parents=True, exist_ok=True)
-CONFIG_PROMPTS_DIR.mkdir(parents=True, exist_ok=True)
+# 运行时目录：导入本模块不再创建目录（测试收集、CLI 工具无副作用），由 ensure_dirs() 显式创建
+_RUNTIME_DIRS = (
+    WRITING_OUTPUTS,
+    JOB_RECORDS_DIR,
+    DATA_DIR,
+    DB_DIR,
+    MEMU_STORAGE_DIR,
+    MEMU_DOWNLOADS_DIR,
+    CONFIG_DIR,
+    CONFIG_AGENTS_DIR,
+    CONFIG_TASKS_DIR,
+    CONFIG_PROMPTS_DIR,
+)
+_dirs_ready = False
+
+
+def ensure_dirs() -> None:
+    """创建项目运行所需目录（幂等）。AppBackend / ScientificWriterClient 初始化时调用。"""
+    global _dirs_ready
+    if _dirs_ready:
+        return
+    for d in _RUNTIME_DIRS:
+        d.mkdir(parents=True, exist_ok=True)
+    _dirs_ready = True
 
 
 # ---------- Format / project type options (extensible) ----------
@@ -0,0 +1,330 @@
+# backend/config_registry.py
+"""
+配置快照注册表：一次性加载 config/ 下的 agents、tasks、prompts 与 memu_scenarios.json，
+预先合并为只读快照（ConfigSnapshot），热路径只读内存，不再触碰磁盘。
+- 预合并：agent 配置（缺失回退 _default）、任务配置、每个 agent 的 prompt（agent_specific + "\\n\\n" + default_base）、
+  retrieve 配置、意图识别允许的 agent_id
+- 热加载：后台线程每 CONFIG_RELOAD_INTERVAL 秒（默认 2，<=0 关闭）比对文件 mtime/大小，有变化时重建并原子替换快照；
+  重载时解析失败的文件沿用上一版内容并记入校验报告
+- prompt 加载时即编译为 PromptTemplate（prompt_template.py），渲染不再逐次 str.format
+- 校验报告：JSON 解析错误、任务引用的 prompt 文件缺失、步骤缺少 model、memu_scenarios.agent_ids 未配置、
+  prompt 模板缺失/未知变量（prompt_issues）等
+命令行：python -m backend.config_registry report
+"""
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from .config import CONFIG_DIR, get_env
+from .prompt_template import PromptTemplate, check_templates, compile_templates
+
+_DEFAULT_RELOAD_INTERVAL = 2.0
+
+Fingerprint = Tuple[Tuple[str, int, int], ...]
+
+
+class ConfigSnapshot:
+    """某一时刻的完整配置（构建后不再修改；调用方不要修改返回的 dict）。"""
+
+    def __init__(
+        self,
+        agents: Dict[str, Dict[str, Any]],
+        tasks: Dict[str, Dict[str, Any]],
+        prompts: Dict[str, str],
+        scenarios: Dict[str, Any],
+        fingerprint: Fingerprint,
+        report: Dict[str, Any],
+        templates: Optional[Dict[str, PromptTemplate]] = None,
+    ):
+        self.agents = agents
+        self.tasks = tasks
+        self.prompts = prompts
+        self.templates = templates if templates is not None else compile_templates(prompts)
+        self.scenarios = scenarios
+        self.fingerprint = fingerprint
+        self.report = report
+        self.loaded_at = time.time()
+        self.allowed_agents: FrozenSet[str] = frozenset(
+            {k for k in scenarios if k != "_comment" and not str(k).startswith("_")} | {"_default"}
+        )
+        ids = scenarios.get("agent_ids")
+        if isinstance(ids, list):
+            self.agent_ids = [str(x) for x in ids if x and str(x) != "_comment"]
+        else:
+            self.agent_ids = [k for k in scenarios if k != "_comment" and not str(k).startswith("_")]
+        self._merged: Dict[Tuple[str, str], str] = {}
+        agent_dirs = {rel.split("/", 1)[0] for rel in prompts if "/" in rel}
+        for rel in prompts:
+            if "/" in rel:
+                name = rel.split("/", 1)[1]
+                for aid in agent_dirs:
+                    self._merged.setdefault((aid, name), self._merge(self.prompt_part(aid, name), self.prompt_part("_default", name), aid))
+
+    @staticmethod
+    def _merge(agent_content: str, default_content: str, agent_id: str) -> str:
+        if agent_id == "_default":
+            return default_content
+        if agent_content and default_content:
+            return agent_content + "\n\n" + default_content
+        return agent_content or default_content
+
+    def agent_config(self, agent_id: str) -> Dict[str, Any]:
+        """config/agents/<agent_id>.json；缺失时回退 _default.json。"""
+        return self.agents.get(agent_id) or self.agents.get("_default") or {}
+
+    def task_config(self, agent_id: str, task_name: str) -> Dict[str, Any]:
+        data = self.tasks.get(task_name) or {}
+        return dict(data.get(agent_id) or data.get("_default") or {})
+
+    def prompt_part(self, agent_id: str, file_name: str, format_vars: Optional[Dict[str, Any]] = None) -> str:
+        """config/prompts/<agent_id>/<file_name> 渲染 format_vars 后去首尾空白；不存在返回空字符串。"""
+        name = file_name if file_name.endswith(".txt") else f"{file_name}.txt"
+        tpl = self.templates.get(f"{agent_id}/{name}")
+        if tpl is None:
+            return ""
+        return tpl.render(format_vars).strip()
+
+    def merged_prompt(self, agent_id: str, file_name: str, format_vars: Optional[Dict[str, Any]] = None) -> str:
+        """agent_specific + "\\n\\n" + default_base（无 format_vars 时直接返回预合并结果）。"""
+        name = file_name if file_name.endswith(".txt") else f"{file_name}.txt"
+        if not format_vars:
+            merged = self._merged.get((agent_id, name))
+            if merged is not None:
+                return merged
+        return self._merge(
+            self.prompt_part(agent_id, name, format_vars) if agent_id != "_default" else "",
+            self.prompt_part("_default", name, format_vars),
+            agent_id,
+        )
+
+    def root_prompt(self, file_name: str) -> str:
+        """config/prompts/ 根目录下的 prompt（如 formula_verification.txt）；不存在返回空字符串。"""
+        return self.prompts.get(file_name) or ""
+
+    def retrieve_config(self, agent_id: str) -> Dict[str, Any]:
+        cfg = self.scenarios.get(agent_id) or self.scenarios.get("_default") or {}
+        return dict(cfg.get("retrieve") or {})
+
+
+def _scan(config_dir: Path) -> Dict[str, Path]:
+    """受管理的配置文件：agents/*.json、tasks/*.json、prompts/**/*.txt、memu_scenarios.json。"""
+    files: Dict[str, Path] = {}
+    for sub, pattern in (("agents", "*.json"), ("tasks", "*.json"), ("prompts", "**/*.txt")):
+        base = config_dir / sub
+        if base.exists():
+            for p in base.glob(pattern):
+                if p.is_file():
+                    files[p.relative_to(config_dir).as_posix()] = p
+    scenarios = config_dir / "memu_scenarios.json"
+    if scenarios.exists():
+        files["memu_scenarios.json"] = scenarios
+    return files
+
+
+def _fingerprint(files: Dict[str, Path]) -> Fingerprint:
+    out = []
+    for rel in sorted(files):
+        try:
+            st = files[rel].stat()
+        except OSError:
+            continue
+        out.append((rel, st.st_mtime_ns, st.st_size))
+    return tuple(out)
+
+
+def _validate(snapshot_parts: Dict[str, Any], report: Dict[str, Any]) -> None:
+    agents, tasks, prompts, scenarios = (snapshot_parts[k] for k in ("agents", "tasks", "prompts", "scenarios"))
+    warnings = report["warnings"]
+    if "_default" not in agents:
+        warnings.append("agents/_default.json 缺失，步骤配置将使用 qwen 兜底")
+    for aid, cfg in sorted(agents.items()):
+        for task_name, task_cfg in cfg.items():
+            if not isinstance(task_cfg, dict) or task_name.startswith("_") or task_name in ("concurrency", "rate_limits", "pricing"):
+                continue
+            for step, step_cfg in task_cfg.items():
+                if isinstance(step_cfg, dict) and "provider" in step_cfg and not step_cfg.get("model"):
+                    warnings.append(f"agents/{aid}.json: {task_name}.{step} 未配置 model")
+    for task_name, data in sorted(tasks.items()):
+        for aid, task_cfg in data.items():
+            if not isinstance(task_cfg, dict):
+                continue
+            for key, file_name in task_cfg.items():
+                if not isinstance(file_name, str) or not file_name.endswith(".txt"):
+                    continue
+                if f"{aid}/{file_name}" not in prompts and f"_default/{file_name}" not in prompts:
+                    warnings.append(f"tasks/{task_name}.json: {aid}.{key} 引用的 prompt {file_name} 不存在")
+    ids = scenarios.get("agent_ids")
+    if isinstance(ids, list):
+        for aid in ids:
+            if aid not in scenarios:
+                warnings.append(f"memu_scenarios.json: agent_ids 中的 {aid} 缺少场景配置")
+    report["prompt_issues"] = check_templates(snapshot_parts["templates"])
+    for issue in report["prompt_issues"]:
+        where = f"prompts/{issue['agent_id']}/{issue['prompt']}" if issue["agent_id"] != "-" else f"prompts/{issue['prompt']}"
+        if issue["unknown"]:
+            warnings.append(f"{where}: 未知占位符 {', '.join(issue['unknown'])}（渲染时不会被替换）")
+        if issue["missing"]:
+            warnings.append(f"{where}: 合并后缺少变量 {', '.join(issue['missing'])}")
+
+
+def build_snapshot(config_dir: Path, previous: Optional[ConfigSnapshot] = None) -> ConfigSnapshot:
+    """读取并校验全部配置文件，构建新快照；JSON 解析失败的文件沿用 previous 中的内容（若有）。"""
+    files = _scan(config_dir)
+    fingerprint = _fingerprint(files)
+    report: Dict[str, Any] = {"files": len(files), "errors": [], "warnings": []}
+    agents: Dict[str, Dict[str, Any]] = {}
+    tasks: Dict[str, Dict[str, Any]] = {}
+    prompts: Dict[str, str] = {}
+    scenarios: Dict[str, Any] = {}
+
+    def load_json(rel: str, prev: Any) -> Optional[Dict[str, Any]]:
+        try:
+            data = json.loads(files[rel].read_text(encoding="utf-8"))
+        except Exception as e:
+            report["errors"].append(f"{rel}: {e}")
+            return prev if isinstance(prev, dict) else None
+        if not isinstance(data, dict):
+            report["errors"].append(f"{rel}: 顶层应为 JSON 对象")
+            return prev if isinstance(prev, dict) else None
+        return data
+
+    for rel in sorted(files):
+        if rel.startswith("agents/"):
+            aid = rel[len("agents/"):-len(".json")]
+            data = load_json(rel, previous.agents.get(aid) if previous else None)
+            if data is not None:
+                agents[aid] = data
+        elif rel.startswith("tasks/"):
+            name = rel[len("tasks/"):-len(".json")]
+            data = load_json(rel, previous.tasks.get(name) if previous else None)
+            if data is not None:
+                tasks[name] = data
+        elif rel.startswith("prompts/"):
+            try:
+                prompts[rel[len("prompts/"):]] = files[rel].read_text(encoding="utf-8")
+            except Exception as e:
+                report["errors"].append(f"{rel}: {e}")
+                if previous and rel[len("prompts/"):] in previous.prompts:
+                    prompts[rel[len("prompts/"):]] = previous.prompts[rel[len("prompts/"):]]
+        elif rel == "memu_scenarios.json":
+            scenarios = load_json(rel, previous.scenarios if previous else None) or {}
+
+    templates = compile_templates(prompts)
+    _validate({"agents": agents, "tasks": tasks, "prompts": prompts, "scenarios": scenarios, "templates": templates}, report)
+    return ConfigSnapshot(agents, tasks, prompts, scenarios, fingerprint, report, templates)
+
+
+class ConfigRegistry:
+    """持有当前快照；reload() 在文件变化时重建并原子替换，watch() 启动后台轮询线程。"""
+
+    def __init__(self, config_dir: Optional[Path] = None, reload_interval: Optional[float] = None):
+        self.config_dir = Path(config_dir or CONFIG_DIR)
+        if reload_interval is None:
+            try:
+                reload_interval = float(get_env("CONFIG_RELOAD_INTERVAL") or _DEFAULT_RELOAD_INTERVAL)
+            except ValueError:
+                reload_interval = _DEFAULT_RELOAD_INTERVAL
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._watcher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.reloads = 0
+
+    def snapshot(self) -> ConfigSnapshot:
+        snap = self._snapshot
+        if snap is None:
+            snap = self.reload()
+            self.watch()
+        return snap
+
+    def reload(self, force: bool = False) -> ConfigSnapshot:
+        """文件指纹变化（或 force）时重建快照；返回当前快照。"""
+        with self._lock:
+            current = self._snapshot
+            if current is not None and not force and _fingerprint(_scan(self.config_dir)) == current.fingerprint:
+                return current
+            snap = build_snapshot(self.config_dir, current)
+            self._snapshot = snap
+            self.reloads += 1
+        report = snap.report
+        print(
+            f"[CONFIG] {'加载' if current is None else '重新加载'}配置快照 | files={report['files']} "
+            f"errors={len(report['errors'])} warnings={len(report['warnings'])}",
+            flush=True,
+        )
+        for line in report["errors"]:
+            print(f"[CONFIG] 错误 | {line}", flush=True)
+        for line in report["warnings"]:
+            print(f"[CONFIG] 告警 | {line}", flush=True)
+        return snap
+
+    def watch(self) -> None:
+        """启动后台轮询线程（reload_interval <= 0 时不启动，只能手动 reload）。"""
+        if self.reload_interval <= 0:
+            return
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch_loop, name="config-registry", daemon=True)
+            self._watcher.start()
+
+    def _watch_loop(self) -> None:
+        while not self._stop.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"[CONFIG] 热加载失败 | error={e}", flush=True)
+
+    def close(self) -> None:
+        self._stop.set()
+
+
+_registry_lock = threading.Lock()
+_registry: Optional[ConfigRegistry] = None
+
+
+def get_registry() -> ConfigRegistry:
+    """进程级共享注册表。"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ConfigRegistry()
+        return _registry
+
+
+def set_registry(registry: Optional[ConfigRegistry]) -> None:
+    """替换进程级注册表（单测指向临时 config 目录；传 None 则下次 get_registry 重建）。"""
+    global _registry
+    with _registry_lock:
+        old, _registry = _registry, registry
+    if old is not None and old is not registry:
+        old.close()
+
+
+def get_config() -> ConfigSnapshot:
+    """当前配置快照（热路径入口）。"""
+    return get_registry().snapshot()
+
+
+def validation_report() -> Dict[str, Any]:
+    snap = get_config()
+    return {**snap.report, "loaded_at": snap.loaded_at, "reloads": get_registry().reloads}
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m backend.config_registry", description="配置快照校验")
+    parser.add_argument("command", choices=["report"])
+    parser.parse_args(argv)
+    registry = ConfigRegistry(reload_interval=0)
+    print(json.dumps(registry.snapshot().report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
@@ -0,0 +1,257 @@
+# backend/figure_caption.py
+"""
+图像说明（VLM）：把 extract_figures 得到的图送入 paper_ingest 的 figure_caption 步骤（视觉模型），
+按 paper_figure_caption.txt 生成一句话说明与关联参数。
+- 发送前把长边缩到 FIGURE_CAPTION_MAX_PX 并转 JPEG；超出模型有效分辨率的像素只增加上传量与图像 token
+- 同一记录的图并发送出，上限 FIGURE_CAPTION_MAX_PARALLEL；调用经 invoke_model（限流、熔断、遥测同其他步骤）
+- 结果缓存在 llm_cache，key 为 (图像内容 sha1, 缩放长边, provider/model, 渲染后的 prompt 哈希)；图或 prompt 不变时不再调用
+- schedule_captioning：记录入库后提交到后台线程，完成后改写记录目录的 structured.json，入库耗时不含本阶段
+- PDF 中已配对图注的图保留原图注，VLM 说明写入 vlm_caption；只有占位图注（第 N 页图 M / 整页快照）被替换
+"""
+
+import base64
+import concurrent.futures
+import contextvars
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .config import get_env
+
+_TASK = "paper_ingest"
+_STEP = "figure_caption"
+_DEFAULT_MAX_PX = 1024
+_DEFAULT_MAX_PARALLEL = 4
+_JPEG_QUALITY = 85
+# 送入 prompt 的参数个数上限
+_MAX_PARAMS_IN_PROMPT = 30
+
+_lock = threading.Lock()
+_stats: Dict[str, int] = {"scheduled": 0, "records": 0, "figures": 0, "captioned": 0, "cached": 0, "failed": 0}
+# 后台线程单个 worker：各记录依次处理，总并发即 FIGURE_CAPTION_MAX_PARALLEL
+_background: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def _count(key: str, n: int = 1) -> None:
+    with _lock:
+        _stats[key] += n
+
+
+def captioning_enabled() -> bool:
+    """FIGURE_CAPTION_ENABLED=0/false/no/off 时关闭图像说明阶段。"""
+    return (get_env("FIGURE_CAPTION_ENABLED", "1") or "1").lower() not in ("0", "false", "no", "off")
+
+
+def downscale_image(path: Path, max_px: int) -> bytes:
+    """读取图像，长边超过 max_px 时等比缩小，去掉 alpha 并转 RGB/灰度 JPEG。"""
+    import fitz  # PyMuPDF
+
+    pix = fitz.Pixmap(str(path))
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.colorspace is None or pix.colorspace.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    longest = max(pix.width, pix.height)
+    if longest > max_px:
+        scale = max_px / longest
+        pix = fitz.Pixmap(pix, max(1, round(pix.width * scale)), max(1, round(pix.height * scale)), None)
+    return pix.tobytes("jpeg", jpg_quality=_JPEG_QUALITY)
+
+
+def param_summary(structured: Dict[str, Any]) -> str:
+    """structured["parameters"] 的简要列表（符号/名称 + 含义），供 prompt 的 param_summary_text。"""
+    items = []
+    for p in structured.get("parameters") or []:
+        if not isinstance(p, dict):
+            continue
+        name = p.get("symbol") or p.get("name")
+        if not name:
+            continue
+        meaning = p.get("meaning") or (p.get("name") if p.get("symbol") else "")
+        items.append(f"{name}（{meaning}）" if meaning else str(name))
+        if len(items) >= _MAX_PARAMS_IN_PROMPT:
+            break
+    return "；".join(items) or "无"
+
+
+def _cache_key(image_sha1: str, max_px: int, provider: str, model: str, prompt: str) -> str:
+    from .llm_cache import make_cache_key
+
+    prompt_version = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+    marker = [{"role": "user", "content": f"figure_caption:{image_sha1}:{max_px}px"}]
+    return make_cache_key(provider, model, marker, 0.1, prompt_version=prompt_version)
+
+
+def _parse(raw: str) -> Optional[Dict[str, Any]]:
+    from .json_repair import parse_model_json
+
+    data = parse_model_json(raw, "figure_caption", allow_llm_repair=False).data
+    if not isinstance(data, dict) or not str(data.get("caption") or "").strip():
+        return None
+    linked = data.get("linked_parameters") or []
+    if isinstance(linked, str):
+        linked = [s.strip() for s in linked.replace("，", ",").split(",") if s.strip()]
+    return {"caption": str(data["caption"]).strip(), "linked_parameters": [str(x) for x in linked][:5]}
+
+
+def caption_figure(
+    image_path: Path,
+    agent_id: str,
+    page: Any,
+    params_text: str,
+    max_px: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    单张图的说明：先查缓存，未命中时缩图后调用视觉模型。
+    返回 {"caption", "linked_parameters", "status"}，status 为 captioned / cached / failed（失败时 caption 为空）。
+    """
+    from . import llm_cache
+    from .agent_config import get_model_for_step, get_prompt, invoke_model
+
+    max_px = max_px or _env_int("FIGURE_CAPTION_MAX_PX", _DEFAULT_MAX_PX)
+    failed = {"caption": "", "linked_parameters": [], "status": "failed"}
+    try:
+        data = Path(image_path).read_bytes()
+    except OSError as e:
+        print(f"[FIGURE_CAPTION] 读取图像失败 | path={image_path} error={e}", flush=True)
+        return failed
+    prompt = get_prompt(agent_id, _STEP, _TASK, page_index=page, param_summary_text=params_text)
+    if not prompt:
+        return failed
+    m = get_model_for_step(agent_id, _TASK, _STEP)
+    provider, model = m.get("provider") or "qwen", m.get("model") or "qwen-vl-plus"
+
+    cache = llm_cache.get_cache() if llm_cache.cache_globally_enabled() else None
+    key = _cache_key(hashlib.sha1(data).hexdigest(), max_px, provider, model, prompt)
+    if cache is not None:
+        hit = cache.get(key)
+        parsed = _parse(hit) if hit else None
+        if parsed:
+            return dict(parsed, status="cached")
+
+    try:
+        jpeg = downscale_image(Path(image_path), max_px)
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii")}},
+            ],
+        }]
+        raw = invoke_model(agent_id, _TASK, _STEP, messages, temperature=0.1, use_cache=False)
+    except Exception as e:
+        print(f"[FIGURE_CAPTION] 调用失败 | path={Path(image_path).name} error={e}", flush=True)
+        return failed
+    parsed = _parse(raw or "")
+    if not parsed:
+        return failed
+    if cache is not None:
+        cache.put(key, raw, provider=provider, model=model, agent_id=agent_id, task_name=_TASK, step=_STEP)
+    return dict(parsed, status="captioned")
+
+
+def caption_figures(
+    figures: List[Dict[str, Any]],
+    storage_folder: Path,
+    structured: Dict[str, Any],
+    agent_id: str = "_default",
+    max_parallel: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    并发为 figures（extract_figures 的输出，image_path 相对 storage_folder）生成说明，原地更新：
+    vlm_caption、linked_parameters（与已有合并去重），占位图注的 caption 替换为 VLM 说明。
+    返回 {"figures", "captioned", "cached", "failed"}。
+    """
+    todo = [f for f in figures if f.get("image_path")]
+    out = {"figures": len(todo), "captioned": 0, "cached": 0, "failed": 0}
+    if not todo:
+        return out
+    params_text = param_summary(structured)
+    max_px = _env_int("FIGURE_CAPTION_MAX_PX", _DEFAULT_MAX_PX)
+    limit = max_parallel or _env_int("FIGURE_CAPTION_MAX_PARALLEL", _DEFAULT_MAX_PARALLEL)
+    workers = max(1, min(limit, len(todo)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="figure-caption") as pool:
+        futures = {
+            pool.submit(
+                contextvars.copy_context().run, caption_figure,
+                Path(storage_folder) / f["image_path"], agent_id, f.get("page", ""), params_text, max_px,
+            ): f
+            for f in todo
+        }
+        for fut in concurrent.futures.as_completed(futures):
+            fig = futures[fut]
+            res = fut.result()
+            out[res["status"]] += 1
+            if res["status"] == "failed":
+                continue
+            fig["vlm_caption"] = res["caption"]
+            fig["linked_parameters"] = list(dict.fromkeys(list(fig.get("linked_parameters") or []) + res["linked_parameters"]))
+            if fig.get("caption_source") == "placeholder":
+                fig["caption"] = res["caption"]
+                fig["caption_source"] = "vlm"
+    for k in ("figures", "captioned", "cached", "failed"):
+        _count(k, out[k])
+    print(
+        f"[FIGURE_CAPTION] 图像说明完成 | agent_id={agent_id} figures={out['figures']} "
+        f"captioned={out['captioned']} cached={out['cached']} failed={out['failed']} parallel={workers}",
+        flush=True,
+    )
+    return out
+
+
+def _caption_record(storage_folder: Path, agent_id: str) -> Dict[str, int]:
+    """读记录目录的 structured.json，为其中 figures 生成说明并原子改写。"""
+    path = Path(storage_folder) / "structured.json"
+    structured = json.loads(path.read_text(encoding="utf-8"))
+    figures = structured.get("figures")
+    if not isinstance(figures, list) or not figures:
+        return {"figures": 0, "captioned": 0, "cached": 0, "failed": 0}
+    result = caption_figures(figures, storage_folder, structured, agent_id)
+    if result["captioned"] or result["cached"]:
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(structured, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+    _count("records")
+    return result
+
+
+def _get_background() -> concurrent.futures.ThreadPoolExecutor:
+    global _background
+    with _lock:
+        if _background is None:
+            _background = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="figure-caption-bg")
+        return _background
+
+
+def schedule_captioning(storage_folder: Path, agent_id: str = "_default") -> Optional[concurrent.futures.Future]:
+    """
+    在后台为记录生成图像说明，立即返回 Future（结果同 caption_figures；异常已记录并返回 None）。
+    FIGURE_CAPTION_ENABLED 关闭或记录目录无 structured.json 时不提交，返回 None。
+    """
+    if not captioning_enabled() or not (Path(storage_folder) / "structured.json").is_file():
+        return None
+
+    def run() -> Optional[Dict[str, int]]:
+        try:
+            return _caption_record(Path(storage_folder), agent_id)
+        except Exception as e:
+            print(f"[FIGURE_CAPTION] 后台说明失败 | folder={storage_folder} error={e}", flush=True)
+            return None
+
+    _count("scheduled")
+    return _get_background().submit(contextvars.copy_context().run, run)
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,264 @@
+# backend/figure_extract.py
+"""
+逐图裁剪（paper_ingest.extract_figures 的 image_policy="pymupdf_per_figure"）：扫描全文，按版面定位图、裁剪并配对图注。
+- 图区域：嵌入位图的显示位置（page.get_image_rects）+ 矢量绘图聚类（page.cluster_drawings），相邻或重叠的合并
+- 过滤：宽或高小于 FIGURE_MIN_SIZE_PT、接近整页（背景框/页框）、与 "Table N" 标题配对的区域（表格线）
+- 图注：以 Figure / Fig. / 图 N 开头的文本块，按垂直距离与水平重叠就近配对（优先区域下方）
+- 裁剪：按 FIGURE_CROP_DPI 渲染区域，长边不超过 FIGURE_CROP_MAX_PX；格式与质量沿用 PAGE_RASTER_FORMAT / PAGE_RASTER_QUALITY
+- 结果按 PDF 内容哈希缓存在整页截图的同一缓存目录（figures.json + 裁剪图），多 agent 共享；常驻进程池启用时按页段并行
+"""
+
+import json
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import page_raster_cache
+from .config import get_env
+
+_FIGURE_CAPTION_RE = re.compile(r"^\s*(?:fig\.?|figure|图)\s*(\d+[a-z]?)", re.IGNORECASE)
+_TABLE_CAPTION_RE = re.compile(r"^\s*(?:table|tab\.|表)\s*(\d+)", re.IGNORECASE)
+
+_DEFAULT_DPI = 150
+_DEFAULT_MAX_PX = 1600
+_DEFAULT_MIN_SIZE_PT = 40
+# 区域合并时的外扩距离、裁剪时的留白（pt）
+_MERGE_GAP_PT = 8.0
+_CROP_MARGIN_PT = 4.0
+# 面积超过页面该比例的区域视为背景或页框
+_MAX_PAGE_FRACTION = 0.85
+# 图注与区域的最大垂直距离（页高比例）；图注在区域上方时距离加罚，优先配对下方图注
+_CAPTION_MAX_GAP = 0.15
+_CAPTION_ABOVE_PENALTY = 0.05
+_MANIFEST = "figures.json"
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def _merge_regions(regions: List[Tuple[Any, set]], gap: float) -> List[Tuple[Any, set]]:
+    """外扩 gap 后相交的区域反复合并，直到不再变化；同时合并来源标记（image / drawing）。"""
+    merged = list(regions)
+    changed = True
+    while changed:
+        changed = False
+        out: List[Tuple[Any, set]] = []
+        for rect, sources in merged:
+            for other, other_sources in out:
+                if (other + (-gap, -gap, gap, gap)).intersects(rect):
+                    other.include_rect(rect)
+                    other_sources |= sources
+                    changed = True
+                    break
+            else:
+                out.append((rect, set(sources)))
+        merged = out
+    return merged
+
+
+def _page_regions(page: Any, min_size: float) -> List[Tuple[Any, set]]:
+    """候选图区域：位图显示位置 + 矢量绘图聚类，裁到页面内、去掉接近整页者后合并，再按最小尺寸过滤。"""
+    import fitz  # PyMuPDF
+
+    area = page.rect
+    cands: List[Tuple[Any, set]] = []
+    for img in page.get_images(full=True):
+        try:
+            rects = page.get_image_rects(img[0])
+        except Exception:
+            rects = []
+        cands.extend((fitz.Rect(r), {"image"}) for r in rects)
+    try:
+        clusters = page.cluster_drawings()
+    except Exception:
+        clusters = []
+    cands.extend((fitz.Rect(r), {"drawing"}) for r in clusters)
+
+    page_area = area.width * area.height
+    kept = []
+    for rect, sources in cands:
+        rect = rect & area
+        if rect.is_empty or rect.width * rect.height >= _MAX_PAGE_FRACTION * page_area:
+            continue
+        kept.append((rect, sources))
+    merged = _merge_regions(kept, _MERGE_GAP_PT)
+    return [(r, s) for r, s in merged if r.width >= min_size and r.height >= min_size]
+
+
+def _page_captions(page: Any) -> List[Dict[str, Any]]:
+    """以 Figure/Fig./图 N 或 Table N 开头的文本块。"""
+    import fitz  # PyMuPDF
+
+    captions: List[Dict[str, Any]] = []
+    for b in page.get_text("blocks"):
+        if b[6] != 0:
+            continue
+        text = " ".join(b[4].split())
+        m = _FIGURE_CAPTION_RE.match(text)
+        kind = "figure" if m else None
+        if not m:
+            m = _TABLE_CAPTION_RE.match(text)
+            kind = "table" if m else None
+        if m:
+            captions.append({"kind": kind, "number": m.group(1), "rect": fitz.Rect(b[:4]), "text": text})
+    return captions
+
+
+def _pair_captions(regions: List[Tuple[Any, set]], captions: List[Dict[str, Any]], page_height: float) -> Dict[int, Dict[str, Any]]:
+    """按距离从小到大贪心配对：每个区域、每条图注至多配一次；需要水平方向有重叠。"""
+    max_gap = _CAPTION_MAX_GAP * page_height
+    pairs: List[Tuple[float, int, int]] = []
+    for i, (rect, _) in enumerate(regions):
+        for j, cap in enumerate(captions):
+            c = cap["rect"]
+            if min(rect.x1, c.x1) - max(rect.x0, c.x0) <= 0:
+                continue
+            below = c.y0 - rect.y1
+            above = rect.y0 - c.y1
+            if -_MERGE_GAP_PT <= below <= max_gap:
+                pairs.append((max(below, 0.0), i, j))
+            elif -_MERGE_GAP_PT <= above <= max_gap:
+                pairs.append((max(above, 0.0) + _CAPTION_ABOVE_PENALTY * page_height, i, j))
+    pairs.sort()
+    matched: Dict[int, Dict[str, Any]] = {}
+    used = set()
+    for _, i, j in pairs:
+        if i in matched or j in used:
+            continue
+        matched[i] = captions[j]
+        used.add(j)
+    return matched
+
+
+def _detect_range(file_path: str, start: int, end: int, out_dir: str, opts: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """检测并裁剪 [start, end) 页（从 0 计）的图；本进程与进程池 worker 共用。"""
+    import fitz  # PyMuPDF
+
+    ext = page_raster_cache.extension(opts["fmt"])
+    figures: List[Dict[str, Any]] = []
+    with fitz.open(file_path) as doc:
+        for page_index in range(start, min(end, len(doc))):
+            page = doc[page_index]
+            regions = _page_regions(page, opts["min_size"])
+            if not regions:
+                continue
+            regions.sort(key=lambda rs: (round(rs[0].y0), rs[0].x0))
+            captions = _pair_captions(regions, _page_captions(page), page.rect.height)
+            index = 0
+            for i, (rect, sources) in enumerate(regions):
+                cap = captions.get(i)
+                if cap is not None and cap["kind"] == "table":
+                    continue
+                index += 1
+                clip = (rect + (-_CROP_MARGIN_PT, -_CROP_MARGIN_PT, _CROP_MARGIN_PT, _CROP_MARGIN_PT)) & page.rect
+                dpi = max(36, min(opts["dpi"], int(opts["max_px"] * 72 / max(clip.width, clip.height))))
+                pix = page.get_pixmap(dpi=dpi, clip=clip)
+                data = page_raster_cache.encode_pixmap(pix, opts["fmt"], opts["quality"])
+                filename = f"p{page_index + 1}_fig{index}.{ext}"
+                page_raster_cache.write_atomic(str(Path(out_dir) / filename), data)
+                figures.append({
+                    "page": page_index + 1,
+                    "index": index,
+                    "bbox": [round(v, 1) for v in clip],
+                    "source": "+".join(sorted(sources)),
+                    "label": f"Figure {cap['number']}" if cap else "",
+                    "caption": cap["text"][:500] if cap else "",
+                    "filename": filename,
+                    "width": pix.width,
+                    "height": pix.height,
+                    "bytes": len(data),
+                })
+    return figures
+
+
+def extract_page_figures(
+    file_path: str,
+    dpi: Optional[int] = None,
+    fmt: Optional[str] = None,
+    quality: Optional[int] = None,
+    cache_dir: Optional[Path] = None,
+) -> List[Dict[str, Any]]:
+    """
+    扫描全文检测并裁剪图，返回按页序排列的
+    [{"page", "index", "bbox", "source", "label", "caption", "filename", "path", "width", "height", "bytes"}]。
+    同一 PDF 与参数的结果缓存在 <缓存目录>/<pdf sha1>/figures_<参数>/figures.json，再次调用直接读取；
+    有页段失败（超时/崩溃）时本次结果不写缓存，下次重试。
+    进程池模式下同一文档同时在执行的页段不超过 PDF_EXTRACT_WORKERS（且不超过池大小），完成一个再提交下一个。
+    """
+    import concurrent.futures
+
+    from . import pdf_worker_pool
+    from .pdf_extract import _SEGMENTS_PER_WORKER, _page_count, _page_ranges, _resolve_workers
+
+    fmt = page_raster_cache.resolve_format(fmt)
+    opts = {
+        "dpi": dpi or _env_int("FIGURE_CROP_DPI", _DEFAULT_DPI),
+        "max_px": _env_int("FIGURE_CROP_MAX_PX", _DEFAULT_MAX_PX),
+        "min_size": _env_int("FIGURE_MIN_SIZE_PT", _DEFAULT_MIN_SIZE_PT),
+        "fmt": fmt,
+        "quality": quality or _env_int("PAGE_RASTER_QUALITY", 85),
+    }
+    digest = page_raster_cache.file_sha1(file_path)
+    tag = f"figures_{opts['dpi']}dpi_{opts['max_px']}px_{opts['min_size']}pt_{fmt}" + ("" if fmt == "png" else f"_q{opts['quality']}")
+    out_dir = page_raster_cache.cache_root(cache_dir) / digest / tag
+    manifest = out_dir / _MANIFEST
+
+    def with_paths(figs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [dict(f, path=str(out_dir / f["filename"])) for f in figs]
+
+    with page_raster_cache.doc_lock(digest):
+        if manifest.is_file():
+            try:
+                cached = json.loads(manifest.read_text(encoding="utf-8"))
+                if all((out_dir / f["filename"]).is_file() for f in cached):
+                    page_raster_cache.mark_used(digest, cache_dir)
+                    return with_paths(cached)
+            except (ValueError, KeyError, TypeError):
+                pass
+        out_dir.mkdir(parents=True, exist_ok=True)
+        figures: List[Dict[str, Any]] = []
+        complete = True
+        if pdf_worker_pool.pool_enabled():
+            pool = pdf_worker_pool.get_pool()
+            deadline = pool.new_deadline()
+            total = pool.submit(_page_count, str(file_path), deadline=deadline).result()
+            parallel = min(pool.size, _resolve_workers(None))
+            ranges = _page_ranges(total, parallel * _SEGMENTS_PER_WORKER)
+            todo = iter(enumerate(ranges))
+            in_flight: Dict[concurrent.futures.Future, int] = {}
+            segments: List[List[Dict[str, Any]]] = [[] for _ in ranges]
+
+            def submit_next() -> None:
+                for idx, (a, b) in todo:
+                    in_flight[pool.submit(_detect_range, str(file_path), a, b, str(out_dir), opts, deadline=deadline)] = idx
+                    return
+
+            for _ in range(parallel):
+                submit_next()
+            while in_flight:
+                done, _ = concurrent.futures.wait(list(in_flight), return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    idx = in_flight.pop(fut)
+                    try:
+                        segments[idx] = fut.result()
+                    except pdf_worker_pool.PdfJobError as e:
+                        complete = False
+                        print(f"[FIGURE_EXTRACT] 页段检测失败 | file={Path(file_path).name} error={e}", flush=True)
+                    submit_next()
+            figures = [f for seg in segments for f in seg]
+        else:
+            figures = _detect_range(str(file_path), 0, _page_count(str(file_path)), str(out_dir), opts)
+        if complete:
+            manifest.write_text(json.dumps(figures, ensure_ascii=False), encoding="utf-8")
+    page_raster_cache.mark_used(digest, cache_dir)
+    page_raster_cache.maybe_purge(cache_dir, keep=[digest])
+    print(
+        f"[FIGURE_EXTRACT] 逐图裁剪完成 | file={Path(file_path).name} figures={len(figures)} "
+        f"captioned={sum(1 for f in figures if f['caption'])} bytes={sum(f['bytes'] for f in figures)}",
+        flush=True,
+    )
+    return with_paths(figures)
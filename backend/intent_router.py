@@ -0,0 +1,362 @@
+# backend/intent_router.py
+"""
+本地意图路由：从历史 intent_to_agent_ids 决策（LLM 结果）中学习，置信时跳过 LLM。
+- 特征：哈希词袋（英文单词 + 中文字符二元组，crc32 哈希到固定维度，log(1+tf) 后 L2 归一化）
+- 模型：每个 agent_id 的样本均值向量（质心），余弦相似度打分；top1 分数与 top1-top2 差距均超过阈值才算置信
+- 决策日志：SQLite（database/intent_router.db），启动时重放最近样本重建质心，之后增量更新
+- 模式（.env 的 INTENT_ROUTER_MODE）：
+    off    不预测、不记录
+    shadow 默认；始终调用 LLM，记录本地预测与 LLM 是否一致（不改变行为）
+    on     置信时直接返回本地结果；按 INTENT_ROUTER_SHADOW_RATE 抽样仍调用 LLM 以持续度量一致率
+- 一致率与覆盖率：stats()；离线按时间顺序回放评估：
+    python -m backend.intent_router stats
+    python -m backend.intent_router evaluate [--threshold 0.35 --margin 0.08]
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from .config import INTENT_ROUTER_DB, get_env
+
+if TYPE_CHECKING:  # numpy 在首次向量化时才导入，import 本模块保持轻量
+    import numpy as np
+
+MODES = ("off", "shadow", "on")
+
+_DIM = 1 << 14
+_DEFAULT_THRESHOLD = 0.35
+_DEFAULT_MARGIN = 0.08
+_DEFAULT_MIN_EXAMPLES = 5
+_DEFAULT_SHADOW_RATE = 0.05
+# 启动时重放的最近决策条数
+_REPLAY_LIMIT = 5000
+
+# intent 请求中的固定标签，不参与特征
+_LABEL_RE = re.compile(r"用户输入/摘要片段:|文件名:")
+_WORD_RE = re.compile(r"[a-z][a-z0-9_\-]+|\d+")
+_CJK_RE = re.compile(r"[一-鿿]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """英文/数字按单词切分（小写），中文按连续字符二元组切分（单字片段保留单字）。"""
+    text = _LABEL_RE.sub(" ", (text or "").lower())
+    tokens = _WORD_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def vectorize(text: str) -> Optional[np.ndarray]:
+    """哈希词袋向量（L2 归一化）；无有效 token 时返回 None。"""
+    tokens = tokenize(text)
+    if not tokens:
+        return None
+    import numpy as np
+    vec = np.zeros(_DIM, dtype=np.float32)
+    for tok in tokens:
+        vec[zlib.crc32(tok.encode("utf-8")) % _DIM] += 1.0
+    np.log1p(vec, out=vec)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else None
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+class IntentRouter:
+    """质心分类器 + 决策日志；predict/record 线程安全。"""
+
+    def __init__(
+        self,
+        db_path: Optional[Path] = None,
+        mode: Optional[str] = None,
+        threshold: Optional[float] = None,
+        margin: Optional[float] = None,
+        min_examples: Optional[int] = None,
+        shadow_rate: Optional[float] = None,
+    ):
+        self.db_path = Path(db_path or INTENT_ROUTER_DB)
+        mode = (mode or get_env("INTENT_ROUTER_MODE") or "shadow").lower()
+        self.mode = mode if mode in MODES else "shadow"
+        self.threshold = threshold if threshold is not None else _env_float("INTENT_ROUTER_THRESHOLD", _DEFAULT_THRESHOLD)
+        self.margin = margin if margin is not None else _env_float("INTENT_ROUTER_MARGIN", _DEFAULT_MARGIN)
+        self.min_examples = int(min_examples if min_examples is not None else _env_float("INTENT_ROUTER_MIN_EXAMPLES", _DEFAULT_MIN_EXAMPLES))
+        self.shadow_rate = shadow_rate if shadow_rate is not None else _env_float("INTENT_ROUTER_SHADOW_RATE", _DEFAULT_SHADOW_RATE)
+        self._lock = threading.Lock()
+        self._sums: Dict[str, np.ndarray] = {}
+        self._counts: Dict[str, int] = {}
+        self._labels: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._counters: Dict[str, int] = {"local_answers": 0, "llm_calls": 0, "shadow_checks": 0}
+        if self.mode != "off":
+            self._init_db()
+            self._replay()
+
+    # ---------- 存储 ----------
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.db_path), timeout=10.0)
+
+    def _init_db(self) -> None:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS intent_decisions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    input_text TEXT NOT NULL,
+                    agent_ids TEXT NOT NULL,
+                    local_agent_id TEXT,
+                    local_score REAL,
+                    local_confident INTEGER,
+                    agreed INTEGER
+                )
+            """)
+            conn.commit()
+
+    def _replay(self) -> None:
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT input_text, agent_ids FROM intent_decisions ORDER BY id DESC LIMIT ?", (_REPLAY_LIMIT,)
+                ).fetchall()
+        except sqlite3.Error:
+            return
+        for text, ids_json in reversed(rows):
+            try:
+                ids = json.loads(ids_json)
+            except (TypeError, ValueError):
+                continue
+            if ids:
+                self._learn(text, ids[0])
+
+    # ---------- 模型 ----------
+    def _learn(self, text: str, label: str) -> None:
+        vec = vectorize(text)
+        if vec is None:
+            return
+        with self._lock:
+            if label in self._sums:
+                self._sums[label] += vec
+            else:
+                self._sums[label] = vec.copy()
+            self._counts[label] = self._counts.get(label, 0) + 1
+            self._matrix = None
+
+    def _centroids(self) -> Optional[np.ndarray]:
+        # 调用方持有 _lock；质心矩阵在有新样本时惰性重建
+        if self._matrix is None:
+            labels = [lb for lb, n in self._counts.items() if n >= self.min_examples]
+            if len(labels) < 2:
+                return None
+            import numpy as np
+            mat = np.stack([self._sums[lb] for lb in labels])
+            norms = np.linalg.norm(mat, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self._labels = labels
+            self._matrix = mat / norms
+        return self._matrix
+
+    def predict(self, text: str, allowed: Optional[set] = None) -> Optional[Dict[str, Any]]:
+        """
+        本地预测：返回 {"agent_ids", "score", "margin", "confident"}；
+        已学习的 agent 不足两个（每个至少 min_examples 条）或输入无有效 token 时返回 None。
+        """
+        if self.mode == "off":
+            return None
+        vec = vectorize(text)
+        if vec is None:
+            return None
+        with self._lock:
+            mat = self._centroids()
+            if mat is None:
+                return None
+            scores = mat @ vec
+            labels = list(self._labels)
+        order = scores.argsort()[::-1]
+        ranked = [(labels[i], float(scores[i])) for i in order if allowed is None or labels[i] in allowed]
+        if not ranked:
+            return None
+        top_label, top = ranked[0]
+        second = ranked[1][1] if len(ranked) > 1 else 0.0
+        return {
+            "agent_ids": [top_label],
+            "score": round(top, 4),
+            "margin": round(top - second, 4),
+            "confident": top >= self.threshold and (top - second) >= self.margin,
+        }
+
+    def answer(self, prediction: Optional[Dict[str, Any]]) -> Optional[List[str]]:
+        """on 模式下置信预测直接作为结果（按 shadow_rate 抽样返回 None 以继续调用 LLM 核对）。"""
+        if self.mode != "on" or not prediction or not prediction.get("confident"):
+            return None
+        if self.shadow_rate > 0 and random.random() < self.shadow_rate:
+            return None
+        with self._lock:
+            self._counters["local_answers"] += 1
+        return list(prediction["agent_ids"])
+
+    def record(self, text: str, agent_ids: List[str], prediction: Optional[Dict[str, Any]] = None) -> None:
+        """记录一次 LLM 决策（含本地预测与是否一致），并增量更新质心。"""
+        if self.mode == "off" or not agent_ids or not (text or "").strip():
+            return
+        agreed = None
+        if prediction:
+            agreed = 1 if prediction["agent_ids"][0] == agent_ids[0] else 0
+        with self._lock:
+            self._counters["llm_calls"] += 1
+            if prediction:
+                self._counters["shadow_checks"] += 1
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    """INSERT INTO intent_decisions
+                       (created_at, input_text, agent_ids, local_agent_id, local_score, local_confident, agreed)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (
+                        time.time(),
+                        text[:4000],
+                        json.dumps(agent_ids, ensure_ascii=False),
+                        prediction["agent_ids"][0] if prediction else None,
+                        prediction["score"] if prediction else None,
+                        (1 if prediction.get("confident") else 0) if prediction else None,
+                        agreed,
+                    ),
+                )
+                conn.commit()
+        except sqlite3.Error:
+            pass
+        self._learn(text, agent_ids[0])
+
+    def stats(self) -> Dict[str, Any]:
+        """样本分布、本进程计数、与 LLM 的历史一致率（全部预测 / 仅置信预测）。"""
+        with self._lock:
+            out: Dict[str, Any] = {
+                "mode": self.mode,
+                "threshold": self.threshold,
+                "margin": self.margin,
+                "examples": dict(self._counts),
+                **self._counters,
+            }
+        if self.mode == "off":
+            return out
+        try:
+            with self._connect() as conn:
+                total, agreed, conf, conf_agreed = conn.execute(
+                    """SELECT COUNT(agreed), COALESCE(SUM(agreed), 0),
+                              COALESCE(SUM(local_confident), 0),
+                              COALESCE(SUM(CASE WHEN local_confident = 1 THEN agreed ELSE 0 END), 0)
+                       FROM intent_decisions WHERE agreed IS NOT NULL"""
+                ).fetchone()
+        except sqlite3.Error:
+            return out
+        out["compared"] = total
+        out["agreement"] = round(agreed / total, 4) if total else None
+        out["confident_compared"] = conf
+        out["confident_agreement"] = round(conf_agreed / conf, 4) if conf else None
+        out["coverage"] = round(conf / total, 4) if total else None
+        return out
+
+    def evaluate(self, threshold: Optional[float] = None, margin: Optional[float] = None, limit: int = _REPLAY_LIMIT) -> Dict[str, Any]:
+        """
+        离线评估：按时间顺序回放日志，每条先用此前样本训练出的模型预测、再加入训练（不写库）。
+        返回整体 top1 一致率、置信覆盖率与置信预测的一致率，可用于调阈值。
+        """
+        replay = IntentRouter(
+            db_path=Path(":memory:"), mode="shadow",
+            threshold=self.threshold if threshold is None else threshold,
+            margin=self.margin if margin is None else margin,
+            min_examples=self.min_examples,
+        )
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT input_text, agent_ids FROM intent_decisions ORDER BY id DESC LIMIT ?", (limit,)
+                ).fetchall()
+        except sqlite3.Error:
+            rows = []
+        predicted = agreed = confident = confident_agreed = 0
+        for text, ids_json in reversed(rows):
+            try:
+                label = (json.loads(ids_json) or ["_default"])[0]
+            except (TypeError, ValueError):
+                continue
+            pred = replay.predict(text)
+            if pred:
+                predicted += 1
+                hit = pred["agent_ids"][0] == label
+                agreed += hit
+                if pred["confident"]:
+                    confident += 1
+                    confident_agreed += hit
+            replay._learn(text, label)
+        return {
+            "samples": len(rows),
+            "predicted": predicted,
+            "agreement": round(agreed / predicted, 4) if predicted else None,
+            "coverage": round(confident / len(rows), 4) if rows else None,
+            "confident_agreement": round(confident_agreed / confident, 4) if confident else None,
+            "threshold": replay.threshold,
+            "margin": replay.margin,
+        }
+
+
+_router_lock = threading.Lock()
+_router: Optional[IntentRouter] = None
+
+
+def get_router() -> IntentRouter:
+    """进程级共享路由器。"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = IntentRouter()
+        return _router
+
+
+def set_router(router: Optional[IntentRouter]) -> None:
+    """替换进程级路由器（单测注入临时库；传 None 则下次 get_router 重建）。"""
+    global _router
+    with _router_lock:
+        _router = router
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m backend.intent_router", description="本地意图路由统计与评估")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("stats", help="样本分布与历史一致率")
+    p_eval = sub.add_parser("evaluate", help="按时间顺序回放日志评估一致率与覆盖率")
+    p_eval.add_argument("--threshold", type=float, default=None)
+    p_eval.add_argument("--margin", type=float, default=None)
+    p_eval.add_argument("--limit", type=int, default=_REPLAY_LIMIT)
+    args = parser.parse_args(argv)
+
+    router = IntentRouter(mode="shadow")
+    if args.cmd == "stats":
+        print(json.dumps(router.stats(), ensure_ascii=False, indent=2))
+    else:
+        print(json.dumps(router.evaluate(args.threshold, args.margin, args.limit), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
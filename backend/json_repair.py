@@ -0,0 +1,408 @@
+# backend/json_repair.py
+"""
+模型输出的 JSON 提取、本地修复与 schema 校验（论文结构化、参数推荐、意图识别共用）。
+- 本地修复：容忍 ```json 围栏、前后说明文字、单引号字符串、字符串内未转义换行、尾随逗号、
+  Python 字面量（True/False/None）以及被截断的结尾（补齐引号与括号，必要时回退到最后一个完整元素）
+- schema 校验：JSON Schema 子集（type / required / properties / items / enum / minItems），按任务注册于 SCHEMAS
+- 本地修复或校验失败时，可发起一次低成本的定向修复调用（config/agents/_default.json 的 json_repair.repair）
+- repair_stats() 按 schema 统计直接解析 / 本地修复 / 模型修复 / 失败次数与修复率
+"""
+
+import json
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# 解析结果状态
+OK = "ok"                      # 直接解析（允许围栏与前后说明文字）
+REPAIRED = "repaired"          # 本地修复后解析
+LLM_REPAIRED = "llm_repaired"  # 定向修复调用后解析
+FAILED = "failed"
+
+# 修复调用最多携带的原始输出字符数
+_REPAIR_INPUT_CHARS = 12000
+# 截断修复时最多回退的完整元素个数
+_MAX_CUT_BACK = 8
+
+_STRING_OR_LIST = {"type": ["string", "array", "number", "null"]}
+
+SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "paper_structure": {
+        "type": "object",
+        "required": ["metadata"],
+        "properties": {
+            "metadata": {
+                "type": "object",
+                "properties": {
+                    "title": _STRING_OR_LIST,
+                    "authors": _STRING_OR_LIST,
+                    "journal": _STRING_OR_LIST,
+                    "year": _STRING_OR_LIST,
+                    "abstract": _STRING_OR_LIST,
+                    "innovation": _STRING_OR_LIST,
+                },
+            },
+            "keywords": {"type": ["array", "string"]},
+            "figures": {"type": ["array", "string", "null"]},
+        },
+    },
+    "parameter_recommendation": {
+        "type": "object",
+        "properties": {
+            "parameter_recommendations": {"type": ["object", "array"]},
+            "force_field_recommendation": {"type": ["object", "array", "null"]},
+        },
+    },
+    "figure_caption": {
+        "type": "object",
+        "required": ["caption"],
+        "properties": {
+            "caption": {"type": "string"},
+            "linked_parameters": {"type": ["array", "string", "null"]},
+        },
+    },
+    "intent": {
+        "type": "object",
+        "required": ["agent_ids"],
+        "properties": {"agent_ids": {"type": ["array", "string"]}},
+    },
+    "intent_batch": {
+        "type": "object",
+        "required": ["results"],
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "required": ["index", "agent_ids"],
+                    "properties": {
+                        "index": {"type": ["integer", "string"]},
+                        "agent_ids": {"type": ["array", "string"]},
+                    },
+                },
+            },
+        },
+    },
+}
+
+
+class ParseResult:
+    """parse_model_json 的结果：data 为解析出的对象（失败为 None），status 为 OK / REPAIRED / LLM_REPAIRED / FAILED。"""
+
+    def __init__(self, data: Any, status: str, errors: Optional[List[str]] = None):
+        self.data = data
+        self.status = status
+        self.errors = errors or []
+
+    @property
+    def ok(self) -> bool:
+        return self.status != FAILED
+
+    def __repr__(self) -> str:
+        return f"ParseResult(status={self.status!r}, errors={self.errors!r})"
+
+
+# ---------- 本地提取与修复 ----------
+
+
+def strip_fences(text: str) -> str:
+    """取第一个 ``` 围栏内的内容（未闭合的围栏取到结尾）；无围栏原样返回。"""
+    if "```" not in text:
+        return text
+    m = re.search(r"```[A-Za-z0-9_-]*[ \t]*\r?\n?(.*?)(?:```|$)", text, re.S)
+    inner = m.group(1) if m else text
+    return inner if re.search(r"[{\[]", inner) else text
+
+
+def _json_start(text: str) -> int:
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    return min(starts) if starts else -1
+
+
+def _json_starts(text: str, schema: Optional[Dict[str, Any]] = None) -> List[int]:
+    """
+    候选起点：首个 { 与首个 [。schema 顶层类型只允许 object（或只允许 array）时对应括号优先，
+    避免说明文字里的 [1]、[注] 等被当作 JSON 起点；否则按出现先后。
+    """
+    obj, arr = text.find("{"), text.find("[")
+    types = (schema or {}).get("type")
+    types = [types] if isinstance(types, str) else list(types or [])
+    if types == ["object"]:
+        order = [obj, arr]
+    elif types == ["array"]:
+        order = [arr, obj]
+    else:
+        order = sorted((obj, arr))
+    return [i for i in order if i >= 0]
+
+
+def _loads_from(text: str, start: int) -> Tuple[Any, str]:
+    try:
+        data, _ = json.JSONDecoder().raw_decode(text, start)
+        return data, OK
+    except json.JSONDecodeError:
+        pass
+    for candidate in repair_json_text(text[start:]):
+        try:
+            return json.loads(candidate), REPAIRED
+        except json.JSONDecodeError:
+            continue
+    return None, FAILED
+
+
+_LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+
+
+def _close(out: List[str], stack: List[str]) -> str:
+    """去掉悬空的逗号/冒号/键后按栈补齐括号。"""
+    text = "".join(out).rstrip()
+    while text.endswith(","):
+        text = text[:-1].rstrip()
+    if text.endswith(":"):
+        text += " null"
+    elif stack and stack[-1] == "{" and re.search(r'[{,]\s*"(?:[^"\\]|\\.)*"$', text):
+        # 对象内只有键没有值
+        text += ": null"
+    return text + "".join("}" if ch == "{" else "]" for ch in reversed(stack))
+
+
+def repair_json_text(text: str) -> List[str]:
+    """
+    从首个 { 或 [ 开始逐字符修复，返回候选 JSON 文本（先为完整修复结果，
+    随后为回退到最后若干个完整元素处再补齐的结果，用于截断在数字/字面量中间的情况）。
+    """
+    start = _json_start(text)
+    if start < 0:
+        return []
+    out: List[str] = []
+    stack: List[str] = []
+    cuts: List[Tuple[int, List[str]]] = []  # (out 长度, 栈快照)：每个结构逗号处为安全截断点
+    in_str = False
+    quote = ""
+    esc = False
+    i = start
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if in_str:
+            if esc:
+                out.append(ch)
+                esc = False
+            elif ch == "\\":
+                out.append(ch)
+                esc = True
+            elif ch == quote:
+                out.append('"')
+                in_str = False
+            elif ch == '"':
+                out.append('\\"')
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch == "\r":
+                out.append("\\r")
+            elif ch == "\t":
+                out.append("\\t")
+            else:
+                out.append(ch)
+            i += 1
+            continue
+        if ch in "\"'":
+            in_str, quote = True, ch
+            out.append('"')
+        elif ch in "{[":
+            stack.append(ch)
+            out.append(ch)
+        elif ch in "}]":
+            # 去掉尾随逗号
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+            out.append("}" if ch == "}" else "]")
+            if not stack:
+                break
+        elif ch == ",":
+            cuts.append((len(out), list(stack)))
+            out.append(ch)
+        elif ch.isdigit() or ch == "-":
+            j = i + 1
+            while j < n and (text[j].isdigit() or text[j] in ".eE+-"):
+                j += 1
+            out.append(text[i:j])
+            i = j
+            continue
+        elif ch.isalpha() or ch == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            prev = next((c for c in reversed(out) if not c.isspace()), "")
+            # 对象键位置的裸词补引号；值位置的未知词（如被截断的 tru）保持原样，由回退截断处理
+            out.append(_LITERALS.get(word, f'"{word}"' if stack and stack[-1] == "{" and prev in "{," else word))
+            i = j
+            continue
+        else:
+            out.append(ch)
+        i += 1
+
+    if in_str:
+        if esc:
+            out.pop()
+        out.append('"')
+    candidates = [_close(out, stack) if stack else "".join(out)]
+    for length, snapshot in reversed(cuts[-_MAX_CUT_BACK:]):
+        candidates.append(_close(out[:length], snapshot))
+    return candidates
+
+
+def loads_lenient(raw: str, schema: Optional[Dict[str, Any]] = None) -> Tuple[Any, str]:
+    """
+    本地解析：先按原文（去围栏、忽略前后说明）直接解析，再尝试本地修复。
+    首个 { 与首个 [ 两个起点都会尝试：给出 schema 时返回第一个通过校验的结果，
+    都不通过时返回第一个解析成功的结果（由调用方报告校验错误）。
+    返回 (data, status)，失败为 (None, FAILED)。
+    """
+    text = strip_fences((raw or "").strip())
+    first: Tuple[Any, str] = (None, FAILED)
+    for start in _json_starts(text, schema):
+        data, status = _loads_from(text, start)
+        if status == FAILED:
+            continue
+        if schema is None or not validate(data, schema):
+            return data, status
+        if first[1] == FAILED:
+            first = (data, status)
+    return first
+
+
+# ---------- schema 校验 ----------
+
+
+_TYPE_CHECKS = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+}
+
+
+def validate(data: Any, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """按 JSON Schema 子集校验，返回错误列表（空列表表示通过）。"""
+    errors: List[str] = []
+    types = schema.get("type")
+    if types:
+        types = [types] if isinstance(types, str) else list(types)
+        if not any(_TYPE_CHECKS[t](data) for t in types if t in _TYPE_CHECKS):
+            return [f"{path}: 期望类型 {'/'.join(types)}，实际为 {type(data).__name__}"]
+    if "enum" in schema and data not in schema["enum"]:
+        errors.append(f"{path}: 取值不在 {schema['enum']} 中")
+    if isinstance(data, dict):
+        for key in schema.get("required") or []:
+            if key not in data:
+                errors.append(f"{path}: 缺少字段 {key}")
+        for key, sub in (schema.get("properties") or {}).items():
+            if key in data:
+                errors.extend(validate(data[key], sub, f"{path}.{key}"))
+    if isinstance(data, list):
+        if len(data) < int(schema.get("minItems") or 0):
+            errors.append(f"{path}: 至少需要 {schema['minItems']} 项")
+        item_schema = schema.get("items")
+        if item_schema:
+            for idx, item in enumerate(data):
+                errors.extend(validate(item, item_schema, f"{path}[{idx}]"))
+    return errors
+
+
+# ---------- 统计 ----------
+
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _count(schema_name: str, status: str) -> None:
+    with _stats_lock:
+        s = _stats.setdefault(schema_name or "-", {"total": 0, OK: 0, REPAIRED: 0, LLM_REPAIRED: 0, FAILED: 0})
+        s["total"] += 1
+        s[status] += 1
+
+
+def repair_stats() -> List[Dict[str, Any]]:
+    """按 schema 统计：总数、直接解析、本地修复、模型修复、失败次数，以及需要修复的比例与修复成功率。"""
+    with _stats_lock:
+        out = []
+        for name, s in sorted(_stats.items()):
+            needed = s[REPAIRED] + s[LLM_REPAIRED] + s[FAILED]
+            out.append({
+                "schema": name,
+                **s,
+                "repair_rate": round(needed / s["total"], 4) if s["total"] else 0.0,
+                "repair_success_rate": round((s[REPAIRED] + s[LLM_REPAIRED]) / needed, 4) if needed else None,
+            })
+        return out
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+# ---------- 对外入口 ----------
+
+
+def _llm_repair(raw: str, schema_name: str, schema: Optional[Dict[str, Any]], errors: List[str]) -> str:
+    """定向修复调用：仅把原始输出、schema 与错误交给便宜模型，要求只输出修复后的 JSON。"""
+    from .agent_config import invoke_model
+
+    system = (
+        "你是 JSON 修复器。用户会给出一段格式有误或不完整的 JSON 以及校验错误，"
+        "请在不改变已有内容含义的前提下修复为合法 JSON；无法确定的字段留空或省略。只输出 JSON，不要解释。"
+    )
+    parts = []
+    if schema:
+        parts.append(f"目标 schema（{schema_name}）：\n{json.dumps(schema, ensure_ascii=False)}")
+    if errors:
+        parts.append("错误：\n" + "\n".join(errors[:10]))
+    parts.append(f"待修复内容：\n{raw[:_REPAIR_INPUT_CHARS]}")
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": "\n\n".join(parts)},
+    ]
+    return invoke_model("_default", "json_repair", "repair", messages, temperature=0) or ""
+
+
+def parse_model_json(
+    raw: str,
+    schema_name: str = "",
+    *,
+    allow_llm_repair: bool = True,
+) -> ParseResult:
+    """
+    解析模型输出中的 JSON 并按 SCHEMAS[schema_name] 校验。
+    本地解析/修复成功且校验通过即返回；否则（allow_llm_repair 时）发起一次定向修复调用。
+    """
+    schema = SCHEMAS.get(schema_name)
+    data, status = loads_lenient(raw, schema)
+    errors = ["无法解析为 JSON"] if status == FAILED else (validate(data, schema) if schema else [])
+    if status != FAILED and not errors:
+        _count(schema_name, status)
+        return ParseResult(data, status)
+
+    if allow_llm_repair and (raw or "").strip():
+        print(f"[JSON_REPAIR] 本地修复失败，发起修复调用 | schema={schema_name} errors={errors[:3]}", flush=True)
+        fixed, fixed_status = loads_lenient(_llm_repair(raw, schema_name, schema, errors), schema)
+        if fixed_status != FAILED:
+            fixed_errors = validate(fixed, schema) if schema else []
+            if not fixed_errors:
+                _count(schema_name, LLM_REPAIRED)
+                return ParseResult(fixed, LLM_REPAIRED)
+            errors = fixed_errors
+
+    _count(schema_name, FAILED)
+    # 本地已解析出对象（仅校验未通过）时仍返回，供调用方按需使用部分字段
+    return ParseResult(data if status != FAILED else None, FAILED, errors)
@@ -0,0 +1,166 @@
+# backend/llm_breaker.py
+"""
+LLM 端点熔断器：按 provider/model 维护滚动窗口内的错误率与延迟。
+- closed：正常放行；窗口内调用数 ≥ min_calls 且 失败率或慢调用率 ≥ 阈值 → open
+- open：cooldown 秒内直接跳过该端点；到期后 half_open 放行一次探测，成功则 closed，失败则重新 open
+- 提供 p95 延迟供 invoke_model 的 hedged 模式决定何时启动下一个回退
+参数可在 .env 调整：LLM_BREAKER_WINDOW、LLM_BREAKER_MIN_CALLS、LLM_BREAKER_ERROR_RATE、
+LLM_BREAKER_SLOW_CALL、LLM_BREAKER_COOLDOWN
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .config import get_env
+from .llm_clients import canonical_provider
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+class CircuitBreaker:
+    """单个 provider/model 的熔断器（线程安全）。"""
+
+    def __init__(
+        self,
+        name: str,
+        window: Optional[float] = None,
+        min_calls: Optional[int] = None,
+        error_rate: Optional[float] = None,
+        slow_call: Optional[float] = None,
+        cooldown: Optional[float] = None,
+    ):
+        self.name = name
+        self.window = window if window is not None else _env_float("LLM_BREAKER_WINDOW", 300.0)
+        self.min_calls = int(min_calls if min_calls is not None else _env_float("LLM_BREAKER_MIN_CALLS", 4))
+        self.error_rate = error_rate if error_rate is not None else _env_float("LLM_BREAKER_ERROR_RATE", 0.5)
+        self.slow_call = slow_call if slow_call is not None else _env_float("LLM_BREAKER_SLOW_CALL", 120.0)
+        self.cooldown = cooldown if cooldown is not None else _env_float("LLM_BREAKER_COOLDOWN", 60.0)
+        self._lock = threading.Lock()
+        # (timestamp, ok, latency)
+        self._samples: Deque[Tuple[float, bool, float]] = deque(maxlen=500)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._skipped = 0
+        self._opened_count = 0
+
+    def _trim(self, now: float) -> None:
+        while self._samples and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    def allow(self) -> bool:
+        """是否放行本次调用；open 且未到 cooldown 时返回 False。"""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == OPEN:
+                if now - self._opened_at < self.cooldown:
+                    self._skipped += 1
+                    return False
+                self._state = HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == HALF_OPEN:
+                if self._probe_in_flight:
+                    self._skipped += 1
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record(self, ok: bool, latency: float) -> None:
+        """记录一次调用结果；latency 超过 slow_call 视为慢调用。"""
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, ok, latency))
+            self._trim(now)
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                if ok and latency < self.slow_call:
+                    self._state = CLOSED
+                    self._samples.clear()
+                    self._samples.append((now, ok, latency))
+                else:
+                    self._open(now)
+                return
+            if self._state == CLOSED and len(self._samples) >= self.min_calls:
+                n = len(self._samples)
+                failures = sum(1 for _, s_ok, _ in self._samples if not s_ok)
+                slow = sum(1 for _, s_ok, lat in self._samples if s_ok and lat >= self.slow_call)
+                if failures / n >= self.error_rate or slow / n >= self.error_rate:
+                    self._open(now)
+
+    def _open(self, now: float) -> None:
+        self._state = OPEN
+        self._opened_at = now
+        self._opened_count += 1
+
+    def p95(self) -> Optional[float]:
+        """窗口内成功调用的 p95 延迟；样本不足 min_calls 时返回 None。"""
+        with self._lock:
+            self._trim(time.monotonic())
+            lat = sorted(s[2] for s in self._samples if s[1])
+        if len(lat) < max(1, self.min_calls):
+            return None
+        idx = min(len(lat) - 1, int(round(0.95 * (len(lat) - 1))))
+        return lat[idx]
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            samples = list(self._samples)
+            state = self._state
+            if state == OPEN and now - self._opened_at >= self.cooldown:
+                state = HALF_OPEN
+            out = {
+                "name": self.name,
+                "state": state,
+                "calls": len(samples),
+                "failures": sum(1 for s in samples if not s[1]),
+                "skipped": self._skipped,
+                "opened_count": self._opened_count,
+                "open_remaining": round(max(0.0, self.cooldown - (now - self._opened_at)), 1) if self._state == OPEN else 0.0,
+            }
+        ok_lat = sorted(s[2] for s in samples if s[1])
+        out["error_rate"] = round(out["failures"] / len(samples), 3) if samples else 0.0
+        out["p50_latency"] = round(ok_lat[len(ok_lat) // 2], 3) if ok_lat else None
+        p95 = self.p95()
+        out["p95_latency"] = round(p95, 3) if p95 is not None else None
+        return out
+
+
+_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(provider: str, model: str) -> CircuitBreaker:
+    """进程级共享：同一 provider/model 返回同一熔断器；provider 按规范名合并别名（dashscope 与 qwen 共用）。"""
+    name = f"{canonical_provider(provider)}/{model}"
+    with _lock:
+        br = _breakers.get(name)
+        if br is None:
+            br = CircuitBreaker(name)
+            _breakers[name] = br
+        return br
+
+
+def breaker_states() -> List[Dict[str, Any]]:
+    """所有已使用端点的熔断器状态（供 AppBackend / 调试面板）。"""
+    with _lock:
+        breakers = list(_breakers.values())
+    return [b.snapshot() for b in sorted(breakers, key=lambda b: b.name)]
+
+
+def reset_breakers() -> None:
+    """清空所有熔断器（单测或运维手动恢复时使用）。"""
+    with _lock:
+        _breakers.clear()
@@ -0,0 +1,300 @@
+# backend/llm_cache.py
+"""
+LLM 响应持久化缓存（SQLite，位于 database/llm_cache.db）。
+- key = hash(provider, model, messages, temperature)，内容寻址：messages 已含所用 prompt 全文，prompt 改动自然换 key
+- TTL 过期 + 按条数/字节数的 LRU 淘汰；invoke_model(use_cache=False) 可绕过
+- 命中率计数 stats()；命令行查看与清理：
+    python -m backend.llm_cache stats
+    python -m backend.llm_cache list --limit 20
+    python -m backend.llm_cache purge [--expired | --all | --step extraction_s2]
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .config import LLM_CACHE_DB, get_env
+
+# 默认启用缓存的步骤（temperature 低、输入相同则输出可复用）；agents 配置中 step.cache 可覆盖
+DEFAULT_CACHED_STEPS = {"extraction_s2", "formula_verification"}
+
+_DEFAULT_TTL = 7 * 24 * 3600
+_DEFAULT_MAX_ENTRIES = 5000
+_DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+
+def make_cache_key(
+    provider: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    prompt_version: Optional[str] = None,
+) -> str:
+    """
+    内容寻址 key：sha256(provider, model, messages, temperature, prompt_version)。
+    prompt_version 仅供 messages 不含 prompt 全文的调用方传入其 prompt 内容哈希（如 figure_caption）。
+    """
+    payload = {
+        "provider": provider,
+        "model": model,
+        "messages": messages,
+        "temperature": round(float(temperature), 4),
+        "prompt_version": prompt_version or "",
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _env_number(key: str, default: float) -> float:
+    try:
+        return float(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+class LLMResponseCache:
+    """SQLite 响应缓存：get/put 线程安全，带 TTL 与 LRU 淘汰。"""
+
+    def __init__(
+        self,
+        db_path: Optional[Path] = None,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.db_path = Path(db_path or LLM_CACHE_DB)
+        self.ttl = float(ttl if ttl is not None else _env_number("LLM_CACHE_TTL", _DEFAULT_TTL))
+        self.max_entries = int(max_entries if max_entries is not None else _env_number("LLM_CACHE_MAX_ENTRIES", _DEFAULT_MAX_ENTRIES))
+        self.max_bytes = int(max_bytes if max_bytes is not None else _env_number("LLM_CACHE_MAX_BYTES", _DEFAULT_MAX_BYTES))
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "expired": 0, "bypass": 0}
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.db_path), timeout=10.0)
+
+    def _init_db(self) -> None:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    provider TEXT,
+                    model TEXT,
+                    agent_id TEXT,
+                    task_name TEXT,
+                    step TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hit_count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)")
+            conn.commit()
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+    def record_bypass(self) -> None:
+        self._count("bypass")
+
+    def get(self, key: str) -> Optional[str]:
+        """命中且未过期时返回响应并刷新 last_access；否则返回 None。"""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT response, created_at FROM llm_cache WHERE cache_key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    self._count("misses")
+                    return None
+                response, created_at = row
+                if self.ttl > 0 and now - created_at > self.ttl:
+                    conn.execute("DELETE FROM llm_cache WHERE cache_key = ?", (key,))
+                    conn.commit()
+                    self._count("expired")
+                    self._count("misses")
+                    return None
+                conn.execute(
+                    "UPDATE llm_cache SET last_access = ?, hit_count = hit_count + 1 WHERE cache_key = ?",
+                    (now, key),
+                )
+                conn.commit()
+        except sqlite3.Error:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return response
+
+    def put(self, key: str, response: str, **meta: Any) -> None:
+        """写入响应（空响应不缓存），随后按 max_entries / max_bytes 做 LRU 淘汰。"""
+        if not response:
+            return
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        try:
+            with self._connect() as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO llm_cache (
+                        cache_key, response, provider, model, agent_id, task_name, step,
+                        size, created_at, last_access, hit_count
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+                """, (
+                    key, response, meta.get("provider", ""), meta.get("model", ""),
+                    meta.get("agent_id", ""), meta.get("task_name", ""), meta.get("step", ""),
+                    size, now, now,
+                ))
+                evicted = self._evict(conn)
+                conn.commit()
+        except sqlite3.Error:
+            return
+        self._count("writes")
+        if evicted:
+            self._count("evictions", evicted)
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        evicted = 0
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        if self.max_entries > 0 and count > self.max_entries:
+            n = count - self.max_entries
+            conn.execute(
+                "DELETE FROM llm_cache WHERE cache_key IN (SELECT cache_key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                (n,),
+            )
+            evicted += n
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        if self.max_bytes > 0 and total > self.max_bytes:
+            rows = conn.execute("SELECT cache_key, size FROM llm_cache ORDER BY last_access ASC").fetchall()
+            drop = []
+            for k, sz in rows:
+                if total <= self.max_bytes:
+                    break
+                drop.append((k,))
+                total -= sz
+            conn.executemany("DELETE FROM llm_cache WHERE cache_key = ?", drop)
+            evicted += len(drop)
+        return evicted
+
+    def purge(self, expired_only: bool = False, step: Optional[str] = None) -> int:
+        """清理缓存：expired_only=True 仅删过期项；step 给定时仅删该步骤；否则全部删除。返回删除条数。"""
+        if expired_only and self.ttl <= 0:
+            # 未设 TTL 时没有过期项
+            return 0
+        sql = "DELETE FROM llm_cache"
+        clauses: List[str] = []
+        params: List[Any] = []
+        if expired_only:
+            clauses.append("created_at < ?")
+            params.append(time.time() - self.ttl)
+        if step:
+            clauses.append("step = ?")
+            params.append(step)
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        with self._connect() as conn:
+            cur = conn.execute(sql, params)
+            conn.commit()
+            return cur.rowcount or 0
+
+    def list_entries(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """最近访问的缓存条目（不含响应全文），供 CLI / 调试。"""
+        cols = ["cache_key", "provider", "model", "agent_id", "task_name", "step", "size", "created_at", "last_access", "hit_count"]
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(cols)} FROM llm_cache ORDER BY last_access DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(zip(cols, r)) for r in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        """进程内命中计数 + 磁盘条目数/字节数/按步骤分布。"""
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters["hits"] + counters["misses"]
+        out: Dict[str, Any] = {
+            **counters,
+            "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+            "db_path": str(self.db_path),
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+        try:
+            with self._connect() as conn:
+                count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+                by_step = conn.execute(
+                    "SELECT step, COUNT(*), COALESCE(SUM(hit_count), 0) FROM llm_cache GROUP BY step"
+                ).fetchall()
+            out.update({
+                "entries": count,
+                "bytes": total,
+                "by_step": {s or "": {"entries": c, "hits": h} for s, c, h in by_step},
+            })
+        except sqlite3.Error as e:
+            out["error"] = str(e)
+        return out
+
+
+_cache_lock = threading.Lock()
+_cache: Optional[LLMResponseCache] = None
+
+
+def get_cache() -> LLMResponseCache:
+    """进程级共享缓存实例（首次使用时创建）。"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMResponseCache()
+        return _cache
+
+
+def set_cache(cache: Optional[LLMResponseCache]) -> None:
+    """替换进程级缓存实例（单测使用临时库时调用；传 None 则下次 get_cache 重建）。"""
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+def cache_globally_enabled() -> bool:
+    """LLM_CACHE_ENABLED=0/false/no 时全局关闭缓存。"""
+    return (get_env("LLM_CACHE_ENABLED", "1") or "1").lower() not in ("0", "false", "no", "off")
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m backend.llm_cache", description="查看与清理 LLM 响应缓存")
+    parser.add_argument("--db", default=None, help="缓存库路径（默认 database/llm_cache.db）")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("stats", help="条目数、字节数、按步骤分布")
+    p_list = sub.add_parser("list", help="最近访问的条目")
+    p_list.add_argument("--limit", type=int, default=20)
+    p_purge = sub.add_parser("purge", help="清理缓存")
+    group = p_purge.add_mutually_exclusive_group(required=True)
+    group.add_argument("--expired", action="store_true", help="仅删除过期条目")
+    group.add_argument("--all", action="store_true", help="删除全部条目")
+    group.add_argument("--step", default=None, help="仅删除某一步骤（如 extraction_s2）")
+    args = parser.parse_args(argv)
+
+    cache = LLMResponseCache(db_path=Path(args.db) if args.db else None)
+    if args.cmd == "stats":
+        out: Any = cache.stats()
+    elif args.cmd == "list":
+        out = cache.list_entries(limit=args.limit)
+    else:
+        out = {"deleted": cache.purge(expired_only=args.expired, step=args.step)}
+    print(json.dumps(out, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
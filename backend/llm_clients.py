@@ -0,0 +1,198 @@
+# backend/llm_clients.py
+"""
+LLM 客户端池：进程级复用 OpenAI 兼容 client 及其底层 httpx 连接池。
+- 按 (provider, base_url, api_key, timeout) 缓存 client，避免每次调用都新建连接、重新 TLS 握手
+- 连接池参数可在 .env 中调整：LLM_POOL_MAX_CONNECTIONS、LLM_POOL_MAX_KEEPALIVE、LLM_POOL_KEEPALIVE_EXPIRY
+- 线程安全（Gradio 多 worker 共用），提供 hit/miss 统计供调试
+- 异步 client（AsyncOpenAI）按事件循环隔离缓存，供 agent_config.ainvoke_model 使用
+"""
+
+import asyncio
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple
+
+from .config import get_env
+
+# (provider, base_url, api_key, timeout) -> OpenAI client
+_ClientKey = Tuple[str, str, str, Optional[float]]
+
+# 指向同一上游端点的 provider 别名（并发信号量、限流、回退链去重共用）
+PROVIDER_ALIASES = {"dashscope": "qwen"}
+
+
+def canonical_provider(provider: str) -> str:
+    """provider 规范名：小写并合并别名（dashscope → qwen）；空值按 qwen。"""
+    p = (provider or "qwen").lower()
+    return PROVIDER_ALIASES.get(p, p)
+
+
+_lock = threading.Lock()
+_clients: Dict[_ClientKey, Any] = {}
+_stats: Dict[str, int] = {"hits": 0, "misses": 0, "errors": 0}
+# id(event loop) -> (循环弱引用, {key: AsyncOpenAI})；httpx.AsyncClient 绑定创建时的事件循环，不能跨循环复用。
+# client 会强引用所属循环，WeakKeyDictionary 的条目永远不会回收，因此按 id 记录并在访问时清理已关闭的循环
+_async_clients: Dict[int, Tuple[Any, Dict[_ClientKey, Any]]] = {}
+
+
+def loop_scoped(registry: Dict[int, Tuple[Any, Dict[Any, Any]]], loop: asyncio.AbstractEventLoop) -> Dict[Any, Any]:
+    """
+    registry 中 loop 对应的字典（不存在则新建），同时删除已关闭或已回收的循环条目。
+    调用方须持有保护 registry 的锁；agent_config 的 provider 信号量共用此清理方式。
+    """
+    for lid, (ref, _) in list(registry.items()):
+        other = ref()
+        if other is None or other.is_closed():
+            del registry[lid]
+    entry = registry.get(id(loop))
+    if entry is None or entry[0]() is not loop:
+        entry = (weakref.ref(loop), {})
+        registry[id(loop)] = entry
+    return entry[1]
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def get_pool_limits() -> Dict[str, Any]:
+    """当前连接池参数（.env 可覆盖）。"""
+    return {
+        "max_connections": _env_int("LLM_POOL_MAX_CONNECTIONS", 32),
+        "max_keepalive_connections": _env_int("LLM_POOL_MAX_KEEPALIVE", 16),
+        "keepalive_expiry": _env_float("LLM_POOL_KEEPALIVE_EXPIRY", 60.0),
+    }
+
+
+def _build_http_client(timeout: Optional[float], is_async: bool = False):
+    import httpx
+
+    limits = get_pool_limits()
+    cls = httpx.AsyncClient if is_async else httpx.Client
+    return cls(
+        limits=httpx.Limits(
+            max_connections=limits["max_connections"],
+            max_keepalive_connections=limits["max_keepalive_connections"],
+            keepalive_expiry=limits["keepalive_expiry"],
+        ),
+        timeout=timeout,
+        follow_redirects=True,
+    )
+
+
+def get_openai_client(
+    provider: str,
+    base_url: str,
+    api_key: str,
+    timeout: Optional[float] = None,
+):
+    """
+    返回共享的 OpenAI 兼容 client；同一 (provider, base_url, api_key, timeout) 复用同一连接池。
+    api_key 为空或 openai 未安装时返回 None（与原 get_client_for_step 等行为一致）。
+    """
+    if not api_key:
+        return None
+    key: _ClientKey = ((provider or "").lower(), base_url or "", api_key, timeout)
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _stats["hits"] += 1
+            return client
+        try:
+            from openai import OpenAI
+
+            kwargs: Dict[str, Any] = {
+                "api_key": api_key,
+                "base_url": base_url,
+                "http_client": _build_http_client(timeout),
+            }
+            if timeout is not None:
+                kwargs["timeout"] = timeout
+            client = OpenAI(**kwargs)
+        except Exception:
+            _stats["errors"] += 1
+            return None
+        _clients[key] = client
+        _stats["misses"] += 1
+        return client
+
+
+def get_async_openai_client(
+    provider: str,
+    base_url: str,
+    api_key: str,
+    timeout: Optional[float] = None,
+):
+    """
+    返回当前事件循环内共享的 AsyncOpenAI client；须在协程中调用。
+    api_key 为空、openai 未安装或不在事件循环内时返回 None。
+    """
+    if not api_key:
+        return None
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    key: _ClientKey = ((provider or "").lower(), base_url or "", api_key, timeout)
+    with _lock:
+        per_loop = loop_scoped(_async_clients, loop)
+        client = per_loop.get(key)
+        if client is not None:
+            _stats["hits"] += 1
+            return client
+        try:
+            from openai import AsyncOpenAI
+
+            kwargs: Dict[str, Any] = {
+                "api_key": api_key,
+                "base_url": base_url,
+                "http_client": _build_http_client(timeout, is_async=True),
+            }
+            if timeout is not None:
+                kwargs["timeout"] = timeout
+            client = AsyncOpenAI(**kwargs)
+        except Exception:
+            _stats["errors"] += 1
+            return None
+        per_loop[key] = client
+        _stats["misses"] += 1
+        return client
+
+
+def pool_stats() -> Dict[str, Any]:
+    """client 池统计：hits / misses / errors、当前 client 数与连接池参数。"""
+    with _lock:
+        total = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "clients": len(_clients),
+            "async_clients": sum(len(v) for _, v in _async_clients.values()),
+            "hit_rate": round(_stats["hits"] / total, 4) if total else 0.0,
+            "limits": get_pool_limits(),
+            "providers": sorted({k[0] for k in _clients}),
+        }
+
+
+def close_all_clients() -> None:
+    """关闭并清空所有缓存 client（进程退出或单测重置时使用）；异步 client 仅丢弃引用（所属循环关闭后下次访问时也会清理）。"""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _async_clients.clear()
+        for k in _stats:
+            _stats[k] = 0
+    for c in clients:
+        try:
+            c.close()
+        except Exception:
+            pass
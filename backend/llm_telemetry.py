@@ -0,0 +1,385 @@
+# backend/llm_telemetry.py
+"""
+LLM 调用遥测（SQLite，位于 database/llm_telemetry.db）。
+- 每次 invoke_model / ainvoke_model / 流式调用、意图识别、normalize_query、file-extract 写一行：
+  agent_id、task、step、最终 provider/model、prompt 字符数与 token、completion token、总延迟、
+  尝试路径（回退/hedge 经过的端点及各自结果）与 outcome（ok / error / empty / cache_hit / local / coalesced）
+- 用法：调用方以 track(...) 包住一次逻辑调用；底层 _do_llm_call 等在每次实际请求后 note_attempt(...)，
+  通过 contextvars 归属到当前 track（线程池任务需以 contextvars.copy_context().run 提交）
+- token 优先取响应 usage，缺失时按字符估算（tokens_estimated=1）
+- 后台线程批量写库，不阻塞调用方；report() 按 (agent, task, step) 汇总 p50/p95 延迟、token 与费用
+- 费用单价在 config/agents/_default.json 的 "pricing" 中按 "provider/model" 或 model 配置（每千 token）
+- 命令行：
+    python -m backend.llm_telemetry report [--hours 24]
+    python -m backend.llm_telemetry recent --limit 20
+"""
+
+import contextvars
+import json
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from .config import LLM_TELEMETRY_DB, get_env
+from .config_registry import get_config
+from .rate_limit import content_text, estimate_tokens
+
+_COLUMNS = (
+    "created_at", "kind", "agent_id", "task_name", "step", "provider", "model",
+    "prompt_chars", "prompt_tokens", "completion_tokens", "tokens_estimated",
+    "latency", "attempts", "path", "outcome", "error",
+)
+
+
+class CallRecord:
+    """一次逻辑调用（可能包含多次端点尝试）的遥测数据。"""
+
+    def __init__(self, kind: str, agent_id: str, task_name: str, step: str, messages: Optional[List[Dict[str, str]]]):
+        self.kind = kind
+        self.agent_id = agent_id
+        self.task_name = task_name
+        self.step = step
+        self.prompt_chars = sum(len(content_text(m.get("content"))[0]) for m in (messages or []))
+        self._messages = messages or []
+        self.attempts: List[Dict[str, Any]] = []
+        # 配置的 provider/model：没有任何实际请求（缓存命中、本地路由）时写入该端点
+        self.provider = ""
+        self.model = ""
+        self.outcome = ""
+        self.error = ""
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def note(
+        self,
+        provider: str,
+        model: str,
+        ok: bool,
+        latency: float,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        output: str = "",
+        error: str = "",
+    ) -> None:
+        estimated = prompt_tokens is None or completion_tokens is None
+        if prompt_tokens is None:
+            prompt_tokens = estimate_tokens(self._messages) if self._messages else 0
+        if completion_tokens is None:
+            completion_tokens = estimate_tokens(output) if output else 0
+        with self._lock:
+            self.attempts.append({
+                "endpoint": f"{(provider or 'qwen').lower()}/{model}",
+                "ok": bool(ok),
+                "latency": round(latency, 3),
+                "prompt_tokens": int(prompt_tokens),
+                "completion_tokens": int(completion_tokens),
+                "estimated": estimated,
+                "error": error[:200],
+            })
+
+    def set_outcome(self, outcome: str) -> None:
+        self.outcome = outcome
+
+    def to_row(self) -> tuple:
+        with self._lock:
+            attempts = list(self.attempts)
+        final = next((a for a in reversed(attempts) if a["ok"]), attempts[-1] if attempts else None)
+        outcome = self.outcome or ("ok" if final and final["ok"] else ("error" if attempts else "empty"))
+        provider, _, model = final["endpoint"].partition("/") if final else (self.provider, "", self.model)
+        error = self.error or next((a["error"] for a in reversed(attempts) if a["error"]), "")
+        return (
+            time.time(), self.kind, self.agent_id, self.task_name, self.step, provider, model,
+            self.prompt_chars,
+            sum(a["prompt_tokens"] for a in attempts),
+            sum(a["completion_tokens"] for a in attempts),
+            1 if any(a["estimated"] for a in attempts) else 0,
+            round(self.latency, 4),
+            len(attempts),
+            json.dumps(
+                [{k: a[k] for k in ("endpoint", "ok", "latency", "prompt_tokens", "completion_tokens")} for a in attempts],
+                ensure_ascii=False,
+            ),
+            outcome,
+            error[:500],
+        )
+
+
+_current: contextvars.ContextVar[Optional[CallRecord]] = contextvars.ContextVar("llm_telemetry_call", default=None)
+
+
+def current() -> Optional[CallRecord]:
+    return _current.get()
+
+
+def note_attempt(provider: str, model: str, ok: bool, latency: float, response: Any = None, output: str = "", error: str = "") -> None:
+    """记录一次端点请求到当前 track；response 为 chat.completions 返回值时从 usage 读取 token。"""
+    rec = _current.get()
+    if rec is None:
+        return
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None) if usage is not None else None
+    completion_tokens = getattr(usage, "completion_tokens", None) if usage is not None else None
+    rec.note(provider, model, ok, latency, prompt_tokens, completion_tokens, output=output, error=error)
+
+
+@contextmanager
+def track(
+    kind: str,
+    agent_id: str = "",
+    task_name: str = "",
+    step: str = "",
+    messages: Optional[List[Dict[str, str]]] = None,
+) -> Iterator[CallRecord]:
+    """包住一次逻辑 LLM 调用；退出时计算总延迟并写入遥测（异常时 outcome=error 并继续抛出）。"""
+    rec = CallRecord(kind, agent_id, task_name, step, messages)
+    token = _current.set(rec)
+    t0 = time.monotonic()
+    try:
+        yield rec
+    except Exception as e:
+        rec.outcome = rec.outcome or "error"
+        rec.error = str(e)
+        raise
+    finally:
+        rec.latency = time.monotonic() - t0
+        try:
+            _current.reset(token)
+        except ValueError:
+            # 流式生成器在其他上下文中被关闭时 token 不可复位，忽略
+            pass
+        if telemetry_enabled():
+            get_store().submit(rec.to_row())
+
+
+def telemetry_enabled() -> bool:
+    """.env 的 LLM_TELEMETRY_ENABLED=0/false 可关闭遥测写库。"""
+    return (get_env("LLM_TELEMETRY_ENABLED") or "1").lower() not in ("0", "false", "no", "off")
+
+
+def _percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def load_pricing() -> Dict[str, Dict[str, float]]:
+    """_default.json 的 "pricing"：{"qwen/qwen-plus": {"input": 元/千token, "output": 元/千token}, ...}。"""
+    raw = (get_config().agents.get("_default") or {}).get("pricing")
+    return {str(k).lower(): v for k, v in (raw or {}).items() if isinstance(v, dict)}
+
+
+def _cost(pricing: Dict[str, Dict[str, float]], provider: str, model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    price = pricing.get(f"{provider}/{model}".lower()) or pricing.get((model or "").lower())
+    if not price:
+        return None
+    return (prompt_tokens * float(price.get("input") or 0) + completion_tokens * float(price.get("output") or 0)) / 1000.0
+
+
+def _row_cost(
+    pricing: Dict[str, Dict[str, float]], provider: str, model: str, prompt_tokens: int, completion_tokens: int, path: Optional[str]
+) -> Optional[float]:
+    """
+    一条调用的费用：按 path 中每次尝试各自的 provider/model 与 token 计价（回退链上各模型单价不同）；
+    path 无逐次 token 的旧记录按最终端点计价。均无单价时返回 None。
+    """
+    try:
+        attempts = json.loads(path) if path else []
+    except ValueError:
+        attempts = []
+    if not attempts or not all(isinstance(a, dict) and "prompt_tokens" in a for a in attempts):
+        return _cost(pricing, provider, model, prompt_tokens, completion_tokens)
+    total: Optional[float] = None
+    for a in attempts:
+        a_provider, _, a_model = str(a.get("endpoint") or "").partition("/")
+        cost = _cost(pricing, a_provider, a_model, int(a.get("prompt_tokens") or 0), int(a.get("completion_tokens") or 0))
+        if cost is not None:
+            total = (total or 0.0) + cost
+    return total
+
+
+class TelemetryStore:
+    """SQLite 遥测表；submit 入队由后台线程批量写入。"""
+
+    def __init__(self, db_path: Optional[Path] = None):
+        self.db_path = Path(db_path or LLM_TELEMETRY_DB)
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.db_path), timeout=10.0)
+
+    def _init_db(self) -> None:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_calls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    kind TEXT NOT NULL,
+                    agent_id TEXT,
+                    task_name TEXT,
+                    step TEXT,
+                    provider TEXT,
+                    model TEXT,
+                    prompt_chars INTEGER,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    tokens_estimated INTEGER,
+                    latency REAL,
+                    attempts INTEGER,
+                    path TEXT,
+                    outcome TEXT,
+                    error TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_created ON llm_calls(created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_step ON llm_calls(agent_id, task_name, step)")
+            conn.commit()
+
+    def submit(self, row: tuple) -> None:
+        self._queue.put(row)
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._drain, name="llm-telemetry", daemon=True)
+                self._writer.start()
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                row = self._queue.get(timeout=5.0)
+            except queue.Empty:
+                return
+            rows = [row]
+            while True:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._connect() as conn:
+                    conn.executemany(
+                        f"INSERT INTO llm_calls ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                        rows,
+                    )
+                    conn.commit()
+            except sqlite3.Error as e:
+                print(f"[LLM_TELEMETRY] 写入失败 | rows={len(rows)} error={e}", flush=True)
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    def flush(self) -> None:
+        """等待已提交的遥测全部写入。"""
+        self._queue.join()
+
+    def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        self.flush()
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM llm_calls ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def report(self, since_hours: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        按 (agent_id, task_name, step) 汇总：调用数、错误数、缓存命中、回退次数、
+        p50/p95/最大延迟、累计延迟、prompt/completion token 与费用；按累计延迟降序。
+        """
+        self.flush()
+        sql = "SELECT agent_id, task_name, step, provider, model, prompt_tokens, completion_tokens, latency, attempts, path, outcome FROM llm_calls"
+        params: tuple = ()
+        if since_hours:
+            sql += " WHERE created_at >= ?"
+            params = (time.time() - since_hours * 3600,)
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        pricing = load_pricing()
+        groups: Dict[tuple, Dict[str, Any]] = {}
+        for agent_id, task_name, step, provider, model, p_tok, c_tok, latency, attempts, path, outcome in rows:
+            g = groups.setdefault((agent_id or "", task_name or "", step or ""), {
+                "agent_id": agent_id or "", "task_name": task_name or "", "step": step or "",
+                "calls": 0, "errors": 0, "cache_hits": 0, "fallbacks": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cost": None, "_latencies": [],
+            })
+            g["calls"] += 1
+            g["errors"] += outcome in ("error", "empty")
+            g["cache_hits"] += outcome in ("cache_hit", "local", "coalesced")
+            g["fallbacks"] += (attempts or 0) > 1
+            g["prompt_tokens"] += p_tok or 0
+            g["completion_tokens"] += c_tok or 0
+            cost = _row_cost(pricing, provider or "", model or "", p_tok or 0, c_tok or 0, path)
+            if cost is not None:
+                g["cost"] = (g["cost"] or 0.0) + cost
+            g["_latencies"].append(float(latency or 0.0))
+        out = []
+        for g in groups.values():
+            lat = sorted(g.pop("_latencies"))
+            g["p50_latency"] = round(_percentile(lat, 0.5) or 0.0, 3)
+            g["p95_latency"] = round(_percentile(lat, 0.95) or 0.0, 3)
+            g["max_latency"] = round(lat[-1], 3) if lat else 0.0
+            g["total_latency"] = round(sum(lat), 3)
+            if g["cost"] is not None:
+                g["cost"] = round(g["cost"], 4)
+            out.append(g)
+        out.sort(key=lambda g: g["total_latency"], reverse=True)
+        return out
+
+
+_store_lock = threading.Lock()
+_store: Optional[TelemetryStore] = None
+
+
+def get_store() -> TelemetryStore:
+    """进程级共享遥测库。"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = TelemetryStore()
+        return _store
+
+
+def set_store(store: Optional[TelemetryStore]) -> Optional[TelemetryStore]:
+    """替换进程级遥测库并返回原库（单测注入临时库后用返回值恢复；传 None 则下次 get_store 重建）。"""
+    global _store
+    with _store_lock:
+        previous, _store = _store, store
+        return previous
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m backend.llm_telemetry", description="LLM 调用遥测报表")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_report = sub.add_parser("report", help="按 agent/task/step 汇总延迟、token 与费用")
+    p_report.add_argument("--hours", type=float, default=None, help="仅统计最近 N 小时")
+    p_recent = sub.add_parser("recent", help="最近的调用记录")
+    p_recent.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    store = get_store()
+    if args.cmd == "report":
+        rows = store.report(since_hours=args.hours)
+        print(f"{'agent_id':<16} {'task':<26} {'step':<22} {'calls':>5} {'err':>4} {'p50':>7} {'p95':>7} {'total':>8} {'tokens':>9} {'cost':>8}")
+        for g in rows:
+            cost = "" if g["cost"] is None else f"{g['cost']:.4f}"
+            print(
+                f"{g['agent_id'][:16]:<16} {g['task_name'][:26]:<26} {g['step'][:22]:<22} {g['calls']:>5} {g['errors']:>4} "
+                f"{g['p50_latency']:>7.2f} {g['p95_latency']:>7.2f} {g['total_latency']:>8.1f} "
+                f"{g['prompt_tokens'] + g['completion_tokens']:>9} {cost:>8}"
+            )
+    else:
+        print(json.dumps(store.recent(args.limit), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
@@ -8,6 +8,7 @@ memU 记忆系统客户端封装（仅请求云端服务）。
   4. 交付：将路径/可下载列表交给用户，用户选择后下载到指定路径。
 """
 
+import hashlib
 import json
 import re
 import shutil
@@ -17,9 +18,10 @@ import uuid
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Literal
 
-import httpx
-
-from .config import get_env, MEMU_DB, MEMU_STORAGE_DIR, MEMU_SCENARIOS_PATH
+from .config import get_env, MEMU_DB, MEMU_STORAGE_DIR
+from .config_registry import get_config
+from .rate_limit import estimate_tokens, get_limiter
+from . import singleflight
 
 # 场景类型：论文入库 / 项目提议 / 写作事件 / 参数推荐
 SceneType = Literal["paper", "proposal", "writing_event", "parameter_recommendation", "data", "image", "other"]
@@ -98,7 +100,7 @@ class MemUClient:
         self._db_path = Path(db_path or MEMU_DB)
         self._storage_dir = Path(storage_dir or MEMU_STORAGE_DIR)
         self._storage_dir.mkdir(parents=True, exist_ok=True)
-        self._scenarios_config: Dict[str, Any] = {}
+        self._scenarios_override: Optional[Dict[str, Any]] = None
         self._load_scenarios_config()
         self._init_db()
 
@@ -112,7 +114,9 @@ class MemUClient:
         if not self.enabled:
             return {"error": "memu_disabled"}
         url = f"{self.base_url}{path}"
+        get_limiter().acquire("memu", "", estimate_tokens(payload))
         try:
+            import httpx
             r = httpx.post(url, headers=self._headers(), json=payload, timeout=timeout)
             r.raise_for_status()
             return r.json()
@@ -123,7 +127,9 @@ class MemUClient:
         if not self.enabled:
             return {"error": "memu_disabled"}
         url = f"{self.base_url}{path}"
+        get_limiter().acquire("memu", "")
         try:
+            import httpx
             r = httpx.get(url, headers=self._headers(), timeout=timeout)
             r.raise_for_status()
             return r.json()
@@ -261,15 +267,19 @@ class MemUClient:
             conn.commit()
 
     def _load_scenarios_config(self) -> None:
-        """从 config/memu_scenarios.json 加载按 agent_id 的配置（预留扩展）。"""
-        path = Path(MEMU_SCENARIOS_PATH)
-        if not path.exists():
-            self._scenarios_config = {}
-            return
-        try:
-            self._scenarios_config = json.loads(path.read_text(encoding="utf-8"))
-        except Exception:
-            self._scenarios_config = {}
+        """按 agent_id 的场景配置改为跟随 config_registry 快照（随 memu_scenarios.json 热加载）；清除手动覆盖。"""
+        self._scenarios_override = None
+
+    @property
+    def _scenarios_config(self) -> Dict[str, Any]:
+        """memu_scenarios.json 内容：手动赋值覆盖优先，否则为当前配置快照（只读）。"""
+        if self._scenarios_override is not None:
+            return self._scenarios_override
+        return get_config().scenarios
+
+    @_scenarios_config.setter
+    def _scenarios_config(self, value: Dict[str, Any]) -> None:
+        self._scenarios_override = value
 
     def get_retrieve_config(self, agent_id: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -360,6 +370,7 @@ class MemUClient:
         """
         检索记忆。v3: POST /api/v3/memory/retrieve
         override_config 未传时从 config/memu_scenarios.json 按 agent_id 加载（method=rag, top_k 等）。
+        相同 (base_url, api_key, payload) 的并发检索经 singleflight 合并为一次请求。
         """
         uid = user_id or self.user_id
         aid = agent_id or self.agent_id
@@ -367,7 +378,10 @@ class MemUClient:
         cfg = override_config if override_config is not None else self.get_retrieve_config(aid)
         if cfg:
             payload["override_config"] = cfg
-        return self._post("/api/v3/memory/retrieve", payload)
+        key = hashlib.sha256(
+            json.dumps([self.base_url, self.api_key, payload], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return singleflight.get_group("memu_retrieve").do(key, self._post, "/api/v3/memory/retrieve", payload)
 
     def _openrouter_query_rewrite(self, query: str, max_tokens: int = 150) -> str:
         """使用 OpenRouter 对 query 做改写/扩展，提升检索效果。"""
@@ -384,6 +398,7 @@ class MemUClient:
             "max_tokens": max_tokens,
         }
         try:
+            import httpx
             r = httpx.post(url, headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"}, json=payload, timeout=15.0)
             r.raise_for_status()
             data = r.json()
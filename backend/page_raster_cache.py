@@ -0,0 +1,426 @@
+# backend/page_raster_cache.py
+"""
+整页栅格缓存：按 (PDF 内容哈希, dpi, 页码, 格式, 质量) 只渲染一次，同一论文路由到多个 agent 时共享。
+- 缓存目录 PAGE_RASTER_CACHE_DIR（默认 database/page_raster_cache/<pdf sha1>/p<页码>_<dpi>dpi[_q<质量>].<ext>）
+- 渲染：常驻 PDF 进程池启用时每页一个任务并行渲染（同一文档共享 deadline，同时在执行的页不超过 PDF_EXTRACT_WORKERS），
+  否则本进程线程池
+- 格式 PAGE_RASTER_FORMAT（png / jpeg / webp），有损格式质量 PAGE_RASTER_QUALITY；webp 需 Pillow，未安装时回退 png
+- 记录目录通过硬链接引用缓存文件（跨文件系统等无法硬链接时复制），清理缓存不影响已入库的记录
+- 清理：以 PDF 为单位按最近使用时间淘汰，超过 PAGE_RASTER_CACHE_MAX_AGE_DAYS 未用或总量超过 PAGE_RASTER_CACHE_MAX_MB 时删除；
+  渲染后自动执行（间隔不少于 _PURGE_INTERVAL 秒），也可 python -m backend.page_raster_cache purge
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .config import DB_DIR, get_env
+
+PAGE_RASTER_CACHE_DIR = DB_DIR / "page_raster_cache"
+PYMUPDF_AVAILABLE = importlib.util.find_spec("fitz") is not None
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+_DEFAULT_DPI = 160
+_DEFAULT_FORMAT = "png"
+_DEFAULT_QUALITY = 85
+_DEFAULT_THREADS = 4
+_DEFAULT_CACHE_MAX_MB = 2048
+_DEFAULT_CACHE_MAX_AGE_DAYS = 30
+_EXT = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+# 渲染后自动清理的最小间隔（秒）
+_PURGE_INTERVAL = 300.0
+# 哈希记忆的条目上限（LRU）
+_HASH_MEMO_MAX = 256
+
+_lock = threading.Lock()
+# (路径, 大小, mtime) -> sha1，避免同一文件重复计算哈希
+_hash_memo: "collections.OrderedDict[Tuple[str, int, float], str]" = collections.OrderedDict()
+# 同一 PDF 的渲染串行化，避免多 agent 并发时重复渲染：digest -> [锁, 持有或等待的调用数]，计数归零时移除
+_doc_locks: Dict[str, List[Any]] = {}
+_last_purge = 0.0
+_stats: Dict[str, int] = {"hits": 0, "rendered": 0, "errors": 0, "bytes_rendered": 0, "linked": 0, "copied": 0, "purged": 0}
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def _count(key: str, n: int = 1) -> None:
+    with _lock:
+        _stats[key] += n
+
+
+def resolve_format(fmt: Optional[str] = None) -> str:
+    """规范化格式名（jpg → jpeg）；webp 无 Pillow 或未知格式时回退 png。"""
+    name = (fmt or get_env("PAGE_RASTER_FORMAT") or _DEFAULT_FORMAT).strip().lower()
+    name = "jpeg" if name == "jpg" else name
+    if name == "webp" and not PIL_AVAILABLE:
+        print("[PAGE_RASTER] webp 需要 Pillow（pip install pillow），回退 png", flush=True)
+        return "png"
+    return name if name in _EXT else "png"
+
+
+def file_sha1(file_path: str) -> str:
+    """PDF 内容哈希（分块读取）；按 (路径, 大小, mtime) 记忆。"""
+    path = Path(file_path)
+    st = path.stat()
+    key = (str(path.resolve()), st.st_size, st.st_mtime)
+    with _lock:
+        cached = _hash_memo.get(key)
+        if cached:
+            _hash_memo.move_to_end(key)
+    if cached:
+        return cached
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    with _lock:
+        _hash_memo[key] = digest
+        while len(_hash_memo) > _HASH_MEMO_MAX:
+            _hash_memo.popitem(last=False)
+    return digest
+
+
+def extension(fmt: str) -> str:
+    """resolve_format 结果对应的文件扩展名（不含点）。"""
+    return _EXT[fmt]
+
+
+def raster_name(page_num: int, dpi: int, fmt: str, quality: int) -> str:
+    """缓存文件名；页码从 1 计，有损格式带质量。"""
+    suffix = "" if fmt == "png" else f"_q{quality}"
+    return f"p{page_num}_{dpi}dpi{suffix}.{extension(fmt)}"
+
+
+def encode_pixmap(pix: Any, fmt: str, quality: int) -> bytes:
+    """按 resolve_format 的结果编码 PyMuPDF Pixmap。"""
+    if fmt == "png":
+        return pix.tobytes("png")
+    if fmt == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=quality)
+    return pix.pil_tobytes(format="WEBP", quality=quality)
+
+
+def write_atomic(out_path: str, data: bytes) -> None:
+    """先写临时文件再替换，并发渲染同一文件时读者不会看到半截内容。"""
+    tmp = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, out_path)
+
+
+def _render_page(file_path: str, page_index: int, dpi: int, fmt: str, quality: int, out_path: str) -> int:
+    """渲染单页并原子写入 out_path，返回字节数；进程池与线程池共用。"""
+    import fitz  # PyMuPDF
+
+    with fitz.open(file_path) as doc:
+        pix = doc[page_index].get_pixmap(dpi=dpi)
+    data = encode_pixmap(pix, fmt, quality)
+    write_atomic(out_path, data)
+    return len(data)
+
+
+def _page_count(file_path: str) -> int:
+    from .pdf_extract import _page_count as count
+    from .pdf_worker_pool import run_isolated
+    return int(run_isolated(count, file_path, default=0, label="page_count") or 0)
+
+
+def cache_root(cache_dir: Optional[Path] = None) -> Path:
+    return Path(cache_dir or get_env("PAGE_RASTER_CACHE_DIR") or PAGE_RASTER_CACHE_DIR)
+
+
+@contextlib.contextmanager
+def doc_lock(digest: str) -> Iterator[None]:
+    """同一 PDF（按内容哈希）的渲染锁（with doc_lock(digest): ...）；没有调用方持有或等待时从表中移除。"""
+    with _lock:
+        entry = _doc_locks.setdefault(digest, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if not entry[1]:
+                _doc_locks.pop(digest, None)
+
+
+@contextlib.contextmanager
+def _claim_idle(digest: str) -> Iterator[bool]:
+    """没有调用方持有或等待该文档的渲染锁时占用它并 yield True（期间新来的渲染等待）；否则不等待，yield False。"""
+    with _lock:
+        entry = None
+        if digest not in _doc_locks:
+            entry = [threading.Lock(), 1]
+            entry[0].acquire()
+            _doc_locks[digest] = entry
+    if entry is None:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        entry[0].release()
+        with _lock:
+            entry[1] -= 1
+            if not entry[1]:
+                _doc_locks.pop(digest, None)
+
+
+def mark_used(digest: str, cache_dir: Optional[Path] = None) -> None:
+    """更新该 PDF 缓存目录的 mtime（命中也算使用），清理按此淘汰最久未用的文档。"""
+    try:
+        os.utime(cache_root(cache_dir) / digest)
+    except OSError:
+        pass
+
+
+def _scan(root: Path) -> List[Tuple[float, Path, int]]:
+    """[(最近使用时间, 文档目录, 字节数)]，最久未用在前。"""
+    docs = []
+    for d in root.iterdir() if root.is_dir() else []:
+        if not d.is_dir():
+            continue
+        try:
+            size = sum(f.stat().st_size for f in d.rglob("*") if f.is_file())
+            docs.append((d.stat().st_mtime, d, size))
+        except OSError:
+            continue
+    docs.sort(key=lambda item: item[0])
+    return docs
+
+
+def usage(cache_dir: Optional[Path] = None) -> Dict[str, Any]:
+    """缓存目录的文档数与字节数。"""
+    docs = _scan(cache_root(cache_dir))
+    return {"dir": str(cache_root(cache_dir)), "docs": len(docs), "bytes": sum(size for _, _, size in docs)}
+
+
+def purge(
+    cache_dir: Optional[Path] = None,
+    max_bytes: Optional[int] = None,
+    max_age_days: Optional[float] = None,
+    keep: Iterable[str] = (),
+    everything: bool = False,
+) -> Dict[str, int]:
+    """
+    以 PDF 为单位清理缓存：先删超过 max_age_days 未使用的文档，再按最久未用删到总量不超过 max_bytes。
+    未给出时读 PAGE_RASTER_CACHE_MAX_MB / PAGE_RASTER_CACHE_MAX_AGE_DAYS（0 表示不按该项清理）；everything=True 时全部删除。
+    正在渲染的文档与 keep 中的哈希不删；占用渲染锁后再确认扫描以来未被使用，否则跳过。
+    返回 {"docs", "bytes", "deleted", "freed_bytes"}（docs / bytes 为清理后）。
+    """
+    if max_bytes is None:
+        max_bytes = _env_int("PAGE_RASTER_CACHE_MAX_MB", _DEFAULT_CACHE_MAX_MB) * 1024 * 1024
+    if max_age_days is None:
+        max_age_days = _env_int("PAGE_RASTER_CACHE_MAX_AGE_DAYS", _DEFAULT_CACHE_MAX_AGE_DAYS)
+    keep = set(keep)
+    docs = _scan(cache_root(cache_dir))
+    total = sum(size for _, _, size in docs)
+    now = time.time()
+    deleted = freed = 0
+    for mtime, d, size in docs:
+        expired = everything or (max_age_days > 0 and now - mtime > max_age_days * 86400)
+        if not expired and not (max_bytes > 0 and total > max_bytes):
+            break
+        if d.name in keep:
+            continue
+        with _claim_idle(d.name) as claimed:
+            if not claimed:
+                continue
+            try:
+                used = d.stat().st_mtime != mtime
+            except OSError:
+                continue
+            if used:
+                continue
+            shutil.rmtree(d, ignore_errors=True)
+        total -= size
+        deleted += 1
+        freed += size
+    if deleted:
+        _count("purged", deleted)
+        print(f"[PAGE_RASTER] 清理缓存 | deleted={deleted} freed={freed} remaining={total}", flush=True)
+    return {"docs": len(docs) - deleted, "bytes": total, "deleted": deleted, "freed_bytes": freed}
+
+
+def maybe_purge(cache_dir: Optional[Path] = None, keep: Iterable[str] = ()) -> None:
+    """渲染写入新文件后调用：距上次清理超过 _PURGE_INTERVAL 秒时执行 purge，失败只打印。"""
+    global _last_purge
+    with _lock:
+        if time.monotonic() - _last_purge < _PURGE_INTERVAL:
+            return
+        _last_purge = time.monotonic()
+    try:
+        purge(cache_dir, keep=keep)
+    except Exception as e:
+        print(f"[PAGE_RASTER] 清理缓存失败 | error={e}", flush=True)
+
+
+def _render_with_pool(file_path: str, jobs: List[Tuple[int, str]], dpi: int, fmt: str, quality: int) -> Dict[int, Any]:
+    """
+    在常驻进程池中渲染：同一文档同时在执行的页不超过 PDF_EXTRACT_WORKERS（且不超过池大小），完成一页再提交下一页，
+    其余子进程留给并发上传的其他文档。返回 {页码: 字节数或异常}。
+    """
+    from . import pdf_worker_pool
+    from .pdf_extract import _resolve_workers
+
+    pool = pdf_worker_pool.get_pool()
+    deadline = pool.new_deadline()
+    parallel = max(1, min(pool.size, _resolve_workers(None)))
+    todo = iter(jobs)
+    in_flight: Dict[concurrent.futures.Future, int] = {}
+    results: Dict[int, Any] = {}
+
+    def submit_next() -> None:
+        for p, out in todo:
+            in_flight[pool.submit(_render_page, str(file_path), p - 1, dpi, fmt, quality, out, deadline=deadline)] = p
+            return
+
+    for _ in range(parallel):
+        submit_next()
+    while in_flight:
+        done, _ = concurrent.futures.wait(list(in_flight), return_when=concurrent.futures.FIRST_COMPLETED)
+        for fut in done:
+            p = in_flight.pop(fut)
+            try:
+                results[p] = fut.result()
+            except Exception as e:
+                results[p] = e
+            submit_next()
+    return results
+
+
+def get_page_rasters(
+    file_path: str,
+    pages: Optional[Iterable[int]] = None,
+    max_pages: Optional[int] = None,
+    dpi: Optional[int] = None,
+    fmt: Optional[str] = None,
+    quality: Optional[int] = None,
+    cache_dir: Optional[Path] = None,
+) -> List[Dict[str, Any]]:
+    """
+    返回 [{"page", "path", "cached"}]（页码从 1 计，按页序）；缺失的页并行渲染后写入缓存，渲染失败的页不出现在结果中。
+    pages 为页码（从 1 计）；未给出时取前 max_pages 页（None 为全部）。
+    dpi / fmt / quality 未给出时读 PAGE_RASTER_DPI / PAGE_RASTER_FORMAT / PAGE_RASTER_QUALITY。
+    """
+    from . import pdf_worker_pool
+
+    dpi = dpi or _env_int("PAGE_RASTER_DPI", _DEFAULT_DPI)
+    fmt = resolve_format(fmt)
+    quality = quality or _env_int("PAGE_RASTER_QUALITY", _DEFAULT_QUALITY)
+    digest = file_sha1(file_path)
+    doc_dir = cache_root(cache_dir) / digest
+
+    if pages is None:
+        total = _page_count(file_path)
+        pages = range(1, (total if max_pages is None else min(total, max_pages)) + 1)
+    wanted = sorted(set(int(p) for p in pages if int(p) >= 1))
+
+    with doc_lock(digest):
+        missing = [p for p in wanted if not (doc_dir / raster_name(p, dpi, fmt, quality)).is_file()]
+        _count("hits", len(wanted) - len(missing))
+        if missing:
+            doc_dir.mkdir(parents=True, exist_ok=True)
+            jobs = [(p, str(doc_dir / raster_name(p, dpi, fmt, quality))) for p in missing]
+            if pdf_worker_pool.pool_enabled():
+                results = _render_with_pool(str(file_path), jobs, dpi, fmt, quality)
+            else:
+                workers = max(1, min(_env_int("PAGE_RASTER_THREADS", _DEFAULT_THREADS), len(jobs)))
+                results = {}
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="page-raster") as executor:
+                    futures = {
+                        p: executor.submit(_render_page, str(file_path), p - 1, dpi, fmt, quality, out) for p, out in jobs
+                    }
+                    for p, fut in futures.items():
+                        try:
+                            results[p] = fut.result()
+                        except Exception as e:
+                            results[p] = e
+            for p, _ in jobs:
+                result = results.get(p)
+                if isinstance(result, Exception):
+                    _count("errors")
+                    print(f"[PAGE_RASTER] 渲染失败 | file={Path(file_path).name} page={p} error={result}", flush=True)
+                else:
+                    _count("bytes_rendered", result or 0)
+                    _count("rendered")
+        print(
+            f"[PAGE_RASTER] 整页栅格 | file={Path(file_path).name} pages={len(wanted)} "
+            f"cached={len(wanted) - len(missing)} rendered={len(missing)} dpi={dpi} format={fmt}",
+            flush=True,
+        )
+    mark_used(digest, cache_dir)
+    if missing:
+        maybe_purge(cache_dir, keep=[digest])
+
+    out: List[Dict[str, Any]] = []
+    for p in wanted:
+        path = doc_dir / raster_name(p, dpi, fmt, quality)
+        if path.is_file():
+            out.append({"page": p, "path": str(path), "cached": p not in missing})
+    return out
+
+
+def link_into(src: str, dest: Path) -> Path:
+    """把缓存文件以硬链接放到记录目录（已存在则替换）；无法硬链接时复制。"""
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if dest.exists():
+        dest.unlink()
+    try:
+        os.link(src, dest)
+        _count("linked")
+    except OSError:
+        shutil.copy2(src, dest)
+        _count("copied")
+    return dest
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return dict(_stats)
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m backend.page_raster_cache", description="查看与清理整页栅格缓存")
+    parser.add_argument("--dir", default=None, help="缓存目录（默认 PAGE_RASTER_CACHE_DIR）")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("stats", help="文档数与占用字节数")
+    p_purge = sub.add_parser("purge", help="按最近使用时间清理")
+    p_purge.add_argument("--max-mb", type=float, default=None, help="总量上限（MB，默认 PAGE_RASTER_CACHE_MAX_MB）")
+    p_purge.add_argument("--max-age-days", type=float, default=None, help="未使用天数上限（默认 PAGE_RASTER_CACHE_MAX_AGE_DAYS）")
+    p_purge.add_argument("--all", action="store_true", help="删除全部缓存")
+    args = parser.parse_args(argv)
+
+    cache_dir = Path(args.dir) if args.dir else None
+    if args.cmd == "stats":
+        out: Any = usage(cache_dir)
+    elif args.all:
+        out = purge(cache_dir, everything=True)
+    else:
+        max_bytes = None if args.max_mb is None else int(args.max_mb * 1024 * 1024)
+        out = purge(cache_dir, max_bytes=max_bytes, max_age_days=args.max_age_days)
+    print(json.dumps(out, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
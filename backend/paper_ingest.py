@@ -5,15 +5,20 @@
 支持单 agent 或多 agent 并行（先实现单 agent 串行，多 agent 可扩展）。
 """
 
+import concurrent.futures
+import contextvars
 import json
 import re
+import threading
 import time
 import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from .config import MEMU_STORAGE_DIR
+from .config import MEMU_STORAGE_DIR, get_env
+from . import json_repair, llm_telemetry
 from .memu_client import build_storage_path
+from .rate_limit import acquire_for_messages, get_limiter
 from .agent_config import (
     get_client_for_step,
     get_model_for_step,
@@ -22,16 +27,286 @@ from .agent_config import (
 )
 
 
+# 阶段1 分块（map-reduce）：按 extract_raw_with_pymupdf 的页标记切分，并行提取后合并标签输出
+_PAGE_MARKER_RE = re.compile(r"^--- 第 (\d+) 页 ---$", re.MULTILINE)
+_TAG_LINE_RE = re.compile(r"^\s*\[([A-Za-z0-9_.]+)\]\s*[:：]\s*(.*)$")
+_S1_SINGLE_CALL_LIMIT = 80000
+_DEFAULT_S1_CHUNK_CHARS = 24000
+_DEFAULT_S1_MAX_PARALLEL = 4
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def _split_pages(raw_text: str) -> List[Tuple[int, str]]:
+    """按「--- 第 N 页 ---」拆成 [(页码, 含页标记的文本)]；无页标记时整体作为第 1 页。"""
+    marks = list(_PAGE_MARKER_RE.finditer(raw_text))
+    if not marks:
+        return [(1, raw_text)]
+    pages: List[Tuple[int, str]] = []
+    head = raw_text[:marks[0].start()].strip()
+    for i, m in enumerate(marks):
+        end = marks[i + 1].start() if i + 1 < len(marks) else len(raw_text)
+        pages.append((int(m.group(1)), raw_text[m.start():end].rstrip()))
+    if head:
+        pages[0] = (pages[0][0], head + "\n" + pages[0][1])
+    return pages
+
+
+def _group_pages(marked_pages: Iterable[Tuple[int, str]], chunk_chars: int) -> Iterator[Dict[str, Any]]:
+    """
+    将 [(页码, 含页标记的文本)] 逐页聚合为不超过 chunk_chars 的片段（不拆页；单页超长时按字符硬切）。
+    片段凑满即产出，只在内存中保留当前片段。
+    """
+    cur: List[str] = []
+    cur_len = 0
+    first = last = 0
+    for page_num, text in marked_pages:
+        if len(text) > chunk_chars:
+            if cur:
+                yield {"first_page": first, "last_page": last, "text": "\n".join(cur)}
+                cur, cur_len = [], 0
+            for i in range(0, len(text), chunk_chars):
+                yield {"first_page": page_num, "last_page": page_num, "text": text[i:i + chunk_chars]}
+            continue
+        if cur and cur_len + len(text) + 1 > chunk_chars:
+            yield {"first_page": first, "last_page": last, "text": "\n".join(cur)}
+            cur, cur_len = [], 0
+        if not cur:
+            first = page_num
+        cur.append(text)
+        cur_len += len(text) + 1
+        last = page_num
+    if cur:
+        yield {"first_page": first, "last_page": last, "text": "\n".join(cur)}
+
+
+def split_text_by_pages(raw_text: str, chunk_chars: int) -> List[Dict[str, Any]]:
+    """
+    将全文按页聚合为若干不超过 chunk_chars 的片段（不拆页；单页超长时按字符硬切）。
+    返回 [{"first_page", "last_page", "text"}]，保持原页序。
+    """
+    return list(_group_pages(_split_pages(raw_text), chunk_chars))
+
+
+def iter_page_chunks(pages: Iterable[Dict[str, Any]], chunk_chars: int) -> Iterator[Dict[str, Any]]:
+    """
+    split_text_by_pages 的流式版本：消费 pdf_extract.iter_pdf_pages 产出的页（{"page_num", "text"}），
+    按与 extract_raw_with_pymupdf 相同的页标记格式聚合，片段凑满即产出。
+    """
+    marked = ((p["page_num"], f"--- 第 {p['page_num']} 页 ---\n{p.get('text') or ''}".rstrip()) for p in pages)
+    return _group_pages(marked, chunk_chars)
+
+
+def merge_tagged_outputs(outputs: List[str]) -> str:
+    """
+    合并各片段的标签输出（按片段顺序）：
+    - [metadata.*] 为单值字段，取第一个给出非空值的片段（标题、摘要通常在前几页）
+    - 其余标签（methodology、keywords、figures、parameter 等）按出现顺序拼接，去除重复行
+    - 标签后的续行归入该标签
+    """
+    order: List[str] = []
+    values: Dict[str, List[str]] = {}
+    owner: Dict[str, int] = {}
+    for idx, out in enumerate(outputs):
+        tag = None
+        for line in (out or "").splitlines():
+            m = _TAG_LINE_RE.match(line)
+            if m:
+                tag = m.group(1)
+                if tag not in values:
+                    order.append(tag)
+                    values[tag] = []
+                line = m.group(2)
+            if tag is None:
+                continue
+            line = line.strip()
+            if not line:
+                continue
+            if tag.startswith("metadata."):
+                if owner.setdefault(tag, idx) != idx:
+                    continue
+            if line not in values[tag]:
+                values[tag].append(line)
+    return "\n".join(f"[{tag}]: " + "\n".join(values[tag]) for tag in order)
+
+
+def _run_stage1_chunked(
+    agent_id: str,
+    system_prompt: str,
+    raw_text: str,
+    chunk_chars: int,
+    max_parallel: int,
+) -> Tuple[str, int, int]:
+    """全文已在内存时的阶段1 分块提取：先切好全部片段（片段数与总页数写入提示），再交给 _run_stage1_stream。"""
+    chunks = split_text_by_pages(raw_text, chunk_chars)
+    last_page = chunks[-1]["last_page"] if chunks else 0
+    return _run_stage1_stream(agent_id, system_prompt, chunks, max_parallel, total=len(chunks), last_page=last_page)
+
+
+def _run_stage1_stream(
+    agent_id: str,
+    system_prompt: str,
+    chunks: Iterable[Dict[str, Any]],
+    max_parallel: int,
+    total: Optional[int] = None,
+    last_page: Optional[int] = None,
+) -> Tuple[str, int, int]:
+    """
+    阶段1 map：片段一产出就提交 invoke_model（并发受 max_parallel 与共享限流器约束），
+    在途片段不超过 2 * max_parallel，chunks 为生成器时边解析边提取、内存有界；
+    reduce：按页序合并标签输出。返回 (合并文本, 成功片段数, 片段总数)。
+    """
+    from .agent_config import invoke_model
+
+    def run_chunk(i: int, c: Dict[str, Any]) -> str:
+        pages = f"第 {c['first_page']} 页" if c["first_page"] == c["last_page"] else f"第 {c['first_page']}–{c['last_page']} 页"
+        where = f"{pages}，共 {last_page} 页，片段 {i + 1}/{total}" if total else f"{pages}，片段 {i + 1}"
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": (
+                    f"以下是论文的一个片段（{where}）。"
+                    f"请仅根据该片段按格式提取论文内容，片段中没有的标签留空：\n\n{c['text']}"
+                ),
+            },
+        ]
+        return (invoke_model(agent_id, "paper_ingest", "extraction_s1", messages, temperature=0.1) or "").strip()
+
+    outputs: Dict[int, str] = {}
+    workers = max(1, max_parallel if total is None else min(max_parallel, total))
+    window = 2 * workers
+    pending: Dict[concurrent.futures.Future, int] = {}
+
+    def collect(done: Iterable[concurrent.futures.Future]) -> None:
+        for fut in done:
+            i = pending.pop(fut)
+            try:
+                outputs[i] = fut.result()
+            except Exception as e:
+                print(f"[PAPER_INGEST] 阶段1 片段失败 | chunk={i + 1} error={e}", flush=True)
+                outputs[i] = ""
+
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s1-chunk") as pool:
+        for i, c in enumerate(chunks):
+            if len(pending) >= window:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            pending[pool.submit(contextvars.copy_context().run, run_chunk, i, c)] = i
+            count = i + 1
+        collect(concurrent.futures.wait(pending).done)
+    ordered = [outputs.get(i, "") for i in range(count)]
+    ok = sum(1 for o in ordered if o)
+    return merge_tagged_outputs([o for o in ordered if o]), ok, count
+
+
+def _stage1_from_pages(agent_id: str, system_prompt: str, pages: Iterable[Dict[str, Any]]) -> Optional[str]:
+    """
+    阶段1 流式页输入：跳过无文本的页，片段凑满即提交。
+    返回合并后的标签文本（全部片段失败时为空串）；没有任何带文本的页（扫描件）或读页出错时返回 None，由调用方回退 file-extract。
+    """
+    # PAPER_S1_CHUNK_CHARS 为 0 时片段上限取单次调用上限
+    chunk_chars = _env_int("PAPER_S1_CHUNK_CHARS", _DEFAULT_S1_CHUNK_CHARS)
+    if chunk_chars <= 0:
+        chunk_chars = _S1_SINGLE_CALL_LIMIT
+    max_parallel = _env_int("PAPER_S1_MAX_PARALLEL", _DEFAULT_S1_MAX_PARALLEL)
+    text_pages = [0]
+
+    def with_text() -> Iterator[Dict[str, Any]]:
+        for page in pages:
+            if (page.get("text") or "").strip():
+                text_pages[0] += 1
+                yield page
+
+    t0 = time.monotonic()
+    try:
+        extracted_text, ok, total = _run_stage1_stream(agent_id, system_prompt, iter_page_chunks(with_text(), chunk_chars), max_parallel)
+    except Exception as e:
+        print(f"[PAPER_INGEST] 阶段1 读页失败，回退 file-extract | error={e}", flush=True)
+        return None
+    if not text_pages[0]:
+        print(f"[PAPER_INGEST] 阶段1 无文本层，回退 file-extract", flush=True)
+        return None
+    print(
+        f"[PAPER_INGEST] 阶段1 流式分块提取 | chunks={ok}/{total} pages={text_pages[0]} parallel={max_parallel} "
+        f"elapsed={time.monotonic() - t0:.1f}s",
+        flush=True,
+    )
+    return extracted_text
+
+
+class _SharedPages:
+    """
+    同一次上传共用的页流（阶段1 流式输入）：首个 agent 消费时经 pdf_extract.iter_pdf_text_pages 读取并缓存，
+    其余 agent 重放缓存，PDF 只解析一次。读页出错时记录异常，之后的 agent 读到同一位置再次抛出（各自回退 file-extract）。
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._source: Optional[Iterator[Dict[str, Any]]] = None
+        self._pages: List[Dict[str, Any]] = []
+        self._error: Optional[Exception] = None
+        self._done = False
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        from . import pdf_extract
+
+        i = 0
+        while True:
+            with self._lock:
+                if i >= len(self._pages):
+                    if self._error is not None:
+                        raise self._error
+                    if self._done:
+                        return
+                    if self._source is None:
+                        self._source = pdf_extract.iter_pdf_text_pages(str(self._path))
+                    try:
+                        self._pages.append(next(self._source))
+                    except StopIteration:
+                        self._done = True
+                        return
+                    except Exception as e:
+                        self._error = e
+                        raise
+                page = self._pages[i]
+            i += 1
+            yield page
+
+
+def _shared_pages(path: Path) -> Optional[_SharedPages]:
+    """PAPER_S1_PAGE_STREAM 开启且已安装 PyMuPDF 时返回本次上传的共享页流，否则 None（阶段1 走 file-extract）。"""
+    from . import pdf_extract
+
+    if (get_env("PAPER_S1_PAGE_STREAM") or "").lower() not in ("1", "true", "yes", "on"):
+        return None
+    if not pdf_extract.PYMUPDF_AVAILABLE:
+        return None
+    return _SharedPages(path)
+
+
 def extract_paper_structure(
     file_path: str,
     agent_id: str,
     storage_dir: Optional[Path] = None,
     raw_text_input: Optional[str] = None,
+    on_partial: Optional[Callable[[str], None]] = None,
+    pages: Optional[Iterable[Dict[str, Any]]] = None,
 ) -> Dict[str, Any]:
     """
     使用 agent 对应模板对 PDF 做双阶段提取，返回结构化 JSON。
-    若提供 raw_text_input（如 PyMuPDF 提取 + LLM 校验后的文本），则 S1 直接基于该文本，不再用 file-extract。
+    若提供 raw_text_input（如 PyMuPDF 提取 + LLM 校验后的文本），则 S1 直接基于该文本，不再用 file-extract；
+    长文本按页分块并发执行 S1，再合并标签输出交给 S2（延迟取决于最长片段而非全文）。
+    若提供 pages（如 pdf_extract.iter_pdf_pages 生成器），S1 边读页边按片段提交，不拼接全文；全部页无文本（扫描件）时回退 file-extract。
     若未提供且 DashScope 不可用，返回兜底结构。
+    阶段2 流式生成，JSON 闭合即停止；on_partial 逐段接收阶段2 输出，供前端展示部分结果（收到 agent_config.STREAM_RESET 时清空已展示内容）。
     """
     from .agent_config import invoke_model
 
@@ -48,38 +323,69 @@ def extract_paper_structure(
     if not extraction_s1:
         extraction_s1 = "请按标签格式提取论文核心信息：标题、作者、期刊、年份、摘要、创新点、研究方法、关键词。"
 
-    if raw_text_input and raw_text_input.strip():
+    extracted_text: Optional[str] = None
+    if pages is not None and not (raw_text_input and raw_text_input.strip()):
+        # S1: 流式页输入（无文本层时 extracted_text 为 None，走下方 file-extract）
+        extracted_text = _stage1_from_pages(agent_id, extraction_s1, pages)
+        if extracted_text == "":
+            return {"error": "阶段1 提取失败（pages 模式）", "metadata": {"title": path.name}}
+    elif raw_text_input and raw_text_input.strip():
         # S1: 基于 PyMuPDF + LLM 校验后的文本做标签提取（无需 file-extract）
-        messages = [
-            {"role": "system", "content": extraction_s1},
-            {"role": "user", "content": f"请按格式从以下文本中提取论文内容：\n\n{raw_text_input[:80000]}"},
-        ]
-        extracted_text = invoke_model(agent_id, "paper_ingest", "extraction_s1", messages, temperature=0.1)
+        # 超过 PAPER_S1_CHUNK_CHARS 时按页分块并发提取再合并；设为 0 则沿用单次调用（截断至 80000 字符）
+        chunk_chars = _env_int("PAPER_S1_CHUNK_CHARS", _DEFAULT_S1_CHUNK_CHARS)
+        if chunk_chars > 0 and len(raw_text_input) > chunk_chars:
+            max_parallel = _env_int("PAPER_S1_MAX_PARALLEL", _DEFAULT_S1_MAX_PARALLEL)
+            t0 = time.monotonic()
+            extracted_text, ok, total = _run_stage1_chunked(agent_id, extraction_s1, raw_text_input, chunk_chars, max_parallel)
+            print(
+                f"[PAPER_INGEST] 阶段1 分块提取 | chunks={ok}/{total} chars={len(raw_text_input)} "
+                f"parallel={max_parallel} elapsed={time.monotonic() - t0:.1f}s",
+                flush=True,
+            )
+        else:
+            messages = [
+                {"role": "system", "content": extraction_s1},
+                {"role": "user", "content": f"请按格式从以下文本中提取论文内容：\n\n{raw_text_input[:_S1_SINGLE_CALL_LIMIT]}"},
+            ]
+            extracted_text = (invoke_model(agent_id, "paper_ingest", "extraction_s1", messages, temperature=0.1) or "").strip()
         if not extracted_text:
             return {"error": "阶段1 提取失败（raw_text 模式）", "metadata": {"title": path.name}}
-        extracted_text = extracted_text.strip()
-    else:
+    if extracted_text is None:
         # S1: 回退到 file-extract 流程
         client = get_client_for_step(agent_id, "paper_ingest", "extraction_s1")
         if not client:
             return {"error": "DASHSCOPE_API_KEY 未配置", "metadata": {"title": path.name}}
-        try:
-            file_object = client.files.create(file=path, purpose="file-extract")
-        except Exception as e:
-            return {"error": f"file-extract 失败: {e}", "metadata": {"title": path.name}}
-        try:
-            r1 = client.chat.completions.create(
-                model=m_s1.get("model", "qwen-long"),
-                messages=[
-                    {"role": "system", "content": f"fileid://{file_object.id}"},
-                    {"role": "system", "content": extraction_s1},
-                    {"role": "user", "content": "请按格式提取论文内容。"},
-                ],
-                temperature=0.1,
-            )
-            extracted_text = (r1.choices[0].message.content or "").strip()
-        except Exception as e:
-            return {"error": f"阶段1 提取失败: {e}", "metadata": {"title": path.name}}
+        s1_provider = m_s1.get("provider", "qwen")
+        s1_model = m_s1.get("model", "qwen-long")
+        with llm_telemetry.track("file_extract", agent_id, "paper_ingest", "file_upload") as call:
+            call.provider, call.model = s1_provider, "files"
+            get_limiter().acquire(s1_provider, "files", agent_id=agent_id)
+            t0 = time.monotonic()
+            try:
+                file_object = client.files.create(file=path, purpose="file-extract")
+            except Exception as e:
+                llm_telemetry.note_attempt(s1_provider, "files", False, time.monotonic() - t0, error=str(e))
+                return {"error": f"file-extract 失败: {e}", "metadata": {"title": path.name}}
+            llm_telemetry.note_attempt(s1_provider, "files", True, time.monotonic() - t0)
+        s1_messages = [
+            {"role": "system", "content": f"fileid://{file_object.id}"},
+            {"role": "system", "content": extraction_s1},
+            {"role": "user", "content": "请按格式提取论文内容。"},
+        ]
+        with llm_telemetry.track("file_extract", agent_id, "paper_ingest", "extraction_s1", s1_messages):
+            acquire_for_messages(s1_provider, s1_model, s1_messages, agent_id=agent_id)
+            t0 = time.monotonic()
+            try:
+                r1 = client.chat.completions.create(
+                    model=s1_model,
+                    messages=s1_messages,
+                    temperature=0.1,
+                )
+                extracted_text = (r1.choices[0].message.content or "").strip()
+            except Exception as e:
+                llm_telemetry.note_attempt(s1_provider, s1_model, False, time.monotonic() - t0, error=str(e))
+                return {"error": f"阶段1 提取失败: {e}", "metadata": {"title": path.name}}
+            llm_telemetry.note_attempt(s1_provider, s1_model, bool(extracted_text), time.monotonic() - t0, response=r1, output=extracted_text)
 
     # Stage 2: 格式化为 JSON（统一用 invoke_model，不依赖 client）
     extraction_s2 = get_prompt(agent_id, "extraction_s2", task_name="paper_ingest")
@@ -90,7 +396,10 @@ def extract_paper_structure(
         {"role": "system", "content": extraction_s2},
         {"role": "user", "content": f"请将以下内容转换为JSON：\n\n{extracted_text}"},
     ]
-    raw_json = invoke_model(agent_id, "paper_ingest", "extraction_s2", s2_messages, temperature=0)
+    raw_json = invoke_model(
+        agent_id, "paper_ingest", "extraction_s2", s2_messages,
+        temperature=0, on_delta=on_partial, stop_at_json_end=True,
+    )
     if not raw_json:
         return {"error": "阶段2 格式化失败", "metadata": {"title": path.name}}
     raw_json = raw_json.strip()
@@ -99,18 +408,15 @@ def extract_paper_structure(
         "metadata": {"title": path.name, "authors": "", "journal": "Unknown", "year": "", "abstract": "", "innovation": ""},
         "methodology": "", "keywords": [], "figures": [],
     }
-    if "```json" in raw_json:
-        raw_json = raw_json.split("```json")[1].split("```")[0].strip()
-    elif "```" in raw_json:
-        raw_json = raw_json.split("```")[1].split("```")[0].strip()
-    try:
-        data = json.loads(raw_json)
-        for k, v in data.items():
+    # 本地修复（围栏、截断、单引号等）失败时才发起定向修复调用，避免整段重跑阶段2
+    parsed = json_repair.parse_model_json(raw_json, "paper_structure")
+    if isinstance(parsed.data, dict):
+        for k, v in parsed.data.items():
             if isinstance(v, dict) and k in default_structure and isinstance(default_structure[k], dict):
                 default_structure[k].update(v)
             else:
                 default_structure[k] = v
-    except json.JSONDecodeError:
+    else:
         m = re.search(r"\[metadata\.title\]:\s*(.*)", extracted_text)
         if m:
             default_structure["metadata"]["title"] = m.group(1).strip()
@@ -147,6 +453,16 @@ def _build_summary_markdown(structured: Dict[str, Any], file_name: str) -> str:
     return "\n".join(lines)
 
 
+# 整页截图页数；逐图裁剪扫描全文
+_FIGURE_MAX_PAGES = 6
+_DEFAULT_FIGURE_POLICY = "pymupdf_per_figure"
+
+
+def _figure_policy(image_policy: Optional[str] = None) -> str:
+    """图像策略：显式传入优先，其次 .env 的 PAPER_FIGURE_POLICY，默认 _DEFAULT_FIGURE_POLICY。"""
+    return (image_policy or get_env("PAPER_FIGURE_POLICY") or _DEFAULT_FIGURE_POLICY).strip()
+
+
 def extract_figures(
     file_path: str,
     structured: Dict[str, Any],
@@ -154,62 +470,76 @@ def extract_figures(
     agent_id: str = "_default",
     record_id: str = "",
     *,
-    image_policy: str = "full_page",
+    image_policy: Optional[str] = None,
 ) -> List[Dict[str, Any]]:
     """
-    提取论文图像，按 paper_web 格式返回 figures。
-    首版使用整页截图；预留 image_policy 扩展：后续可支持 "pymupdf_per_figure" 用 PyMuPDF 精确提取图片并与文字/参数对应。
-    图像存于 storage_folder/figures/，image_path 含 record_id 便于回溯。
+    提取论文图像，按 paper_web 格式返回 figures。image_policy 为 None 时见 _figure_policy（默认逐图裁剪）。
+    - image_policy="pymupdf_per_figure"：figure_extract 扫描全文，按位图位置与矢量绘图裁剪每张图并配对图注；
+      未检测到图（或检测失败）时回退整页截图
+    - image_policy="full_page"：前 6 页整页截图，来自 page_raster_cache（同一 PDF 的同一页只渲染一次，多 agent 共享）
+    图像存于 storage_folder/figures/（硬链接引用共享缓存），image_path 含 record_id 便于回溯。
+    caption_source 标记图注来源（pdf / placeholder），入库后 figure_caption 后台阶段只替换占位图注。
+    渲染在常驻 PDF 进程池中并行，超时或崩溃的页不出现在结果中；链接到记录目录失败的图跳过。
     """
-    try:
-        import fitz
-    except ImportError:
-        return []
+    from . import page_raster_cache
 
+    image_policy = _figure_policy(image_policy)
     path = Path(file_path)
-    if not path.exists():
+    if not path.exists() or not page_raster_cache.PYMUPDF_AVAILABLE:
         return []
+    figures_dir = Path(storage_folder) / "figures"
+    prefix = f"{record_id}_" if record_id else ""
+    if image_policy == "pymupdf_per_figure":
+        from .figure_extract import extract_page_figures
+        try:
+            crops = extract_page_figures(str(path))
+        except Exception as e:
+            print(f"[PAPER_INGEST] 逐图裁剪失败，回退整页截图 | file={path.name} error={e}", flush=True)
+            crops = []
+        figures: List[Dict[str, Any]] = []
+        for c in crops:
+            img_name = f"{prefix}{c['filename']}"
+            try:
+                page_raster_cache.link_into(c["path"], figures_dir / img_name)
+            except OSError as e:
+                print(f"[PAPER_INGEST] 图像写入记录目录失败，跳过 | file={img_name} error={e}", flush=True)
+                continue
+            figures.append({
+                "id": f"fig-{c['page']}-{c['index']}",
+                "caption": c["caption"] or f"第 {c['page']} 页图 {c['index']}",
+                "caption_source": "pdf" if c["caption"] else "placeholder",
+                "label": c["label"],
+                "page": c["page"],
+                "bbox": c["bbox"],
+                "linked_parameters": [],
+                "image_path": f"figures/{img_name}",
+            })
+        if figures:
+            return figures
 
-    figures_dir = storage_folder / "figures"
-    figures_dir.mkdir(parents=True, exist_ok=True)
-    max_pages = 6
-
-    params = structured.get("parameters", []) or []
-    param_summaries = []
-    for p in params:
-        name = p.get("name", "")
-        symbol = p.get("symbol", "")
-        unit = p.get("unit", "")
-        meaning = p.get("meaning", "")
-        param_summaries.append(f"名称: {name}, 符号: {symbol}, 单位: {unit}, 含义: {meaning}")
-    param_summary_text = "\n".join(param_summaries) if param_summaries else "（当前未提取到任何参数）"
-
-    figures: List[Dict[str, Any]] = []
-    doc = fitz.open(str(path))
-
-    for page_index in range(min(len(doc), max_pages)):
-        page = doc[page_index]
-        img_name = f"page_{page_index + 1}.png"
-        if record_id:
-            img_name = f"{record_id}_{img_name}"
-        img_path = figures_dir / img_name
-        pix = page.get_pixmap(dpi=160)
-        pix.save(str(img_path))
-
-        rel_path = f"figures/{img_name}"
-        default_caption = f"第 {page_index + 1} 页整页快照"
-
-        # 扩展：image_policy=="pymupdf_per_figure" 时用 param_summary_text 调用 VLM 生成 caption/linked_parameters
+    try:
+        rasters = page_raster_cache.get_page_rasters(str(path), max_pages=_FIGURE_MAX_PAGES)
+    except Exception as e:
+        print(f"[PAPER_INGEST] 整页截图失败 | file={path.name} error={e}", flush=True)
+        return []
 
+    figures = []
+    for r in rasters:
+        page_num = r["page"]
+        img_name = f"{prefix}page_{page_num}{Path(r['path']).suffix}"
+        try:
+            page_raster_cache.link_into(r["path"], figures_dir / img_name)
+        except OSError as e:
+            print(f"[PAPER_INGEST] 图像写入记录目录失败，跳过 | file={img_name} error={e}", flush=True)
+            continue
         figures.append({
-            "id": f"page-{page_index + 1}",
-            "caption": default_caption,
-            "page": page_index + 1,
+            "id": f"page-{page_num}",
+            "caption": f"第 {page_num} 页整页快照",
+            "caption_source": "placeholder",
+            "page": page_num,
             "linked_parameters": [],
-            "image_path": rel_path,
+            "image_path": f"figures/{img_name}",
         })
-
-    doc.close()
     return figures
 
 
@@ -242,6 +572,8 @@ def paper_ingest_pdf(
     if not agent_ids:
         agent_ids = ["_default"]
 
+    image_policy = _figure_policy()
+    pages = _shared_pages(path)
     results: List[Dict[str, Any]] = []
     for aid in agent_ids:
         print(f"[PAPER_INGEST] 处理 agent | agent_id={aid}", flush=True)
@@ -254,14 +586,16 @@ def paper_ingest_pdf(
         if pre_extracted is not None and pre_extracted_for_agent == aid and not pre_extracted.get("error"):
             structured = dict(pre_extracted)
         else:
-            structured = extract_paper_structure(str(path), agent_id=aid, storage_dir=storage_dir)
+            # PAPER_S1_PAGE_STREAM 开启时 S1 逐页读文本流式提交（多 agent 共用一次解析，扫描件仍回退 file-extract）；
+            # 默认上传整份 PDF 走 file-extract
+            structured = extract_paper_structure(str(path), agent_id=aid, storage_dir=storage_dir, pages=pages)
         if structured.get("error"):
             print(f"[PAPER_INGEST] 提取失败 | agent_id={aid} error={structured.get('error')}", flush=True)
             results.append({"agent_id": aid, "record_id": record_id, "error": structured["error"], "structured": structured})
             continue
 
-        # 1b) 图像理解：提取整页截图，合并 figures（预留 pymupdf_per_figure 扩展）
-        figs = extract_figures(str(path), structured, folder, agent_id=aid, record_id=record_id)
+        # 1b) 图像理解：逐图裁剪或整页截图（PAPER_FIGURE_POLICY），合并 figures
+        figs = extract_figures(str(path), structured, folder, agent_id=aid, record_id=record_id, image_policy=image_policy)
         if figs:
             structured["figures"] = figs
 
@@ -6,8 +6,9 @@
 """
 
 import json
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
+from . import json_repair
 from .agent_config import (
     get_prompt,
     get_parameter_recommendation_system_prompt,
@@ -24,10 +25,12 @@ def run_parameter_recommendation(
     agent_ids: Optional[List[str]] = None,
     memory_context: str = "",
     relevant_forces: Optional[List[Dict[str, Any]]] = None,
+    on_partial: Optional[Callable[[str], None]] = None,
 ) -> Dict[str, Any]:
     """
     根据结构化论文与用户参数需求，结合多 agent 记忆与模板，返回参数推荐与力场推荐。
     user_params 应包含 expected_phenomena 及若干参数名 -> 描述/单位 等。
+    模型输出流式生成，JSON 闭合即停止；on_partial 逐段接收输出，供前端展示部分结果（收到 agent_config.STREAM_RESET 时清空已展示内容）。
     """
     print(f"[PARAM_REC] run_parameter_recommendation 入口 | user_id={user_id} agent_id={agent_id} agent_ids={agent_ids}", flush=True)
     if agent_ids is None and agent_id is None:
@@ -57,9 +60,19 @@ def run_parameter_recommendation(
     user_params_clean = {k: v for k, v in user_params.items() if k != "expected_phenomena"}
     expected_phenomena = (user_params.get("expected_phenomena") or "").strip() or "（无）"
 
-    # get_prompt 已统一实现 agent_specific + default_base 拼接，此处直接调用即可
-    prompt_template = get_prompt(aid, "prompt", task_name="parameter_recommendation") or ""
-    if not prompt_template:
+    # get_prompt 已统一实现 agent_specific + default_base 拼接，并按预编译模板填充变量
+    # （模板中的 JSON 示例花括号原样保留，不会再导致整段替换失败）
+    filled = get_prompt(
+        aid, "prompt", task_name="parameter_recommendation",
+        structured_paper_json=json.dumps(structured_paper, ensure_ascii=False, indent=2),
+        relevant_forces_json=json.dumps(relevant_forces, ensure_ascii=False, indent=2),
+        observed_phenomena=observed_phenomena,
+        simulation_results_description=simulation_results_description,
+        user_params_json=json.dumps(user_params_clean, ensure_ascii=False, indent=2),
+        expected_phenomena=expected_phenomena,
+        memory_context=memory_context,
+    )
+    if not filled:
         return {
             "error": "未找到 parameter_recommendation 模板",
             "agent_id_used": aid,
@@ -67,38 +80,25 @@ def run_parameter_recommendation(
             "force_field_recommendation": {},
         }
 
-    try:
-        filled = prompt_template.format(
-            structured_paper_json=json.dumps(structured_paper, ensure_ascii=False, indent=2),
-            relevant_forces_json=json.dumps(relevant_forces, ensure_ascii=False, indent=2),
-            observed_phenomena=observed_phenomena,
-            simulation_results_description=simulation_results_description,
-            user_params_json=json.dumps(user_params_clean, ensure_ascii=False, indent=2),
-            expected_phenomena=expected_phenomena,
-            memory_context=memory_context,
-        )
-    except KeyError:
-        filled = prompt_template.replace("{memory_context}", memory_context)
-
     system_prompt = get_parameter_recommendation_system_prompt(aid)
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": filled},
     ]
     print(f"[PARAM_REC] 调用模型 | agent_id={aid}", flush=True)
-    raw = invoke_model(aid, "parameter_recommendation", "main", messages, temperature=0.2)
+    raw = invoke_model(
+        aid, "parameter_recommendation", "main", messages,
+        temperature=0.2, on_delta=on_partial, stop_at_json_end=True,
+    )
     if not raw:
         print(f"[PARAM_REC] 失败 | 模型返回空", flush=True)
         return {"error": "模型调用失败", "agent_id_used": aid, "parameter_recommendations": {}, "force_field_recommendation": {}}
 
-    if "```json" in raw:
-        raw = raw.split("```json")[1].split("```")[0].strip()
-    elif "```" in raw:
-        raw = raw.split("```")[1].split("```")[0].strip()
-    try:
-        data = json.loads(raw)
+    parsed = json_repair.parse_model_json(raw, "parameter_recommendation")
+    if parsed.ok:
+        data = parsed.data
         rec_count = len(data.get("parameter_recommendations") or {})
-        print(f"[PARAM_REC] 完成 | agent_id={aid} parameter_recommendations_count={rec_count}", flush=True)
+        print(f"[PARAM_REC] 完成 | agent_id={aid} parameter_recommendations_count={rec_count} json={parsed.status}", flush=True)
         return {
             "agent_id_used": aid,
             "parameter_recommendations": data.get("parameter_recommendations", {}),
@@ -106,6 +106,6 @@ def run_parameter_recommendation(
             "raw_response": raw,
             "memory_context_used": len(memory_context),
         }
-    except json.JSONDecodeError:
-        print(f"[PARAM_REC] 失败 | JSON 解析错误 raw_preview={raw[:200] if raw else ''}", flush=True)
+    else:
+        print(f"[PARAM_REC] 失败 | JSON 解析错误 errors={parsed.errors[:3]} raw_preview={raw[:200] if raw else ''}", flush=True)
         return {"error": "模型返回非合法 JSON", "agent_id_used": aid, "raw_response": raw[:500], "parameter_recommendations": {}, "force_field_recommendation": {}}
@@ -3,31 +3,417 @@
 基于 PyMuPDF 的 PDF 原始提取 + LLM 公式校验。
 - 文本提取：页级纯文本（公式易出错，文字较稳）
 - 图像提取：保存图片并记录页码与位置
-- 公式校验：将提取文字交给大模型评估，重点修正公式部分
+- 流式读取：iter_pdf_pages 逐页产出文本 / 文本块 / 图片描述，供下游边读边处理（本进程内惰性解析，不经常驻进程池）；
+  iter_pdf_text_pages 只产出页文本，常驻进程池启用时按批在子进程中读取
+- 公式校验：本地定位数学密集片段，分批并发交给大模型修正后按偏移写回（或整段送校）
 参考：ex.py、pdf_code.py
 """
 
+import importlib.util
 import os
+import re
+import sys
+import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
-try:
+# 只探测是否安装，fitz（PyMuPDF）在首次提取时才导入
+PYMUPDF_AVAILABLE = importlib.util.find_spec("fitz") is not None
+
+
+# 页级并行：页数达到阈值且 workers > 1 时，把页码区间切成连续分段交给进程池，各进程按路径自行打开文档
+_DEFAULT_PARALLEL_MIN_PAGES = 32
+# 每个 worker 分到的分段数（分段略多于进程数，避免某段页面特别重时拖尾）
+_SEGMENTS_PER_WORKER = 4
+# iter_pdf_text_pages 经进程池读取时每批的页数
+_TEXT_BATCH_PAGES = 8
+# 嵌入图片：宽或高小于该像素数的跳过（图标、装饰线）；长边超过 max_dim 的缩小后写盘（0 不缩放）
+_DEFAULT_IMAGE_MIN_SIZE = 32
+_DEFAULT_IMAGE_MAX_DIM = 2048
+
+
+def _env_int(key: str, default: int) -> int:
+    from .config import get_env
+    try:
+        return int(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def _resolve_workers(workers: Optional[int]) -> int:
+    """workers 为 None 时读 PDF_EXTRACT_WORKERS（默认 1 即串行）；0 表示 CPU 核数。"""
+    n = _env_int("PDF_EXTRACT_WORKERS", 1) if workers is None else int(workers)
+    if n <= 0:
+        n = os.cpu_count() or 1
+    return max(1, n)
+
+
+def _page_ranges(total: int, parts: int) -> List[Tuple[int, int]]:
+    """把 [0, total) 切成至多 parts 段连续区间 [(start, end)]，各段页数相差不超过 1。"""
+    parts = max(1, min(parts, total))
+    size, extra = divmod(total, parts)
+    ranges: List[Tuple[int, int]] = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def _image_options() -> Dict[str, int]:
+    """图片去重/缩放参数在调用方进程解析后传给 worker（常驻子进程不会看到之后修改的环境变量）。"""
+    return {
+        "min_size": _env_int("PDF_IMAGE_MIN_SIZE", _DEFAULT_IMAGE_MIN_SIZE),
+        "max_dim": _env_int("PDF_IMAGE_MAX_DIM", _DEFAULT_IMAGE_MAX_DIM),
+    }
+
+
+def _encode_image(doc: Any, xref: int, base_image: Dict[str, Any], max_dim: int) -> Tuple[bytes, str, int, int, bool]:
+    """
+    返回 (写盘字节, 扩展名, 宽, 高, 是否缩放)。长边超过 max_dim（> 0）时按 2 的幂缩小并重新编码：
+    原图为 JPEG 时仍存 JPEG，其余存 PNG；解码失败时保留原始字节。
+    """
+    data, ext = base_image["image"], base_image.get("ext", "png")
+    width, height = base_image.get("width", 0), base_image.get("height", 0)
+    if max_dim <= 0 or max(width, height) <= max_dim:
+        return data, ext, width, height, False
+    import math
+    import fitz  # PyMuPDF
+
+    try:
+        pix = fitz.Pixmap(doc, xref)
+        if pix.alpha and ext in ("jpg", "jpeg"):
+            pix = fitz.Pixmap(pix, 0)
+        if pix.colorspace is not None and pix.colorspace.n not in (1, 3):
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        pix.shrink(max(1, math.ceil(math.log2(max(width, height) / max_dim))))
+        if ext in ("jpg", "jpeg") and not pix.alpha:
+            return pix.tobytes("jpeg", jpg_quality=85), "jpeg", pix.width, pix.height, True
+        return pix.tobytes("png"), "png", pix.width, pix.height, True
+    except Exception:
+        return data, ext, width, height, False
+
+
+def _extract_page_range(
+    file_path: str,
+    image_dir: Optional[str],
+    start: int,
+    end: int,
+    max_chars: Optional[int] = None,
+    image_opts: Optional[Dict[str, int]] = None,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, int]]:
+    """
+    提取 [start, end) 页的文本与图片（页码从 0 计）；串行与进程池 worker 共用。返回 (pages, images, 图片计数)。
+    image_dir 为 None 时只取文本、不写盘；max_chars 为累计页文本达到该长度后停止读后续页。
+    图片：同一 xref 只解码一次；文件按内容哈希命名，内容相同的图片（含其他分段/进程已写出的）复用同一文件；
+    宽或高小于 min_size 的跳过；长边超过 max_dim 的缩小后写盘。images 每次出现一条，重复出现指向同一文件。
+    """
+    import hashlib
     import fitz  # PyMuPDF
-    PYMUPDF_AVAILABLE = True
-except ImportError:
-    PYMUPDF_AVAILABLE = False
+
+    from .page_raster_cache import write_atomic
+
+    opts = image_opts or _image_options()
+    base_dir = Path(image_dir) if image_dir else None
+    pages: List[Dict[str, Any]] = []
+    images: List[Dict[str, Any]] = []
+    counts = {"skipped_small": 0, "written": 0, "bytes_written": 0, "downsampled": 0}
+    # xref -> 已写出的文件信息；None 表示该 xref 已被跳过
+    seen: Dict[int, Optional[Dict[str, Any]]] = {}
+    n_chars = 0
+    doc = fitz.open(file_path)
+    try:
+        for page_num in range(start, min(end, len(doc))):
+            if max_chars is not None and n_chars >= max_chars:
+                break
+            page = doc[page_num]
+            text = page.get_text()
+            pages.append({"page_num": page_num + 1, "text": text})
+            n_chars += len(text)
+            if base_dir is None:
+                continue
+
+            # 提取图片
+            image_list = page.get_images(full=True)
+            for img_index, img_info in enumerate(image_list):
+                xref = img_info[0]
+                if xref not in seen:
+                    if min(img_info[2], img_info[3]) < opts["min_size"]:
+                        seen[xref] = None
+                    else:
+                        try:
+                            base_image = doc.extract_image(xref)
+                            digest = hashlib.sha1(base_image["image"]).hexdigest()
+                            data, image_ext, width, height, shrunk = _encode_image(doc, xref, base_image, opts["max_dim"])
+                            filename = f"img_{digest[:16]}.{image_ext}"
+                            img_path = base_dir / filename
+                            if not img_path.exists():
+                                # 并行分段可能同时写同一哈希文件：先写临时文件再替换，避免留下半截文件
+                                write_atomic(str(img_path), data)
+                                counts["written"] += 1
+                                counts["bytes_written"] += len(data)
+                                counts["downsampled"] += int(shrunk)
+                            try:
+                                rel_path = img_path.resolve().relative_to(Path.cwd())
+                                image_path_str = str(rel_path).replace("\\", "/")
+                            except ValueError:
+                                image_path_str = str(img_path)
+                            seen[xref] = {
+                                "path": str(img_path),
+                                "image_path": image_path_str,
+                                "filename": filename,
+                                "sha1": digest,
+                                "width": width,
+                                "height": height,
+                                "bytes": len(data),
+                            }
+                        except Exception:
+                            seen[xref] = None
+                info = seen[xref]
+                if info is None:
+                    if min(img_info[2], img_info[3]) < opts["min_size"]:
+                        counts["skipped_small"] += 1
+                    continue
+                images.append({"page": page_num + 1, "index": img_index + 1, "xref": xref, **info})
+    finally:
+        doc.close()
+    return pages, images, counts
+
+
+def _merge_counts(total: Dict[str, int], part: Dict[str, int]) -> None:
+    for k, v in part.items():
+        total[k] = total.get(k, 0) + v
+
+
+def build_image_manifest(images: List[Dict[str, Any]], counts: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    按文件聚合图片出现记录：{"files": [{"filename", "path", "sha1", "width", "height", "bytes", "uses": [{"page", "index"}]}],
+    "occurrences", "unique", "duplicates", 以及 skipped_small / written / bytes_written / downsampled 计数}。
+    """
+    files: Dict[str, Dict[str, Any]] = {}
+    for img in images:
+        entry = files.get(img["filename"])
+        if entry is None:
+            entry = files[img["filename"]] = {
+                k: img.get(k) for k in ("filename", "path", "image_path", "sha1", "width", "height", "bytes")
+            }
+            entry["uses"] = []
+        entry["uses"].append({"page": img["page"], "index": img["index"]})
+    manifest: Dict[str, Any] = {
+        "files": list(files.values()),
+        "occurrences": len(images),
+        "unique": len(files),
+        "duplicates": len(images) - len(files),
+    }
+    manifest.update(counts or {})
+    return manifest
+
+
+def _extract_parallel(
+    file_path: str,
+    image_dir: str,
+    page_count: int,
+    workers: int,
+    image_opts: Dict[str, int],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, int]]:
+    """按页码分段提交进程池（spawn，避免 fork 继承 UI/遥测线程），结果按分段顺序合并即为页序。"""
+    import concurrent.futures
+    import multiprocessing
+
+    ranges = _page_ranges(page_count, workers * _SEGMENTS_PER_WORKER)
+    pages: List[Dict[str, Any]] = []
+    images: List[Dict[str, Any]] = []
+    counts: Dict[str, int] = {}
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(ranges)), mp_context=ctx) as pool:
+        futures = [
+            pool.submit(_extract_page_range, file_path, image_dir, start, end, None, image_opts) for start, end in ranges
+        ]
+        for fut in futures:
+            seg_pages, seg_images, seg_counts = fut.result()
+            pages.extend(seg_pages)
+            images.extend(seg_images)
+            _merge_counts(counts, seg_counts)
+    return pages, images, counts
+
+
+def _page_count(file_path: str) -> int:
+    import fitz  # PyMuPDF
+    with fitz.open(file_path) as doc:
+        return len(doc)
+
+
+def _extract_with_pool(
+    file_path: str,
+    image_dir: str,
+    image_opts: Dict[str, int],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, int], int]:
+    """
+    在常驻进程池（pdf_worker_pool）中提取：先在子进程读页数，页数达到阈值时按分段并行，否则整篇一个任务。
+    同一文档同时在执行的分段不超过 PDF_EXTRACT_WORKERS（且不超过池大小），其余子进程留给并发上传的其他文档；
+    分段完成一个再提交下一个。同一文档的任务共享 deadline；任一分段失败/超时即取消其余分段并抛出 PdfJobError。
+    返回 (pages, images, 图片计数, 参与进程数)。
+    """
+    import concurrent.futures
+
+    from . import pdf_worker_pool
+
+    pool = pdf_worker_pool.get_pool()
+    deadline = pool.new_deadline()
+    page_count = pool.submit(_page_count, file_path, deadline=deadline).result()
+    parallel = min(pool.size, _resolve_workers(None))
+    ranges = [(0, page_count)]
+    if parallel > 1 and page_count >= _env_int("PDF_EXTRACT_PARALLEL_MIN_PAGES", _DEFAULT_PARALLEL_MIN_PAGES):
+        ranges = _page_ranges(page_count, parallel * _SEGMENTS_PER_WORKER)
+    todo = iter(enumerate(ranges))
+    in_flight: Dict[concurrent.futures.Future, int] = {}
+    results: List[Any] = [None] * len(ranges)
+
+    def submit_next() -> None:
+        for idx, (start, end) in todo:
+            fut = pool.submit(_extract_page_range, file_path, image_dir, start, end, None, image_opts, deadline=deadline)
+            in_flight[fut] = idx
+            return
+
+    try:
+        for _ in range(parallel):
+            submit_next()
+        while in_flight:
+            done, _ = concurrent.futures.wait(list(in_flight), return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                results[in_flight.pop(fut)] = fut.result()
+                submit_next()
+    except Exception:
+        for fut in in_flight:
+            fut.cancel()
+        raise
+    pages: List[Dict[str, Any]] = []
+    images: List[Dict[str, Any]] = []
+    counts: Dict[str, int] = {}
+    for seg_pages, seg_images, seg_counts in results:
+        pages.extend(seg_pages)
+        images.extend(seg_images)
+        _merge_counts(counts, seg_counts)
+    return pages, images, counts, min(parallel, len(ranges))
+
+
+def iter_pdf_pages(
+    file_path: str,
+    *,
+    with_blocks: bool = True,
+    with_images: bool = False,
+    start_page: int = 1,
+    max_pages: Optional[int] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    逐页读取 PDF（本进程内，按需解析），每页产出：
+    {"page_num", "text", "blocks": [{"bbox", "text", "type"}], "images": [{"xref", "index", "width", "height", "bbox"}]}
+    - text 与 extract_raw_with_pymupdf 的页文本一致；blocks 为 PyMuPDF 文本块（type 0 文本 / 1 图片）
+    - images 只含描述，不解码、不落盘；with_images=False 时为空列表
+    - start_page 从 1 计；max_pages 限制产出页数。调用方提前停止迭代时文档随生成器关闭
+    文件不存在抛 FileNotFoundError，未安装 PyMuPDF 抛 ImportError。
+    """
+    if not PYMUPDF_AVAILABLE:
+        raise ImportError("PyMuPDF 未安装，请执行: pip install pymupdf")
+    if not Path(file_path).exists():
+        raise FileNotFoundError(f"文件不存在: {file_path}")
+    import fitz  # PyMuPDF
+
+    doc = fitz.open(file_path)
+    try:
+        end = len(doc) if max_pages is None else min(len(doc), start_page - 1 + max(0, max_pages))
+        for page_num in range(max(0, start_page - 1), end):
+            page = doc[page_num]
+            blocks: List[Dict[str, Any]] = []
+            if with_blocks:
+                for b in page.get_text("blocks"):
+                    blocks.append({"bbox": tuple(round(v, 2) for v in b[:4]), "text": b[4], "type": b[6]})
+            images: List[Dict[str, Any]] = []
+            if with_images:
+                for img_index, img_info in enumerate(page.get_images(full=True)):
+                    xref = img_info[0]
+                    try:
+                        rects = page.get_image_rects(xref)
+                    except Exception:
+                        rects = []
+                    images.append({
+                        "xref": xref,
+                        "index": img_index + 1,
+                        "width": img_info[2],
+                        "height": img_info[3],
+                        "bbox": tuple(round(v, 2) for v in rects[0]) if rects else None,
+                    })
+            yield {"page_num": page_num + 1, "text": page.get_text(), "blocks": blocks, "images": images}
+    finally:
+        doc.close()
+
+
+def iter_pdf_text_pages(file_path: str, *, max_pages: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    逐页产出 {"page_num", "text"}（与 iter_pdf_pages 的页文本一致）。
+    常驻进程池启用时每 _TEXT_BATCH_PAGES 页一个任务在子进程中读取，产出当前批时下一批已在读取；
+    每批单独计时（调用方处理页的耗时不计入解析时限），超时或崩溃抛 PdfJobError。未启用时在本进程内逐页读取。
+    文件不存在抛 FileNotFoundError，未安装 PyMuPDF 抛 ImportError。
+    """
+    from .pdf_worker_pool import get_pool, pool_enabled
+
+    if not pool_enabled():
+        for page in iter_pdf_pages(file_path, with_blocks=False, max_pages=max_pages):
+            yield {"page_num": page["page_num"], "text": page["text"]}
+        return
+    if not PYMUPDF_AVAILABLE:
+        raise ImportError("PyMuPDF 未安装，请执行: pip install pymupdf")
+    if not Path(file_path).exists():
+        raise FileNotFoundError(f"文件不存在: {file_path}")
+    pool = get_pool()
+    total = pool.run(_page_count, file_path)
+    if max_pages is not None:
+        total = min(total, max(0, max_pages))
+    starts = iter(range(0, total, _TEXT_BATCH_PAGES))
+
+    def submit_next():
+        for start in starts:
+            end = min(start + _TEXT_BATCH_PAGES, total)
+            return pool.submit(_extract_page_range, file_path, None, start, end, deadline=pool.new_deadline())
+        return None
+
+    pending = submit_next()
+    try:
+        while pending is not None:
+            current, pending = pending, submit_next()
+            pages, _, _ = current.result()
+            yield from pages
+    finally:
+        if pending is not None:
+            pending.cancel()
 
 
 def extract_raw_with_pymupdf(
     file_path: str,
     output_image_dir: Optional[Path] = None,
+    workers: Optional[int] = None,
+    text_only: bool = False,
+    max_pages: Optional[int] = None,
+    max_chars: Optional[int] = None,
 ) -> Dict[str, Any]:
     """
     使用 PyMuPDF 提取 PDF 的原始文本与图像。
+    快速路径：text_only / max_pages / max_chars 任一给出时串行读取前若干页并提前停止，不分段；
+    workers 为 None 且常驻进程池启用时作为单个任务在子进程中执行，否则在本进程内执行；
+    text_only=True 时不提取图片、不创建图片目录（意图识别等只需开头文本的场景）；raw_text 截断到 max_chars。
+    workers 为 None 且常驻进程池启用（PDF_POOL_SIZE > 0）时，在 pdf_worker_pool 子进程中提取（超时/崩溃隔离，
+    页数达到阈值时分段并行，同一文档最多占用 PDF_EXTRACT_WORKERS 个子进程）；否则在本进程内执行，
+    workers 为进程数（None 读 PDF_EXTRACT_WORKERS，默认 1 串行；0 为 CPU 核数）。
+    页数不少于 PDF_EXTRACT_PARALLEL_MIN_PAGES（默认 32）时按页码分段并行，结果按页序合并，与串行输出一致；
+    临时进程池不可用时回退串行。
     返回：
     - raw_text: 全文（按页拼接）
     - pages: [{"page_num": int, "text": str}]
-    - images: [{"page": int, "path": str, "filename": str, "index": int}]
+    - images: [{"page": int, "index": int, "xref": int, "path": str, "filename": str, "sha1": str, "width", "height", "bytes"}]，
+      每次出现一条；同一图片（同 xref 或内容哈希相同）在多处出现时指向同一文件
+    - image_manifest: build_image_manifest 的结果（按文件聚合的 uses、去重数、跳过的小图数、写盘字节数）
+    - stats: {"pages", "workers", "mode"（serial / parallel / pool / text）, "elapsed_s", "pages_per_sec"}
     """
     if not PYMUPDF_AVAILABLE:
         return {"error": "PyMuPDF 未安装", "raw_text": "", "pages": [], "images": []}
@@ -38,76 +424,339 @@ def extract_raw_with_pymupdf(
     if path.suffix.lower() != ".pdf":
         return {"error": "仅支持 PDF", "raw_text": "", "pages": [], "images": []}
 
-    base_dir = output_image_dir or (path.parent / "extracted_images")
-    base_dir = Path(base_dir)
-    base_dir.mkdir(parents=True, exist_ok=True)
+    t0 = time.monotonic()
+    image_opts = _image_options()
+    base_dir = None if text_only else Path(output_image_dir or (path.parent / "extracted_images"))
+    if base_dir is not None:
+        base_dir.mkdir(parents=True, exist_ok=True)
 
-    pages: List[Dict[str, Any]] = []
-    images: List[Dict[str, Any]] = []
-    full_parts: List[str] = []
+    from .pdf_worker_pool import PdfJobError, get_pool, pool_enabled
 
-    try:
-        doc = fitz.open(str(path))
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            pages.append({"page_num": page_num + 1, "text": text})
-            full_parts.append(f"--- 第 {page_num + 1} 页 ---\n{text}")
+    if text_only or max_pages is not None or max_chars is not None:
+        end = max(0, max_pages) if max_pages is not None else sys.maxsize
+        args = (str(path), str(base_dir) if base_dir else None, 0, end, max_chars, image_opts)
+        try:
+            if workers is None and pool_enabled():
+                pages, images, counts = get_pool().run(_extract_page_range, *args)
+            else:
+                pages, images, counts = _extract_page_range(*args)
+        except Exception as e:
+            return {"error": str(e), "raw_text": "", "pages": [], "images": []}
+        out = _build_result(path, pages, images, counts, "text" if text_only else "serial", 1, t0)
+        if max_chars is not None:
+            out["raw_text"] = out["raw_text"][:max_chars]
+        return out
 
-            # 提取图片
-            image_list = page.get_images(full=True)
-            for img_index, img_info in enumerate(image_list):
-                xref = img_info[0]
-                try:
-                    base_image = doc.extract_image(xref)
-                    image_bytes = base_image["image"]
-                    image_ext = base_image.get("ext", "png")
-                    filename = f"page_{page_num + 1}_img_{img_index + 1}.{image_ext}"
-                    img_path = base_dir / filename
-                    img_path.write_bytes(image_bytes)
-                    try:
-                        rel_path = img_path.resolve().relative_to(Path.cwd())
-                        image_path_str = str(rel_path).replace("\\", "/")
-                    except ValueError:
-                        image_path_str = str(img_path)
-                    images.append({
-                        "page": page_num + 1,
-                        "path": str(img_path),
-                        "image_path": image_path_str,
-                        "filename": filename,
-                        "index": img_index + 1,
-                    })
-                except Exception:
-                    pass
-        doc.close()
+    if workers is None and pool_enabled():
+        try:
+            pages, images, counts, n_workers = _extract_with_pool(str(path), str(base_dir), image_opts)
+        except PdfJobError as e:
+            print(f"[PDF_EXTRACT] 进程池提取失败 | file={path.name} error={e}", flush=True)
+            return {"error": str(e), "raw_text": "", "pages": [], "images": []}
+        return _build_result(path, pages, images, counts, "pool", n_workers, t0)
+
+    n_workers = _resolve_workers(workers)
+    try:
+        page_count = _page_count(str(path))
+        mode = "serial"
+        if n_workers > 1 and page_count >= _env_int("PDF_EXTRACT_PARALLEL_MIN_PAGES", _DEFAULT_PARALLEL_MIN_PAGES):
+            try:
+                pages, images, counts = _extract_parallel(str(path), str(base_dir), page_count, n_workers, image_opts)
+                mode = "parallel"
+            except Exception as e:
+                print(f"[PDF_EXTRACT] 进程池提取失败，回退串行 | file={path.name} error={e}", flush=True)
+        if mode == "serial":
+            n_workers = 1
+            pages, images, counts = _extract_page_range(str(path), str(base_dir), 0, page_count, None, image_opts)
     except Exception as e:
         return {"error": str(e), "raw_text": "", "pages": [], "images": []}
+    return _build_result(path, pages, images, counts, mode, n_workers, t0)
+
+
+def _build_result(
+    path: Path,
+    pages: List[Dict[str, Any]],
+    images: List[Dict[str, Any]],
+    counts: Dict[str, int],
+    mode: str,
+    n_workers: int,
+    t0: float,
+) -> Dict[str, Any]:
+    elapsed = time.monotonic() - t0
+    stats = {
+        "pages": len(pages),
+        "workers": n_workers,
+        "mode": mode,
+        "elapsed_s": round(elapsed, 3),
+        "pages_per_sec": round(len(pages) / elapsed, 1) if elapsed > 0 else None,
+    }
+    print(
+        f"[PDF_EXTRACT] PyMuPDF 提取完成 | file={path.name} pages={stats['pages']} mode={mode} "
+        f"workers={n_workers} elapsed={stats['elapsed_s']}s pages/s={stats['pages_per_sec']} "
+        f"images={len(images)} files={len({i['filename'] for i in images})} "
+        f"skipped_small={counts.get('skipped_small', 0)} bytes_written={counts.get('bytes_written', 0)}",
+        flush=True,
+    )
+    raw_text = "\n\n".join(f"--- 第 {p['page_num']} 页 ---\n{p['text']}" for p in pages)
+    manifest = build_image_manifest(images, counts)
+    return {"raw_text": raw_text, "pages": pages, "images": images, "image_manifest": manifest, "stats": stats}
+
+
+# ---------- 公式校验：本地定位数学密集片段，仅送校这些片段 ----------
+
+# 强数学符号：希腊字母、运算/关系符号、上下标数字、数学字母数字区（U+1D400–U+1D7FF）
+_MATH_STRONG = set(
+    "∑∏∫∮∂∇√∞∝≈≠≡≤≥≪≫±∓×÷·∘⊗⊕∈∉⊂⊆⊃∪∩∀∃∧∨¬→←↔⇒⇔↦⟨⟩‖ℏℓℝℂℕℤ†∗′″"
+    "⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿ₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎"
+    "ϵϑϕϖϱς"
+)
+# 弱数学符号：正文中也常见，按半个计
+_MATH_WEAK = set("=+<>^_/|~")
+# 数学字体（TeX CM/AMS 数学字体、Symbol、STIX/Cambria Math 等）
+_MATH_FONT_RE = re.compile(r"CMMI|CMSY|CMEX|CMBSY|MSAM|MSBM|EUFM|EUSM|RSFS|Math|Symbol|STIX|Euclid|wasy", re.IGNORECASE)
+_PAGE_MARKER_LINE_RE = re.compile(r"^--- 第 \d+ 页 ---$")
+_SPAN_OUT_RE = re.compile(r"<<<SPAN (\d+)>>>\n?(.*?)\n?<<<END \1>>>", re.DOTALL)
+
+_DEFAULT_VERIFY_MODE = "spans"
+_DEFAULT_VERIFY_BATCH_CHARS = 4000
+_DEFAULT_VERIFY_MAX_PARALLEL = 4
 
-    raw_text = "\n\n".join(full_parts)
-    return {"raw_text": raw_text, "pages": pages, "images": images}
+
+def _math_weight(line: str) -> Tuple[float, int]:
+    """返回 (数学符号加权计数, 非空白字符数)。"""
+    weight = 0.0
+    n = 0
+    for ch in line:
+        if ch.isspace():
+            continue
+        n += 1
+        if ch in _MATH_STRONG or "\u0391" <= ch <= "\u03c9" or "\U0001d400" <= ch <= "\U0001d7ff":
+            weight += 1.0
+        elif ch in _MATH_WEAK:
+            weight += 0.5
+    return weight, n
+
+
+def _math_font_lines(file_path: str, min_ratio: float = 0.3) -> List[str]:
+    """
+    逐页读取 PyMuPDF 字体信息，返回以数学字体或上标（flags bit 0）为主的行文本（去首尾空白）：
+    这类 span 的非空白字符占该行的比例 ≥ min_ratio（正文里零星的行内符号、脚注标记不算）。
+    """
+    import fitz  # PyMuPDF
+
+    lines: List[str] = []
+    with fitz.open(file_path) as doc:
+        for page in doc:
+            for block in page.get_text("dict").get("blocks", []):
+                for line in block.get("lines", []):
+                    total = math = 0
+                    for sp in line.get("spans", []):
+                        n = sum(1 for ch in sp.get("text", "") if not ch.isspace())
+                        total += n
+                        if _MATH_FONT_RE.search(sp.get("font", "")) or sp.get("flags", 0) & 1:
+                            math += n
+                    if total and math / total >= min_ratio:
+                        text = "".join(sp.get("text", "") for sp in line.get("spans", [])).strip()
+                        if text:
+                            lines.append(text)
+    return lines
+
+
+def find_math_spans(
+    text: str,
+    math_lines: Optional[Iterable[str]] = None,
+    min_density: float = 0.12,
+    min_weight: float = 2.0,
+    max_gap_lines: int = 1,
+    max_span_chars: int = _DEFAULT_VERIFY_BATCH_CHARS,
+) -> List[Tuple[int, int]]:
+    """
+    在本地定位数学密集片段，返回按出现顺序排列、互不重叠的 [(start, end)] 字符偏移（按整行）。
+    - 行的数学符号加权计数 ≥ min_weight 且密度 ≥ min_density，或该行出现在 math_lines（数学字体行）中即记为数学行
+    - 相隔不超过 max_gap_lines 行的数学行合并为一个片段；片段超过 max_span_chars 时按行切开
+    - 页标记行（--- 第 N 页 ---）不计入
+    """
+    font_lines = {ln for ln in (math_lines or ()) if ln}
+    # 每行的 [start, end)（不含换行符）
+    bounds: List[Tuple[int, int]] = []
+    pos = 0
+    for line in text.split("\n"):
+        bounds.append((pos, pos + len(line)))
+        pos += len(line) + 1
+
+    flagged: List[int] = []
+    for idx, (a, b) in enumerate(bounds):
+        line = text[a:b]
+        stripped = line.strip()
+        if not stripped or _PAGE_MARKER_LINE_RE.match(stripped):
+            continue
+        weight, n = _math_weight(stripped)
+        if (weight >= min_weight and weight / max(1, n) >= min_density) or stripped in font_lines:
+            flagged.append(idx)
+
+    spans: List[Tuple[int, int]] = []
+    group: List[int] = []
+
+    def flush() -> None:
+        if not group:
+            return
+        start = bounds[group[0]][0]
+        for idx in group:
+            a, b = bounds[idx]
+            if b - start > max_span_chars and a > start:
+                spans.append((start, bounds[idx - 1][1]))
+                start = a
+        spans.append((start, bounds[group[-1]][1]))
+        group.clear()
+
+    for idx in flagged:
+        if group and (idx - group[-1] - 1 > max_gap_lines or _PAGE_MARKER_LINE_RE.match(text[slice(*bounds[idx - 1])].strip())):
+            flush()
+        if group:
+            group.extend(range(group[-1] + 1, idx))
+        group.append(idx)
+    flush()
+    return spans
+
+
+def _batch_spans(spans: List[Tuple[int, int]], batch_chars: int) -> List[List[int]]:
+    """把片段下标按累计长度装入批次（保持顺序），单个超长片段独占一批。"""
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    size = 0
+    for i, (a, b) in enumerate(spans):
+        if cur and size + (b - a) > batch_chars:
+            batches.append(cur)
+            cur, size = [], 0
+        cur.append(i)
+        size += b - a
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def _verify_spans(
+    raw_text: str,
+    agent_id: str,
+    file_path: Optional[str],
+    t0: float,
+) -> Dict[str, Any]:
+    """spans 模式：本地定位数学片段，分批并发送校，按偏移把修正写回原文；未返回或异常的片段保留原文。"""
+    import concurrent.futures
+    import contextvars
+
+    from .agent_config import invoke_model
+    from .config_registry import get_config
+
+    math_lines: List[str] = []
+    if file_path and PYMUPDF_AVAILABLE and Path(file_path).exists():
+        from .pdf_worker_pool import run_isolated
+        math_lines = run_isolated(_math_font_lines, str(file_path), default=[], label="math_font_lines") or []
+
+    batch_chars = _env_int("FORMULA_VERIFY_BATCH_CHARS", _DEFAULT_VERIFY_BATCH_CHARS)
+    spans = find_math_spans(raw_text, math_lines=math_lines, max_span_chars=batch_chars)
+    batches = _batch_spans(spans, batch_chars)
+    stats: Dict[str, Any] = {
+        "mode": "spans",
+        "spans": len(spans),
+        "math_chars": sum(b - a for a, b in spans),
+        "text_chars": len(raw_text),
+        "batches": len(batches),
+        "failed_batches": 0,
+    }
+    if not spans:
+        stats["elapsed_s"] = round(time.monotonic() - t0, 3)
+        return {"corrected_text": raw_text, "error": None, "stats": stats}
+
+    system = get_config().root_prompt("formula_verification_spans.txt").strip() or (
+        "你是学术文档解析专家。只修正每个片段中的公式与数学符号，保持 <<<SPAN n>>> / <<<END n>>> 标记，逐段输出。"
+    )
+
+    def run_batch(indices: List[int]) -> Dict[int, str]:
+        body = "\n\n".join(
+            f"<<<SPAN {i}>>>\n{raw_text[spans[i][0]:spans[i][1]]}\n<<<END {i}>>>" for i in indices
+        )
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": f"请校验并修正以下从 PDF 提取的公式片段，按原标记逐段输出：\n\n{body}"},
+        ]
+        out = invoke_model(agent_id, "paper_ingest", "formula_verification", messages, temperature=0.1)
+        if not out:
+            raise RuntimeError("模型调用失败")
+        wanted = set(indices)
+        return {int(m.group(1)): m.group(2) for m in _SPAN_OUT_RE.finditer(out) if int(m.group(1)) in wanted}
+
+    corrections: Dict[int, str] = {}
+    max_parallel = max(1, _env_int("FORMULA_VERIFY_MAX_PARALLEL", _DEFAULT_VERIFY_MAX_PARALLEL))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_parallel, len(batches)), thread_name_prefix="formula-verify") as pool:
+        futures = [pool.submit(contextvars.copy_context().run, run_batch, b) for b in batches]
+        for fut in futures:
+            try:
+                corrections.update(fut.result())
+            except Exception as e:
+                stats["failed_batches"] += 1
+                print(f"[PDF_EXTRACT] 公式校验批次失败 | error={e}", flush=True)
+
+    # 从后往前按偏移替换，前面片段的偏移不受影响；长度异常（模型改写了大段内容）的修正丢弃
+    parts: List[str] = []
+    cursor = len(raw_text)
+    applied = 0
+    for i in range(len(spans) - 1, -1, -1):
+        a, b = spans[i]
+        fixed = corrections.get(i)
+        original = raw_text[a:b]
+        if fixed is None or not (0.5 * len(original) - 20 <= len(fixed) <= 2 * len(original) + 50):
+            fixed = original
+        elif fixed != original:
+            applied += 1
+        parts.append(raw_text[b:cursor])
+        parts.append(fixed)
+        cursor = a
+    parts.append(raw_text[:cursor])
+    stats["corrected_spans"] = applied
+    stats["elapsed_s"] = round(time.monotonic() - t0, 3)
+    print(
+        f"[PDF_EXTRACT] 公式片段校验完成 | spans={len(spans)} math_chars={stats['math_chars']}/{len(raw_text)} "
+        f"batches={len(batches)} failed={stats['failed_batches']} corrected={applied} elapsed={stats['elapsed_s']}s",
+        flush=True,
+    )
+    error = "部分批次模型调用失败，对应片段保留原文" if stats["failed_batches"] else None
+    return {"corrected_text": "".join(reversed(parts)), "error": error, "stats": stats}
 
 
 def verify_formulas_with_llm(
     raw_text: str,
     agent_id: str = "_default",
     max_chars: int = 15000,
+    mode: Optional[str] = None,
+    file_path: Optional[str] = None,
 ) -> Dict[str, Any]:
     """
     将 PyMuPDF 提取的文本交给大模型做公式部分校验与修正。
     文字不易出错，公式易出错；模型评估后仅修正公式部分，返回修正后的全文。
+    - mode="spans"（默认，FORMULA_VERIFY_MODE）：本地按符号密度与数学字体（需 file_path）定位数学片段，
+      分批（FORMULA_VERIFY_BATCH_CHARS）并发（FORMULA_VERIFY_MAX_PARALLEL）只送校这些片段，按偏移写回；覆盖全文，
+      输出 token 随公式量而非页数增长
+    - mode="full"：整段送校前 max_chars 字符并由模型重写，超出部分不校验
     """
-    from .agent_config import invoke_model
-
     if not raw_text or not raw_text.strip():
         return {"corrected_text": "", "error": None}
 
+    from .config import get_env
+
+    t0 = time.monotonic()
+    mode = (mode or get_env("FORMULA_VERIFY_MODE") or _DEFAULT_VERIFY_MODE).strip().lower()
+    if mode == "spans":
+        return _verify_spans(raw_text, agent_id, file_path, t0)
+
+    from .agent_config import invoke_model
+
     text_to_verify = raw_text[:max_chars]
     if len(raw_text) > max_chars:
         text_to_verify += "\n\n[以下内容已截断，未参与校验]"
 
-    from .config import CONFIG_PROMPTS_DIR
-    prompt_path = CONFIG_PROMPTS_DIR / "formula_verification.txt"
-    system = prompt_path.read_text(encoding="utf-8").strip() if prompt_path.exists() else (
+    from .config_registry import get_config
+    system = get_config().root_prompt("formula_verification.txt").strip() or (
         "你是学术文档解析专家。评估并修正 PDF 提取文本中的公式部分，只输出修正后的完整文本。"
     )
 
@@ -0,0 +1,337 @@
+# backend/pdf_worker_pool.py
+"""
+常驻 PDF 提取进程池：PyMuPDF 解析在独立进程中执行，畸形 PDF 卡死或崩溃不影响 Gradio 进程。
+- 每个槽位一条调度线程 + 一个 spawn 子进程，任务经共享队列分发，多用户并发上传并行处理
+- 单文档超时：同一文档的所有任务共享时限，从该文档首个任务开始执行时起算（排队时间不计），
+  超时即杀掉执行中的子进程并重启（PDF_POOL_TIMEOUT）
+- 排队超时：任务在队列中等待超过 PDF_POOL_QUEUE_TIMEOUT 时不再执行（池长期占满时尽早报错）
+- 内存上限：子进程启动时设置 RLIMIT_AS（PDF_POOL_MEMORY_MB，仅类 Unix），超限以 MemoryError 结束任务并回收进程
+- 回收：子进程处理 PDF_POOL_MAX_JOBS 个任务后重启，释放 PyMuPDF 累积的内存
+- 池大小 PDF_POOL_SIZE（默认 2，0 关闭，关闭时调用方在本进程内执行）
+- 任务函数须为模块级函数（按引用 pickle）；子进程内 in_worker() 为 True，避免嵌套提交
+- 例外：pdf_extract.iter_pdf_pages 是本进程内的惰性生成器（文档在迭代期间保持打开、调用方可随时停止），不经进程池；
+  需要隔离的读取改用 extract_raw_with_pymupdf（含 text_only / max_pages 快速路径）或 run_isolated
+"""
+
+import atexit
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from .config import get_env
+
+_DEFAULT_SIZE = 2
+_DEFAULT_TIMEOUT = 120.0
+_DEFAULT_QUEUE_TIMEOUT = 600.0
+_DEFAULT_MEMORY_MB = 2048
+_DEFAULT_MAX_JOBS = 50
+
+# 子进程内置为 True
+_IN_WORKER = False
+
+
+class PdfJobError(RuntimeError):
+    """任务在子进程中失败（异常、内存超限或进程崩溃）。"""
+
+
+class PdfJobTimeout(PdfJobError):
+    """任务超过所属文档的时限，或排队超过 PDF_POOL_QUEUE_TIMEOUT。"""
+
+
+def _env_number(key: str, default: float) -> float:
+    try:
+        return float(get_env(key) or default)
+    except ValueError:
+        return default
+
+
+def in_worker() -> bool:
+    return _IN_WORKER
+
+
+def _worker_main(conn: Any, memory_mb: int) -> None:
+    """子进程入口：设置内存上限后循环执行 (fn, args, kwargs)，收到 None 退出。"""
+    global _IN_WORKER
+    _IN_WORKER = True
+    if memory_mb > 0:
+        try:
+            import resource
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        fn, args, kwargs = job
+        try:
+            conn.send(("ok", fn(*args, **kwargs)))
+        except MemoryError:
+            conn.send(("memory", "内存超限"))
+            return
+        except BaseException as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class DocumentDeadline:
+    """一个文档的执行时限：首个任务开始执行时起算 timeout 秒，同一文档的后续任务共用。"""
+
+    __slots__ = ("timeout", "started", "_lock")
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """开始计时（若尚未开始）并返回剩余秒数。"""
+        with self._lock:
+            if self.started is None:
+                self.started = time.monotonic()
+            return self.started + self.timeout - time.monotonic()
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "deadline", "queued_at", "future")
+
+    def __init__(self, fn: Callable[..., Any], args: tuple, kwargs: Dict[str, Any], deadline: DocumentDeadline):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = deadline
+        self.queued_at = time.monotonic()
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class _Slot:
+    """一个槽位：调度线程独占一个子进程，串行执行队列中的任务。"""
+
+    def __init__(self, pool: "PdfWorkerPool", index: int):
+        self.pool = pool
+        self.index = index
+        self.proc: Optional[multiprocessing.process.BaseProcess] = None
+        self.conn: Any = None
+        self.jobs_done = 0
+        self.thread = threading.Thread(target=self._loop, name=f"pdf-pool-{index}", daemon=True)
+
+    def _start(self) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=_worker_main, args=(child_conn, self.pool.memory_mb), daemon=True, name=f"pdf-worker-{self.index}")
+        proc.start()
+        child_conn.close()
+        self.proc, self.conn, self.jobs_done = proc, parent_conn, 0
+        self.pool._count("started")
+
+    def _stop(self, kill: bool = False) -> None:
+        proc, conn = self.proc, self.conn
+        self.proc, self.conn = None, None
+        if proc is None:
+            return
+        if not kill:
+            try:
+                conn.send(None)
+                proc.join(timeout=2.0)
+            except Exception:
+                pass
+        if proc.is_alive():
+            proc.kill()
+            proc.join(timeout=2.0)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _loop(self) -> None:
+        while True:
+            job = self.pool._queue.get()
+            if job is None:
+                self._stop()
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            self._run(job)
+
+    def _run(self, job: _Job) -> None:
+        waited = time.monotonic() - job.queued_at
+        if waited > self.pool.queue_timeout:
+            self.pool._count("queue_timeouts")
+            job.future.set_exception(PdfJobTimeout(f"PDF 任务排队超时（{waited:.0f}s > {self.pool.queue_timeout:.0f}s）"))
+            return
+        remaining = job.deadline.remaining()
+        if remaining <= 0:
+            self.pool._count("timeouts")
+            job.future.set_exception(PdfJobTimeout(f"PDF 文档超时（>{job.deadline.timeout:.0f}s），跳过剩余任务"))
+            return
+        if self.proc is None or not self.proc.is_alive():
+            self._stop(kill=True)
+            self._start()
+        try:
+            self.conn.send((job.fn, job.args, job.kwargs))
+            if not self.conn.poll(remaining):
+                self._stop(kill=True)
+                self.pool._count("timeouts")
+                job.future.set_exception(PdfJobTimeout(f"PDF 任务超时（>{job.deadline.timeout:.0f}s），已终止子进程"))
+                return
+            status, payload = self.conn.recv()
+        except (EOFError, OSError, BrokenPipeError) as e:
+            self._stop(kill=True)
+            self.pool._count("crashes")
+            job.future.set_exception(PdfJobError(f"PDF 子进程异常退出: {type(e).__name__}"))
+            return
+        self.jobs_done += 1
+        if status == "ok":
+            self.pool._count("completed")
+            job.future.set_result(payload)
+        else:
+            self.pool._count("memory_errors" if status == "memory" else "errors")
+            job.future.set_exception(PdfJobError(payload))
+        if status == "memory" or self.jobs_done >= self.pool.max_jobs:
+            self._stop(kill=status == "memory")
+            self.pool._count("recycled")
+
+
+class PdfWorkerPool:
+    """
+    常驻子进程池。submit(fn, *args, deadline=...) 返回 concurrent.futures.Future；
+    run(fn, *args) 阻塞等待结果。子进程惰性启动，首个任务到达时才 spawn。
+    """
+
+    def __init__(
+        self,
+        size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        memory_mb: Optional[int] = None,
+        max_jobs: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+    ):
+        self.size = max(1, int(size if size is not None else _env_number("PDF_POOL_SIZE", _DEFAULT_SIZE)))
+        self.timeout = float(timeout if timeout is not None else _env_number("PDF_POOL_TIMEOUT", _DEFAULT_TIMEOUT))
+        self.memory_mb = int(memory_mb if memory_mb is not None else _env_number("PDF_POOL_MEMORY_MB", _DEFAULT_MEMORY_MB))
+        self.max_jobs = max(1, int(max_jobs if max_jobs is not None else _env_number("PDF_POOL_MAX_JOBS", _DEFAULT_MAX_JOBS)))
+        self.queue_timeout = float(
+            queue_timeout if queue_timeout is not None else _env_number("PDF_POOL_QUEUE_TIMEOUT", _DEFAULT_QUEUE_TIMEOUT)
+        )
+        self._queue: "queue.Queue[Optional[_Job]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._slots: List[_Slot] = []
+        self._closed = False
+        self._stats: Dict[str, int] = {k: 0 for k in ("submitted", "completed", "errors", "timeouts", "queue_timeouts", "crashes", "memory_errors", "started", "recycled")}
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def _ensure_slots(self) -> None:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("PdfWorkerPool 已关闭")
+            if self._slots:
+                return
+            self._slots = [_Slot(self, i) for i in range(self.size)]
+        for slot in self._slots:
+            slot.thread.start()
+
+    def new_deadline(self, timeout: Optional[float] = None) -> DocumentDeadline:
+        """为一个文档生成时限（首个任务开始执行时起算）；同一文档的多个任务共用。"""
+        return DocumentDeadline(self.timeout if timeout is None else timeout)
+
+    def submit(
+        self, fn: Callable[..., Any], *args: Any, deadline: Optional[DocumentDeadline] = None, **kwargs: Any
+    ) -> concurrent.futures.Future:
+        self._ensure_slots()
+        job = _Job(fn, args, kwargs, deadline if deadline is not None else self.new_deadline())
+        self._count("submitted")
+        self._queue.put(job)
+        return job.future
+
+    def run(self, fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> Any:
+        """在子进程执行 fn 并等待结果；超时抛 PdfJobTimeout，子进程失败抛 PdfJobError。"""
+        return self.submit(fn, *args, deadline=self.new_deadline(timeout), **kwargs).result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            snap: Dict[str, Any] = dict(self._stats)
+        snap.update({
+            "size": self.size,
+            "timeout": self.timeout,
+            "queue_timeout": self.queue_timeout,
+            "memory_mb": self.memory_mb,
+            "max_jobs": self.max_jobs,
+            "queued": self._queue.qsize(),
+            "alive": sum(1 for s in self._slots if s.proc is not None and s.proc.is_alive()),
+        })
+        return snap
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            slots = list(self._slots)
+        for _ in slots:
+            self._queue.put(None)
+        for slot in slots:
+            slot.thread.join(timeout=5.0)
+
+
+_pool: Optional[PdfWorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def pool_enabled() -> bool:
+    """子进程内始终 False（不嵌套）；否则 PDF_POOL_SIZE > 0 时启用。"""
+    return not _IN_WORKER and _env_number("PDF_POOL_SIZE", _DEFAULT_SIZE) > 0
+
+
+def get_pool() -> PdfWorkerPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PdfWorkerPool()
+        return _pool
+
+
+def set_pool(pool: Optional[PdfWorkerPool]) -> None:
+    """替换全局进程池（测试用）；旧池被关闭。"""
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, pool
+    if old is not None and old is not pool:
+        old.close()
+
+
+def stats() -> Dict[str, Any]:
+    """全局进程池统计；尚未创建时返回空字典（不会为统计而启动子进程）。"""
+    return _pool.stats() if _pool is not None else {}
+
+
+def run_isolated(fn: Callable[..., Any], *args: Any, default: Any = None, label: str = "", **kwargs: Any) -> Any:
+    """
+    启用进程池时在子进程中执行 fn，未启用时在本进程直接调用；两种方式下失败或超时都打印原因并返回 default。
+    """
+    name = label or getattr(fn, "__name__", "job")
+    if not pool_enabled():
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            print(f"[PDF_POOL] 任务失败（本进程） | {name} | {e}", flush=True)
+            return default
+    try:
+        return get_pool().run(fn, *args, **kwargs)
+    except PdfJobError as e:
+        print(f"[PDF_POOL] 任务失败 | {name} | {e}", flush=True)
+        return default
+
+
+@atexit.register
+def _shutdown() -> None:
+    if _pool is not None:
+        _pool.close()
@@ -0,0 +1,109 @@
+# backend/prompt_template.py
+"""
+预编译的 prompt 模板：加载时把文本切成「字面量 / 占位符」片段，渲染时直接拼接，不再逐次 str.format。
+- 只有 {标识符}（如 {memory_context}）是占位符；其余花括号（JSON 示例等）一律按字面量保留，无需转义
+- 渲染时缺失的变量保留原样 {name}，多余的变量忽略（不再因 KeyError 整段放弃替换）
+- PROMPT_VARIABLES 登记各 prompt 文件约定的变量；check_templates 在配置加载时列出缺失/未知变量
+"""
+
+import re
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, Optional, Tuple, Union
+
+_PLACEHOLDER_RE = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+# prompt 文件名 -> 调用方渲染时提供的变量；未登记的文件不应包含占位符
+PROMPT_VARIABLES: Dict[str, FrozenSet[str]] = {
+    "parameter_recommendation.txt": frozenset({
+        "structured_paper_json",
+        "relevant_forces_json",
+        "observed_phenomena",
+        "simulation_results_description",
+        "user_params_json",
+        "expected_phenomena",
+        "memory_context",
+    }),
+    "paper_figure_caption.txt": frozenset({"page_index", "param_summary_text"}),
+    "project_proposal.txt": frozenset({"user_idea", "memory_context"}),
+}
+
+
+class PromptTemplate:
+    """编译后的模板：segments 为字面量字符串与占位符名（_Var）交替的序列。"""
+
+    __slots__ = ("name", "text", "segments", "placeholders")
+
+    def __init__(self, text: str, name: str = ""):
+        self.name = name
+        self.text = text
+        segments: List[Union[str, "_Var"]] = []
+        names: List[str] = []
+        pos = 0
+        for m in _PLACEHOLDER_RE.finditer(text):
+            if m.start() > pos:
+                segments.append(text[pos:m.start()])
+            var = m.group(1)
+            segments.append(_Var(var))
+            if var not in names:
+                names.append(var)
+            pos = m.end()
+        if pos < len(text):
+            segments.append(text[pos:])
+        self.segments: Tuple[Union[str, "_Var"], ...] = tuple(segments)
+        self.placeholders: Tuple[str, ...] = tuple(names)
+
+    def render(self, variables: Optional[Mapping[str, Any]] = None) -> str:
+        """填充占位符；缺失的变量保留 {name} 原样。"""
+        if not variables or not self.placeholders:
+            return self.text
+        parts = []
+        for seg in self.segments:
+            if isinstance(seg, _Var):
+                parts.append(str(variables[seg.name]) if seg.name in variables else "{" + seg.name + "}")
+            else:
+                parts.append(seg)
+        return "".join(parts)
+
+    def missing(self, variables: Iterable[str]) -> List[str]:
+        provided = set(variables)
+        return [v for v in self.placeholders if v not in provided]
+
+    def __repr__(self) -> str:
+        return f"PromptTemplate({self.name!r}, placeholders={list(self.placeholders)!r})"
+
+
+class _Var:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+def compile_templates(prompts: Mapping[str, str]) -> Dict[str, PromptTemplate]:
+    """rel_path -> 文本 编译为 rel_path -> PromptTemplate。"""
+    return {rel: PromptTemplate(text, rel) for rel, text in prompts.items()}
+
+
+def check_templates(templates: Mapping[str, PromptTemplate]) -> List[Dict[str, Any]]:
+    """
+    按 PROMPT_VARIABLES 检查模板：
+    - unknown：文件中出现了约定之外的占位符（渲染时不会被填充，原样发给模型）
+    - missing：某 agent 合并后的 prompt（agent_specific + _default）缺少约定变量
+    返回问题列表 [{"prompt", "agent_id", "unknown": [...], "missing": [...]}]，无问题返回空列表。
+    """
+    issues: List[Dict[str, Any]] = []
+    by_name: Dict[str, Dict[str, PromptTemplate]] = {}
+    for rel, tpl in templates.items():
+        agent_id, _, name = rel.rpartition("/")
+        by_name.setdefault(name, {})[agent_id] = tpl
+    for name, per_agent in sorted(by_name.items()):
+        expected = PROMPT_VARIABLES.get(name, frozenset())
+        default = per_agent.get("_default")
+        for agent_id, tpl in sorted(per_agent.items()):
+            unknown = [v for v in tpl.placeholders if v not in expected]
+            missing: List[str] = []
+            if expected and agent_id != "":
+                present = set(tpl.placeholders) | (set(default.placeholders) if default is not None else set())
+                missing = sorted(expected - present)
+            if unknown or missing:
+                issues.append({"prompt": name, "agent_id": agent_id or "-", "unknown": unknown, "missing": missing})
+    return issues
@@ -0,0 +1,265 @@
+# backend/rate_limit.py
+"""
+共享令牌桶限流：所有 LLM 调用（invoke_model / intent / normalize_query / file-extract）与 memU 请求共用。
+- 按 (provider, model) 分桶（仅配置了 provider 级额度时同 provider 共用一桶），每桶两条令牌：请求数（rpm）与 token 数（tpm）
+- token 数由 messages / payload 字符数估算（estimate_tokens）
+- 超限时排队等待（背压）而不是直接失败；等待超过 LLM_RATE_MAX_WAIT 秒后放行并打印告警
+- 配置：config/agents/_default.json 的 "rate_limits"，键为 "provider/model" 或 "provider"，例如
+    "rate_limits": {"qwen": {"rpm": 300, "tpm": 500000}, "qwen/qwen-long": {"rpm": 60}, "memu": {"rpm": 120}}
+  未配置的端点不限流。config/agents/<agent_id>.json 的 "rate_limits" 按键覆盖 _default（与 concurrency 一致），
+  被覆盖的端点为该 agent 单独分桶（端点名带 "@agent_id"），未覆盖的端点仍与其他 agent 共用桶。
+"""
+
+import asyncio
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import get_env
+from .config_registry import get_config
+from .llm_clients import canonical_provider
+
+# 每次调用额外计入的输出 token 估计（TPM 同时统计输入与输出）
+_DEFAULT_COMPLETION_TOKENS = 512
+# 多模态消息中每张图按固定 token 计（约 1024px 长边的图），不按 base64 字符数估算
+IMAGE_PART_TOKENS = 1280
+
+
+def content_text(content: Any) -> Tuple[str, int]:
+    """消息 content 的文本部分与图片数；content 为多模态 parts 列表时只拼接 type=text 的部分。"""
+    if isinstance(content, list):
+        texts = [str(p.get("text") or "") for p in content if isinstance(p, dict) and p.get("type") == "text"]
+        images = sum(1 for p in content if isinstance(p, dict) and p.get("type") == "image_url")
+        return "".join(texts), images
+    return str(content or ""), 0
+
+
+def estimate_tokens(content: Any) -> int:
+    """
+    粗略估算 token 数：ASCII 约 4 字符 1 token，非 ASCII（中文等）约 1 字符 1 token。
+    content 可为字符串、messages 列表或任意可 JSON 序列化对象；messages 中的图片按 IMAGE_PART_TOKENS 计。
+    """
+    images = 0
+    if isinstance(content, list) and all(isinstance(m, dict) for m in content):
+        parts = [content_text(m.get("content")) for m in content]
+        text = "".join(t for t, _ in parts)
+        images = sum(n for _, n in parts)
+    elif isinstance(content, str):
+        text = content
+    else:
+        try:
+            text = json.dumps(content, ensure_ascii=False)
+        except (TypeError, ValueError):
+            text = str(content)
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return max(1, ascii_chars // 4 + (len(text) - ascii_chars) + images * IMAGE_PART_TOKENS)
+
+
+class TokenBucket:
+    """容量 capacity、每秒补充 rate 的令牌桶；reserve 返回需要等待的秒数（预占令牌，先到先得）。"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reconfigure(self, rate: float, capacity: float) -> None:
+        if rate != self.rate or capacity != self.capacity:
+            self.rate = rate
+            self.capacity = capacity
+            self._tokens = min(self._tokens, capacity)
+
+    def reserve(self, amount: float, now: float) -> float:
+        amount = min(amount, self.capacity)
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+
+class _Endpoint:
+    def __init__(self, key: str):
+        self.key = key
+        self.rpm: Optional[TokenBucket] = None
+        self.tpm: Optional[TokenBucket] = None
+        self.queued = 0
+        self.max_queued = 0
+        self.acquired = 0
+        self.delayed = 0
+        self.waited_seconds = 0.0
+        self.overflow = 0
+
+
+class RateLimiter:
+    """按端点分桶的共享限流器；acquire（线程）与 aacquire（协程）共用同一组令牌桶。"""
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, float]]] = None, max_wait: Optional[float] = None):
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, _Endpoint] = {}
+        self._fixed_limits = {str(k).lower(): v for k, v in limits.items()} if limits is not None else None
+        self._limits: Tuple[Any, Dict[str, Dict[str, Dict[str, float]]]] = (None, {})
+        if max_wait is None:
+            try:
+                max_wait = float(get_env("LLM_RATE_MAX_WAIT") or 300.0)
+            except ValueError:
+                max_wait = 300.0
+        self.max_wait = max_wait
+
+    def _load_limits(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+        各 agent 规整后的 rate_limits：{agent_id: {端点键: 额度}}。显式传入的 limits 固定作为 _default；
+        否则取配置快照中各 agents/*.json 的 rate_limits（快照替换时重新规整）。不持有 self._lock 调用。
+        """
+        if self._fixed_limits is not None:
+            return {"_default": self._fixed_limits}
+        snap = get_config()
+        cached_snap, limits = self._limits
+        if snap is not cached_snap:
+            limits = {}
+            for aid, cfg in snap.agents.items():
+                raw = (cfg or {}).get("rate_limits")
+                if isinstance(raw, dict):
+                    limits[aid] = {str(k).lower(): v for k, v in raw.items() if isinstance(v, dict)}
+            self._limits = (snap, limits)
+        return limits
+
+    def _endpoint(self, provider: str, model: str, agent_id: str, limits: Dict[str, Dict[str, Dict[str, float]]]) -> _Endpoint:
+        # "provider/model" 有配置时按模型分桶；否则 provider 级配置由该 provider 所有模型共享一个桶；
+        # agent 自己的 rate_limits 按键覆盖 _default，覆盖的端点单独分桶
+        provider = canonical_provider(provider)
+        own = limits.get(agent_id, {}) if agent_id != "_default" else {}
+        merged = {**limits.get("_default", {}), **own}
+        model_key = f"{provider}/{model}" if model else provider
+        if model_key.lower() in merged:
+            key, cfg = model_key, merged[model_key.lower()]
+        elif provider in merged:
+            key, cfg = provider, merged[provider]
+        else:
+            key, cfg = model_key, {}
+        if key.lower() in own:
+            key = f"{key}@{agent_id}"
+        ep = self._endpoints.get(key)
+        if ep is None:
+            ep = _Endpoint(key)
+            self._endpoints[key] = ep
+        for attr, name in (("rpm", "rpm"), ("tpm", "tpm")):
+            try:
+                per_min = float(cfg.get(name) or 0)
+            except (TypeError, ValueError):
+                per_min = 0.0
+            bucket = getattr(ep, attr)
+            if per_min <= 0:
+                setattr(ep, attr, None)
+            elif bucket is None:
+                setattr(ep, attr, TokenBucket(per_min / 60.0, per_min))
+            else:
+                bucket.reconfigure(per_min / 60.0, per_min)
+        return ep
+
+    def _reserve(self, provider: str, model: str, tokens: int, agent_id: str) -> Tuple[_Endpoint, float]:
+        # 配置快照可能触发热加载读盘，须在持锁之前取得
+        limits = self._load_limits()
+        with self._lock:
+            ep = self._endpoint(provider, model, agent_id or "_default", limits)
+            now = time.monotonic()
+            wait = 0.0
+            if ep.rpm is not None:
+                wait = max(wait, ep.rpm.reserve(1, now))
+            if ep.tpm is not None:
+                wait = max(wait, ep.tpm.reserve(tokens, now))
+            ep.acquired += 1
+            if wait > 0:
+                ep.delayed += 1
+                if wait > self.max_wait:
+                    ep.overflow += 1
+                    print(f"[RATE_LIMIT] 等待 {wait:.1f}s 超过上限 {self.max_wait:.0f}s，提前放行 | endpoint={ep.key}", flush=True)
+                    wait = self.max_wait
+                ep.queued += 1
+                ep.max_queued = max(ep.max_queued, ep.queued)
+                ep.waited_seconds += wait
+            return ep, wait
+
+    def _release_queue(self, ep: _Endpoint) -> None:
+        with self._lock:
+            ep.queued -= 1
+
+    def acquire(self, provider: str, model: str = "", tokens: int = 1, agent_id: str = "_default") -> float:
+        """阻塞直到 (provider, model) 有可用额度（按 agent_id 的 rate_limits 覆盖）；返回实际等待秒数。"""
+        ep, wait = self._reserve(provider, model, tokens, agent_id)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._release_queue(ep)
+        return wait
+
+    async def aacquire(self, provider: str, model: str = "", tokens: int = 1, agent_id: str = "_default") -> float:
+        """acquire 的协程版本：await asyncio.sleep 排队，不占用线程。"""
+        ep, wait = self._reserve(provider, model, tokens, agent_id)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._release_queue(ep)
+        return wait
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        """每个端点的排队深度（当前/峰值）、放行数、被延迟次数、累计等待秒数与配置额度。"""
+        with self._lock:
+            out = []
+            for ep in sorted(self._endpoints.values(), key=lambda e: e.key):
+                out.append({
+                    "endpoint": ep.key,
+                    "rpm": round(ep.rpm.capacity) if ep.rpm else None,
+                    "tpm": round(ep.tpm.capacity) if ep.tpm else None,
+                    "queue_depth": ep.queued,
+                    "max_queue_depth": ep.max_queued,
+                    "acquired": ep.acquired,
+                    "delayed": ep.delayed,
+                    "overflow": ep.overflow,
+                    "waited_seconds": round(ep.waited_seconds, 3),
+                })
+            return out
+
+
+_limiter_lock = threading.Lock()
+_limiter: Optional[RateLimiter] = None
+
+
+def get_limiter() -> RateLimiter:
+    """进程级共享限流器。"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
+
+
+def set_limiter(limiter: Optional[RateLimiter]) -> None:
+    """替换进程级限流器（单测注入固定额度；传 None 则下次 get_limiter 重建）。"""
+    global _limiter
+    with _limiter_lock:
+        _limiter = limiter
+
+
+def completion_allowance() -> int:
+    """每次 LLM 调用额外计入 TPM 的输出 token 估计（.env 的 LLM_RATE_COMPLETION_TOKENS）。"""
+    try:
+        return int(get_env("LLM_RATE_COMPLETION_TOKENS") or _DEFAULT_COMPLETION_TOKENS)
+    except ValueError:
+        return _DEFAULT_COMPLETION_TOKENS
+
+
+def acquire_for_messages(provider: str, model: str, messages: List[Dict[str, str]], agent_id: str = "_default") -> float:
+    """LLM 调用前限流：按 messages 估算 token 并加上输出估计。"""
+    return get_limiter().acquire(provider, model, estimate_tokens(messages) + completion_allowance(), agent_id=agent_id)
+
+
+async def aacquire_for_messages(provider: str, model: str, messages: List[Dict[str, str]], agent_id: str = "_default") -> float:
+    return await get_limiter().aacquire(
+        provider, model, estimate_tokens(messages) + completion_allowance(), agent_id=agent_id
+    )
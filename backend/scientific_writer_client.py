@@ -15,8 +15,6 @@ import uuid
 from pathlib import Path
 from typing import Any, AsyncGenerator, Dict, List, Optional, Callable
 
-from dotenv import load_dotenv
-
 from .config import (
     PROJECT_ROOT,
     WRITING_OUTPUTS,
@@ -25,27 +23,22 @@ from .config import (
     VENUE_FORMATS,
     PROJECT_TYPES,
     PROJECT_TYPE_PROMPT_HINTS,
+    ensure_dirs,
 )
+from . import llm_telemetry
+from .llm_clients import get_openai_client
+from .rate_limit import acquire_for_messages
 
-# Load .env from merge_project root so scientific_writer sees ANTHROPIC_* / OPENROUTER_*
-_ENV_FILE = PROJECT_ROOT / ".env"
-if _ENV_FILE.exists():
-    load_dotenv(_ENV_FILE, override=True)
+# 项目根目录 .env（ANTHROPIC_* / OPENROUTER_*）已由 config 导入时加载，scientific_writer 可直接读取
 
 
 # Optional: Qwen for query normalization (DashScope)
 def _get_qwen_client():
-    try:
-        from openai import OpenAI
-        key = get_env("DASHSCOPE_API_KEY")
-        if not key:
-            return None
-        return OpenAI(
-            api_key=key,
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-    except Exception:
-        return None
+    return get_openai_client(
+        "dashscope",
+        "https://dashscope.aliyuncs.com/compatible-mode/v1",
+        get_env("DASHSCOPE_API_KEY"),
+    )
 
 
 # Scientific Writer API (pip install scientific-writer)
@@ -83,7 +76,9 @@ class ScientificWriterClient:
     ):
         self.cwd = Path(cwd or PROJECT_ROOT)
         self.output_dir = Path(output_dir or WRITING_OUTPUTS)
+        ensure_dirs()
         if env_path and Path(env_path).exists():
+            from dotenv import load_dotenv
             load_dotenv(env_path, override=True)
         self._generate_paper_fn = _import_generate_paper()
         self._job_storage: Dict[str, Dict[str, Any]] = {}
@@ -151,16 +146,25 @@ class ScientificWriterClient:
 【记忆上下文】(可选)
 {memory_md[:3000] if memory_md else '无'}
 """
+        messages = [
+            {"role": "system", "content": QUERY_NORMALIZE_SYSTEM},
+            {"role": "user", "content": user_content.strip()},
+        ]
         try:
-            resp = client.chat.completions.create(
-                model=qwen_model,
-                messages=[
-                    {"role": "system", "content": QUERY_NORMALIZE_SYSTEM},
-                    {"role": "user", "content": user_content.strip()},
-                ],
-                temperature=0.3,
-            )
-            text = resp.choices[0].message.content.strip()
+            acquire_for_messages("dashscope", qwen_model, messages)
+            with llm_telemetry.track("normalize_query", "_default", "query_normalize", "normalize", messages):
+                t0 = time.monotonic()
+                try:
+                    resp = client.chat.completions.create(
+                        model=qwen_model,
+                        messages=messages,
+                        temperature=0.3,
+                    )
+                except Exception as e:
+                    llm_telemetry.note_attempt("dashscope", qwen_model, False, time.monotonic() - t0, error=str(e))
+                    raise
+                text = resp.choices[0].message.content.strip()
+                llm_telemetry.note_attempt("dashscope", qwen_model, bool(text), time.monotonic() - t0, response=resp, output=text)
             # 去掉可能的引号
             if text.startswith('"') and text.endswith('"'):
                 text = text[1:-1]
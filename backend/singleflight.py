@@ -0,0 +1,155 @@
+# backend/singleflight.py
+"""
+请求合并（single-flight）：同一 key 的并发调用只真正执行一次，其余调用方等待并共享结果。
+- 线程与 asyncio 共用同一份 in-flight 表：do()（线程）与 ado()（协程）对同一 key 互相合并
+- 发起方抛出异常时，等待方收到同一异常；发起方被取消（CancelledError / KeyboardInterrupt）时，等待方各自重新执行
+- 在事件循环线程内调用 do() 时不阻塞等待（会卡住整个循环），已有 in-flight 请求则自行执行
+- 等待方拿到结果的深拷贝，避免多方修改同一个 dict
+- 分组统计：调用数、实际执行数、被合并数、当前 in-flight 数，见 stats()
+用于 invoke_model / ainvoke_model（key 同 llm_cache）与 MemUClient.retrieve。
+"""
+
+import asyncio
+import concurrent.futures
+import copy
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class _LeaderAbandoned(Exception):
+    """发起方未完成（被取消或中断），等待方应自行执行。"""
+
+
+class SingleFlight:
+    """一组 key 空间；同一 key 的并发调用合并为一次执行。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+        self.calls = 0
+        self.executed = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.max_waiters = 0
+        self._waiters: Dict[str, int] = {}
+
+    def _join(self, key: str, can_wait: bool = True):
+        """返回 (future, 是否为发起方)；已有 in-flight 请求但调用方不能等待时返回 (None, False)。"""
+        with self._lock:
+            self.calls += 1
+            fut = self._inflight.get(key)
+            if fut is not None and not can_wait:
+                self.executed += 1
+                return None, False
+            if fut is not None:
+                self.coalesced += 1
+                self._waiters[key] = self._waiters.get(key, 0) + 1
+                self.max_waiters = max(self.max_waiters, self._waiters[key])
+                return fut, False
+            fut = concurrent.futures.Future()
+            self._inflight[key] = fut
+            self._waiters[key] = 0
+            self.executed += 1
+            return fut, True
+
+    def _finish(self, key: str, fut: concurrent.futures.Future) -> None:
+        with self._lock:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+                self._waiters.pop(key, None)
+
+    def _settle(self, key: str, fut: concurrent.futures.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        self._finish(key, fut)
+        if error is None:
+            fut.set_result(result)
+            return
+        if isinstance(error, Exception):
+            with self._lock:
+                self.errors += 1
+            fut.set_exception(error)
+        else:
+            fut.set_exception(_LeaderAbandoned())
+
+    def do(self, key: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        同步调用：key 已有 in-flight 请求时阻塞等待其结果，否则执行 fn(*args, **kwargs)。
+        当前线程正在运行事件循环时不等待：发起方无论在本循环、其他循环还是其他线程，阻塞都会卡住本循环
+        （同循环时还会死锁），此时直接自行执行。
+        """
+        try:
+            asyncio.get_running_loop()
+            in_loop = True
+        except RuntimeError:
+            in_loop = False
+        fut, leader = self._join(key, can_wait=not in_loop)
+        if fut is None:
+            return fn(*args, **kwargs)
+        if not leader:
+            try:
+                return copy.deepcopy(fut.result())
+            except _LeaderAbandoned:
+                return fn(*args, **kwargs)
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._settle(key, fut, error=e)
+            raise
+        self._settle(key, fut, result)
+        return result
+
+    async def ado(self, key: str, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """协程调用：等待方 await 发起方的 future（发起方可以是线程或其他事件循环）。"""
+        fut, leader = self._join(key)
+        if not leader:
+            try:
+                return copy.deepcopy(await asyncio.wrap_future(fut))
+            except _LeaderAbandoned:
+                return await fn(*args, **kwargs)
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            self._settle(key, fut, error=e)
+            raise
+        self._settle(key, fut, result)
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "group": self.name,
+                "calls": self.calls,
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "inflight": len(self._inflight),
+                "max_waiters": self.max_waiters,
+                "coalesce_rate": round(self.coalesced / self.calls, 4) if self.calls else 0.0,
+            }
+
+
+_groups_lock = threading.Lock()
+_groups: Dict[str, SingleFlight] = {}
+
+
+def get_group(name: str) -> SingleFlight:
+    """进程级共享的 single-flight 分组（如 "llm"、"memu_retrieve"）。"""
+    with _groups_lock:
+        group = _groups.get(name)
+        if group is None:
+            group = SingleFlight(name)
+            _groups[name] = group
+        return group
+
+
+def stats() -> List[Dict[str, Any]]:
+    """各分组的合并统计。"""
+    with _groups_lock:
+        groups = sorted(_groups.values(), key=lambda g: g.name)
+    return [g.snapshot() for g in groups]
+
+
+def reset_groups() -> None:
+    """清空分组与统计（单测用）。"""
+    with _groups_lock:
+        _groups.clear()